@@ -132,7 +132,9 @@ install_python_deps() {
     pip install \
         requests \
         PyYAML \
-        systemd-python
+        systemd-python \
+        inotify_simple \
+        orjson
     
     deactivate
     
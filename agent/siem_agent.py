@@ -6,6 +6,7 @@ Collects logs from various sources and forwards them to the SIEM platform
 
 import os
 import sys
+import errno
 import time
 import json
 import yaml
@@ -13,12 +14,51 @@ import signal
 import logging
 import threading
 import requests
+import gzip
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import socket
 from pathlib import Path
 from datetime import datetime, timezone
-from queue import Queue, Empty
+from collections import deque
+from dataclasses import dataclass, asdict, is_dataclass
+from concurrent.futures import ThreadPoolExecutor
 import select
+import mmap
+import selectors
 import subprocess
+import ctypes
+import ctypes.util
+
+try:
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+    INOTIFY_AVAILABLE = True
+except ImportError:
+    INOTIFY_AVAILABLE = False
+
+try:
+    from systemd import journal
+    SYSTEMD_JOURNAL_AVAILABLE = True
+except ImportError:
+    SYSTEMD_JOURNAL_AVAILABLE = False
+
+try:
+    from prometheus_client import start_http_server, REGISTRY
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # Configure logging
 logging.basicConfig(
@@ -32,22 +72,359 @@ logging.basicConfig(
 
 logger = logging.getLogger('siem-agent')
 
+# Agent threads only run shallow call stacks; the 8 MB default is mostly waste
+THREAD_STACK_SIZE = 512 * 1024
+
+# Bytes requested per read() when draining a tailed file
+TAIL_READ_SIZE = 1 << 20
+
+# recvmmsg(2) batched UDP receive (Linux only)
+MSG_WAITFORONE = 0x10000
+SYSLOG_BATCH_SIZE = 64
+# Large enough for any UDP datagram, as with the recvfrom(65535) fallback
+SYSLOG_BUFFER_SIZE = 65535
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if is_dataclass(obj):
+        return asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_json(obj):
+    """Serialize obj to JSON bytes, using orjson when available"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_UTC_Z)
+    return json.dumps(obj, default=_json_default).encode('utf-8')
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t)
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int)
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _MsgHdr),
+        ('msg_len', ctypes.c_uint)
+    ]
+
+
+def _load_recvmmsg():
+    """Return libc's recvmmsg function, or None if unavailable"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+_recvmmsg = _load_recvmmsg()
+RECVMMSG_AVAILABLE = _recvmmsg is not None
+
+
+class BatchedUDPReceiver:
+    """
+    Receive up to SYSLOG_BATCH_SIZE datagrams per syscall using recvmmsg(2).
+    Buffers are allocated once and reused for every call. Datagrams cut off
+    by a smaller buffer_size are counted in truncated and logged.
+    """
+    
+    def __init__(self, sock, batch_size=SYSLOG_BATCH_SIZE, buffer_size=SYSLOG_BUFFER_SIZE):
+        self.fd = sock.fileno()
+        self.batch_size = batch_size
+        self.truncated = 0
+        self.buffers = [ctypes.create_string_buffer(buffer_size) for _ in range(batch_size)]
+        self.addrs = [ctypes.create_string_buffer(128) for _ in range(batch_size)]
+        self.iovecs = (_IOVec * batch_size)()
+        self.msgs = (_MMsgHdr * batch_size)()
+        
+        for i in range(batch_size):
+            self.iovecs[i].iov_base = ctypes.cast(self.buffers[i], ctypes.c_void_p)
+            self.iovecs[i].iov_len = buffer_size
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_name = ctypes.cast(self.addrs[i], ctypes.c_void_p)
+    
+    def recv(self):
+        """Return a list of (data, remote_ip) tuples; empty if nothing is pending"""
+        for i in range(self.batch_size):
+            self.msgs[i].msg_hdr.msg_namelen = 128
+            self.msgs[i].msg_hdr.msg_flags = 0
+        
+        count = _recvmmsg(self.fd, self.msgs, self.batch_size, MSG_WAITFORONE | socket.MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+        
+        datagrams = []
+        for i in range(count):
+            if self.msgs[i].msg_hdr.msg_flags & socket.MSG_TRUNC:
+                self.truncated += 1
+                logger.warning(f"Syslog datagram truncated to {self.msgs[i].msg_len} bytes "
+                               f"({self.truncated} truncated so far)")
+            # Copy only the received bytes, not the whole buffer
+            data = ctypes.string_at(self.buffers[i], self.msgs[i].msg_len)
+            # sockaddr_in: family (2), port (2), addr (4)
+            remote_ip = socket.inet_ntoa(self.addrs[i].raw[4:8])
+            datagrams.append((data, remote_ip))
+        return datagrams
+
+
+@dataclass
+class Event:
+    """A collected log event as sent to the SIEM ingest API"""
+    __slots__ = ('timestamp', 'host', 'source', 'raw', 'agent_info')
+    
+    timestamp: str
+    host: str
+    source: str
+    raw: str
+    agent_info: dict
+
+
+JOURNAL_EXPORT_FIELDS = frozenset([b'MESSAGE', b'_SYSTEMD_UNIT', b'_PID', b'PRIORITY'])
+
+
+def parse_journal_export(buf, fields=JOURNAL_EXPORT_FIELDS):
+    """
+    Parse complete entries from a journalctl --output=export byte buffer.
+    
+    Entries are blocks of NAME=value lines ended by a blank line; fields that
+    are not plain text are encoded as NAME, newline, 64-bit little-endian size,
+    the raw data and a newline. Only the requested fields are decoded.
+    
+    Returns (entries, consumed) where consumed is the number of bytes that
+    belong to complete entries.
+    """
+    entries = []
+    entry = {}
+    pos = 0
+    consumed = 0
+    end = len(buf)
+    
+    while pos < end:
+        nl = buf.find(b'\n', pos)
+        if nl < 0:
+            break
+        
+        if nl == pos:
+            # Blank line terminates the entry
+            entries.append(entry)
+            entry = {}
+            pos = consumed = nl + 1
+            continue
+        
+        eq = buf.find(b'=', pos, nl)
+        if eq >= 0:
+            name = bytes(buf[pos:eq])
+            if name in fields:
+                entry[name.decode()] = buf[eq + 1:nl].decode('utf-8', errors='replace')
+            pos = nl + 1
+        else:
+            # Binary-safe field
+            if nl + 9 > end:
+                break
+            size = int.from_bytes(buf[nl + 1:nl + 9], 'little')
+            data_end = nl + 9 + size
+            if data_end >= end:
+                break
+            name = bytes(buf[pos:nl])
+            if name in fields:
+                entry[name.decode()] = buf[nl + 9:data_end].decode('utf-8', errors='replace')
+            pos = data_end + 1
+    
+    return entries, consumed
+
+
+class _FileTail:
+    """Per-file state for the shared inotify tailer"""
+    __slots__ = ('path', 'source_name', 'fd', 'buf')
+    
+    def __init__(self, path, source_name):
+        self.path = path
+        self.source_name = source_name
+        self.fd = None
+        self.buf = bytearray()
+
+
+class EventQueue:
+    """
+    Bounded multi-producer / single-consumer event queue.
+    deque.append and deque.popleft are atomic, so producers never take a
+    lock; the sender pops a whole batch per wakeup and is woken through a
+    single Event that is only touched when it is not already set.
+    
+    When full, the overflow policy decides what happens: 'drop' rejects the
+    item, 'block' waits for the sender to make room and 'grow' ignores maxsize.
+    """
+    
+    OVERFLOW_POLICIES = ('block', 'drop', 'grow')
+    
+    def __init__(self, maxsize=10000, overflow_policy='drop'):
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy: {overflow_policy}")
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self._items = deque()
+        self._ready = threading.Event()
+        self._space = threading.Event()
+    
+    def put(self, item):
+        """Append an item, returning False if it was dropped because the queue is full"""
+        # Concurrent producers may overshoot maxsize by at most one item each
+        if self.overflow_policy != 'grow':
+            while len(self._items) >= self.maxsize:
+                if self.overflow_policy == 'drop':
+                    return False
+                self._space.clear()
+                if len(self._items) < self.maxsize:
+                    break
+                self._space.wait(0.1)
+        
+        self._items.append(item)
+        if not self._ready.is_set():
+            self._ready.set()
+        return True
+    
+    def drain(self, max_items):
+        """Remove and return up to max_items items in FIFO order"""
+        items = []
+        popleft = self._items.popleft
+        try:
+            for _ in range(max_items):
+                items.append(popleft())
+        except IndexError:
+            pass
+        
+        if items and not self._space.is_set():
+            self._space.set()
+        
+        if not self._items:
+            self._ready.clear()
+            # A producer may have appended after the check but before the clear
+            if self._items:
+                self._ready.set()
+        return items
+    
+    def wait(self, timeout=None):
+        """Block until the queue may have items; returns False on timeout"""
+        return self._ready.wait(timeout)
+    
+    def qsize(self):
+        return len(self._items)
+    
+    def empty(self):
+        return not self._items
+
+
+class StatCounter:
+    """
+    Event counter with one cell per thread, so producers never share a
+    read-modify-write. Cells are summed when the counter is read.
+    """
+    
+    def __init__(self):
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+    
+    def add(self, n=1):
+        try:
+            self._local.cell[0] += n
+        except AttributeError:
+            cell = self._local.cell = [n]
+            with self._lock:
+                self._cells.append(cell)
+    
+    @property
+    def value(self):
+        with self._lock:
+            return sum(cell[0] for cell in self._cells)
+
+
+class AgentMetricsCollector:
+    """Prometheus collector exposing the agent's counters and queue depth"""
+    
+    def __init__(self, agent):
+        self.agent = agent
+    
+    def collect(self):
+        agent = self.agent
+        for name, counter, documentation in (
+            ('siem_agent_events_collected', agent.events_collected, 'Events collected from all sources'),
+            ('siem_agent_events_sent', agent.events_sent, 'Events accepted by the SIEM'),
+            ('siem_agent_events_failed', agent.events_failed, 'Events that failed to send'),
+            ('siem_agent_events_dropped', agent.events_dropped, 'Events dropped because the queue was full'),
+        ):
+            yield CounterMetricFamily(name, documentation, value=counter.value)
+        yield GaugeMetricFamily('siem_agent_queue_depth', 'Events waiting to be sent', value=agent.event_queue.qsize())
+
+
 class SIEMAgent:
     def __init__(self, config_path='/etc/siem-agent/config.yaml'):
         self.config_path = config_path
         self.config = self._load_config()
         self.running = False
         self.threads = []
-        self.event_queue = Queue(maxsize=10000)
+        self.event_queue = EventQueue(
+            maxsize=self.config.get('queue_size', 10000),
+            overflow_policy=self.config.get('overflow_policy', 'drop')
+        )
         self.hostname = socket.gethostname()
+        self._agent_info = {
+            'version': '1.0.0',
+            'agent_id': self.hostname
+        }
         
-        # Statistics
-        self.stats = {
-            'events_collected': 0,
-            'events_sent': 0,
-            'events_failed': 0,
-            'start_time': None
+        # Batches are POSTed from a small worker pool so the sender can keep
+        # draining the queue while requests are in flight
+        sender_workers = self.config.get('sender_workers', 4)
+        self._sender_pool = ThreadPoolExecutor(max_workers=sender_workers, thread_name_prefix='siem-sender')
+        self._in_flight = threading.BoundedSemaphore(self.config.get('max_in_flight', sender_workers * 2))
+        
+        # One pooled session shared by the sender workers and the shutdown flush
+        self._compress = self.config.get('compress', True)
+        self._request_timeout = (self.config.get('connection') or {}).get('timeout', 10)
+        self._session_headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f"Bearer {self.config['api_token']}"
         }
+        if self._compress:
+            self._session_headers['Content-Encoding'] = 'gzip'
+        self._session = self._create_session(pool_maxsize=sender_workers)
+        self._clock_local = threading.local()
+        
+        # Statistics
+        self.events_collected = StatCounter()
+        self.events_sent = StatCounter()
+        self.events_failed = StatCounter()
+        self.events_dropped = StatCounter()
+        self.start_time = None
         
         # Signal handlers
         signal.signal(signal.SIGTERM, self._signal_handler)
@@ -57,7 +434,7 @@ class SIEMAgent:
         """Load configuration from YAML file"""
         try:
             with open(self.config_path, 'r') as f:
-                config = yaml.safe_load(f)
+                config = yaml.load(f, Loader=YAMLLoader)
             
             # Validate required configuration
             required_fields = ['siem_endpoint', 'api_token']
@@ -65,6 +442,9 @@ class SIEMAgent:
                 if field not in config:
                     raise ValueError(f"Missing required configuration field: {field}")
             
+            if config.get('overflow_policy', 'drop') not in EventQueue.OVERFLOW_POLICIES:
+                raise ValueError(f"Invalid overflow_policy: {config['overflow_policy']}")
+            
             return config
         except Exception as e:
             logger.error(f"Error loading configuration: {e}")
@@ -79,7 +459,8 @@ class SIEMAgent:
         """Start the SIEM agent"""
         logger.info("Starting SIEM Agent...")
         self.running = True
-        self.stats['start_time'] = datetime.now(timezone.utc)
+        self.start_time = datetime.now(timezone.utc)
+        threading.stack_size(THREAD_STACK_SIZE)
         
         try:
             # Start event sender thread
@@ -87,21 +468,34 @@ class SIEMAgent:
             sender_thread.start()
             self.threads.append(sender_thread)
             
-            # Start file tail threads
-            for source in self.config.get('file_sources', []):
+            # Start file tailing - one inotify thread for all files, or a polling thread per file
+            file_sources = self.config.get('file_sources', [])
+            if file_sources and INOTIFY_AVAILABLE:
                 thread = threading.Thread(
-                    target=self._tail_file,
-                    args=(source['path'], source['name']),
+                    target=self._tail_files,
+                    args=(file_sources,),
                     daemon=True
                 )
                 thread.start()
                 self.threads.append(thread)
+            else:
+                if file_sources:
+                    logger.warning("inotify_simple not available, falling back to polling file tail")
+                for source in file_sources:
+                    thread = threading.Thread(
+                        target=self._tail_file,
+                        args=(source['path'], source['name']),
+                        daemon=True
+                    )
+                    thread.start()
+                    self.threads.append(thread)
             
-            # Start syslog listener threads
-            for source in self.config.get('syslog_sources', []):
+            # Start a single syslog listener thread for all UDP ports
+            syslog_sources = self.config.get('syslog_sources', [])
+            if syslog_sources:
                 thread = threading.Thread(
                     target=self._listen_syslog,
-                    args=(source['port'], source['name']),
+                    args=(syslog_sources,),
                     daemon=True
                 )
                 thread.start()
@@ -113,6 +507,16 @@ class SIEMAgent:
                 thread.start()
                 self.threads.append(thread)
             
+            # Expose metrics over HTTP if configured
+            metrics_port = self.config.get('metrics_port')
+            if metrics_port:
+                if PROMETHEUS_AVAILABLE:
+                    REGISTRY.register(AgentMetricsCollector(self))
+                    start_http_server(metrics_port)
+                    logger.info(f"Prometheus metrics available on port {metrics_port}")
+                else:
+                    logger.warning("metrics_port is set but prometheus_client is not installed")
+            
             # Start statistics reporter
             stats_thread = threading.Thread(target=self._stats_reporter, daemon=True)
             stats_thread.start()
@@ -143,7 +547,7 @@ class SIEMAgent:
         logger.info("SIEM Agent stopped")
     
     def _tail_file(self, file_path, source_name):
-        """Tail a log file and send new lines"""
+        """Tail a log file by polling and send new lines, used when inotify is unavailable"""
         logger.info(f"Starting file tail for {file_path} (source: {source_name})")
         
         try:
@@ -153,59 +557,331 @@ class SIEMAgent:
                 while not file_path.exists() and self.running:
                     time.sleep(5)
             
-            with open(file_path, 'r') as f:
-                # Seek to end of file
-                f.seek(0, 2)
-                
-                while self.running:
-                    line = f.readline()
-                    if not line:
-                        time.sleep(0.1)
-                        continue
-                    
-                    line = line.strip()
-                    if line:
-                        self._queue_event(source_name, line)
+            # Forward the existing backlog first if configured, otherwise start at the end
+            offset = None
+            if self.config.get('catch_up', False):
+                offset = self._catch_up_file(file_path, source_name)
+            
+            self._tail_file_poll(file_path, source_name, offset)
                         
         except Exception as e:
             logger.error(f"Error tailing file {file_path}: {e}")
     
-    def _listen_syslog(self, port, source_name):
-        """Listen for syslog messages on UDP port"""
+    def _catch_up_file(self, file_path, source_name):
+        """
+        Queue the trailing catch_up_bytes of a file in bulk through mmap.
+        Returns the offset just past the last complete line.
+        """
+        catch_up_bytes = self.config.get('catch_up_bytes', 8 * 1024 * 1024)
+        # A chunk must fit in the queue, or waiting for room for it never ends
+        chunk_lines = max(1, min(1000, self.event_queue.maxsize))
+        
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return 0
+            
+            # mmap offsets must be page aligned
+            start = max(0, size - catch_up_bytes)
+            start -= start % mmap.ALLOCATIONGRANULARITY
+            
+            # The first line is only cut off if start is not at a line boundary
+            partial_first_line = False
+            if start > 0:
+                f.seek(start - 1)
+                partial_first_line = f.read(1) != b'\n'
+            
+            with mmap.mmap(f.fileno(), size - start, offset=start, access=mmap.ACCESS_READ) as mm:
+                data = mm[:]
+        
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].split(b'\n')
+        if partial_first_line:
+            lines = lines[1:]
+        
+        logger.info(f"Catching up {len(lines)} lines from {file_path}")
+        
+        for i in range(0, len(lines), chunk_lines):
+            chunk = lines[i:i + chunk_lines]
+            # Wait for room rather than overflowing the queue with backlog
+            while self.running and self.event_queue.maxsize - self.event_queue.qsize() < len(chunk):
+                time.sleep(0.05)
+            if not self.running:
+                break
+            
+            for line in chunk:
+                line = line.strip()
+                if line:
+                    self._queue_event(source_name, line.decode('utf-8', errors='ignore'))
+        
+        return start + end
+    
+    def _tail_files(self, sources):
+        """Tail all file sources from one thread, multiplexed on a single inotify instance"""
+        inotify = INotify()
+        watch_mask = inotify_flags.MODIFY | inotify_flags.CREATE | inotify_flags.MOVED_TO
+        # Parent directories are watched so rotation (rename + create) is noticed
+        dir_by_wd = {}
+        wd_by_dir = {}
+        tails = {}
+        pending = [(Path(source['path']), source['name']) for source in sources]
+        next_retry = 0
+        
+        try:
+            while self.running:
+                if pending and time.time() >= next_retry:
+                    # Directories that don't exist yet are retried every few seconds
+                    waiting = []
+                    for path, source_name in pending:
+                        directory = str(path.parent)
+                        if directory not in wd_by_dir:
+                            try:
+                                wd = inotify.add_watch(directory, watch_mask)
+                            except OSError:
+                                waiting.append((path, source_name))
+                                continue
+                            wd_by_dir[directory] = wd
+                            dir_by_wd[wd] = directory
+                        
+                        logger.info(f"Starting file tail for {path} (source: {source_name})")
+                        tail = _FileTail(path, source_name)
+                        tails[(directory, path.name)] = tail
+                        if not path.exists():
+                            logger.warning(f"Log file {path} does not exist, waiting...")
+                            continue
+                        try:
+                            self._open_tail(tail, initial=True)
+                        except Exception as e:
+                            logger.error(f"Error tailing file {path}: {e}")
+                    
+                    pending = waiting
+                    next_retry = time.time() + 5
+                
+                events = inotify.read(timeout=1000)
+                if not events:
+                    continue
+                
+                rotated = {}
+                modified = {}
+                for event in events:
+                    tail = tails.get((dir_by_wd.get(event.wd), event.name))
+                    if tail is None:
+                        continue
+                    if event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                        rotated[id(tail)] = tail
+                    else:
+                        modified[id(tail)] = tail
+                
+                for key, tail in {**modified, **rotated}.items():
+                    try:
+                        self._update_tail(tail, key in rotated)
+                    except Exception as e:
+                        logger.error(f"Error tailing file {tail.path}: {e}")
+        finally:
+            for tail in tails.values():
+                if tail.fd is not None:
+                    os.close(tail.fd)
+            inotify.close()
+    
+    def _open_tail(self, tail, initial=False):
+        """Open a tailed file; new files are read from the start, the initial open from the end or backlog"""
+        offset = 0
+        if initial:
+            offset = None
+            if self.config.get('catch_up', False):
+                offset = self._catch_up_file(tail.path, tail.source_name)
+        
+        tail.fd = os.open(tail.path, os.O_RDONLY | os.O_NONBLOCK)
+        tail.buf = bytearray()
+        if offset is None:
+            os.lseek(tail.fd, 0, os.SEEK_END)
+        else:
+            os.lseek(tail.fd, offset, os.SEEK_SET)
+    
+    def _update_tail(self, tail, rotated):
+        """Read new data from a tailed file after an inotify event"""
+        if tail.fd is None:
+            # File showed up after we started
+            self._open_tail(tail)
+            tail.buf = self._drain_file(tail.fd, tail.buf, tail.source_name)
+            return
+        
+        # Drain whatever is left in the current file (also the tail of a rotated file)
+        tail.buf = self._drain_file(tail.fd, tail.buf, tail.source_name)
+        
+        if rotated:
+            os.close(tail.fd)
+            tail.fd = None
+            self._open_tail(tail)
+            tail.buf = self._drain_file(tail.fd, tail.buf, tail.source_name)
+        elif os.fstat(tail.fd).st_size < os.lseek(tail.fd, 0, os.SEEK_CUR):
+            # File was truncated in place (copytruncate)
+            os.lseek(tail.fd, 0, os.SEEK_SET)
+            tail.buf = self._drain_file(tail.fd, bytearray(), tail.source_name)
+    
+    def _drain_file(self, fd, buf, source_name):
+        """Read everything available from fd and queue complete lines, returning the partial tail"""
+        while True:
+            try:
+                chunk = os.read(fd, TAIL_READ_SIZE)
+            except BlockingIOError:
+                break
+            buf += chunk
+            # A short read on a regular file means EOF, so skip the extra empty read
+            if len(chunk) < TAIL_READ_SIZE:
+                break
+        
+        *lines, remainder = buf.split(b'\n')
+        for line in lines:
+            line = line.strip()
+            if line:
+                self._queue_event(source_name, line.decode('utf-8', errors='ignore'))
+        
+        return bytearray(remainder)
+    
+    def _tail_file_poll(self, file_path, source_name, offset=None):
+        """Tail a log file by polling, used when inotify is unavailable"""
+        with open(file_path, 'r') as f:
+            if offset is None:
+                # Seek to end of file
+                f.seek(0, 2)
+            else:
+                f.seek(offset)
+            
+            while self.running:
+                line = f.readline()
+                if not line:
+                    time.sleep(0.1)
+                    continue
+                
+                line = line.strip()
+                if line:
+                    self._queue_event(source_name, line)
+    
+    def _listen_syslog(self, sources):
+        """Listen for syslog messages on all configured UDP ports from one thread"""
+        selector = selectors.DefaultSelector()
+        sockets = []
+        
+        try:
+            for source in sources:
+                sock = self._bind_syslog_socket(source['port'], source['name'])
+                if sock is None:
+                    continue
+                sockets.append(sock)
+                receiver = BatchedUDPReceiver(sock) if RECVMMSG_AVAILABLE else None
+                selector.register(sock, selectors.EVENT_READ, (source['name'], receiver))
+            
+            while self.running and sockets:
+                # Level-triggered: a socket with datagrams left over fires again,
+                # so each wakeup reads one batch per socket and busy ports can't starve quiet ones
+                for key, _ in selector.select(timeout=1.0):
+                    source_name, receiver = key.data
+                    try:
+                        if receiver:
+                            self._recv_syslog_batched(receiver, source_name)
+                        else:
+                            self._recv_syslog_single(key.fileobj, source_name)
+                    except Exception as e:
+                        logger.error(f"Error receiving syslog message: {e}")
+        finally:
+            selector.close()
+            for sock in sockets:
+                try:
+                    sock.close()
+                except:
+                    pass
+    
+    def _bind_syslog_socket(self, port, source_name):
+        """Create a non-blocking UDP socket for a syslog source, or None on failure"""
         logger.info(f"Starting syslog listener on port {port} (source: {source_name})")
         
+        sock = None
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Larger receive buffer absorbs bursts while the thread is busy
+            sock.setsockopt(
+                socket.SOL_SOCKET,
+                socket.SO_RCVBUF,
+                self.config.get('syslog_rcvbuf', 8 * 1024 * 1024)
+            )
             sock.bind(('0.0.0.0', port))
-            sock.settimeout(1.0)
-            
-            while self.running:
-                try:
-                    data, addr = sock.recvfrom(65535)
-                    message = data.decode('utf-8', errors='ignore').strip()
-                    if message:
-                        self._queue_event(source_name, message, {'remote_addr': addr[0]})
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    logger.error(f"Error receiving syslog message: {e}")
-                    
+            sock.setblocking(False)
+            return sock
         except Exception as e:
             logger.error(f"Error starting syslog listener on port {port}: {e}")
-        finally:
-            try:
+            if sock:
                 sock.close()
-            except:
-                pass
+            return None
+    
+    def _recv_syslog_batched(self, receiver, source_name):
+        """Receive one recvmmsg batch of syslog datagrams"""
+        for data, remote_ip in receiver.recv():
+            message = data.decode('utf-8', errors='ignore').strip()
+            if message:
+                self._queue_event(source_name, message, {'remote_addr': remote_ip})
+    
+    def _recv_syslog_single(self, sock, source_name):
+        """Receive syslog datagrams one recvfrom at a time, used when recvmmsg is unavailable"""
+        for _ in range(SYSLOG_BATCH_SIZE):
+            try:
+                data, addr = sock.recvfrom(65535)
+            except BlockingIOError:
+                break
+            message = data.decode('utf-8', errors='ignore').strip()
+            if message:
+                self._queue_event(source_name, message, {'remote_addr': addr[0]})
     
     def _read_journal(self):
         """Read systemd journal logs"""
         logger.info("Starting systemd journal reader")
         
+        if SYSTEMD_JOURNAL_AVAILABLE:
+            self._read_journal_native()
+        else:
+            logger.warning("systemd-python not available, falling back to journalctl subprocess")
+            self._read_journal_subprocess()
+    
+    def _read_journal_native(self):
+        """Read journal records directly through sd-journal, blocking on sd_journal_wait"""
+        try:
+            reader = journal.Reader()
+            
+            # Add filters if specified (matches on the same field are OR'ed)
+            journal_config = self.config.get('systemd_journal', {})
+            for unit in journal_config.get('units') or []:
+                reader.add_match(_SYSTEMD_UNIT=unit)
+            
+            # Only follow new entries
+            reader.seek_tail()
+            reader.get_previous()
+            
+            while self.running:
+                if reader.wait(1.0) == journal.NOP:
+                    continue
+                
+                for entry in reader:
+                    message = entry.get('MESSAGE', '')
+                    if message:
+                        metadata = {
+                            'unit': entry.get('_SYSTEMD_UNIT', ''),
+                            'pid': entry.get('_PID', ''),
+                            'priority': entry.get('PRIORITY', '')
+                        }
+                        self._queue_event('systemd-journal', message, metadata)
+            
+            reader.close()
+            
+        except Exception as e:
+            logger.error(f"Error reading journal: {e}")
+    
+    def _read_journal_subprocess(self):
+        """Follow the journal through journalctl, used when systemd-python is unavailable"""
         try:
-            # Use journalctl to follow the journal
-            cmd = ['journalctl', '-f', '--output=json', '--no-pager']
+            # Use journalctl to follow the journal in export format, which
+            # needs no JSON unescaping and is split with plain byte searches
+            cmd = ['journalctl', '-f', '--output=export', '--no-pager']
             
             # Add filters if specified
             journal_config = self.config.get('systemd_journal', {})
@@ -217,29 +893,35 @@ class SIEMAgent:
                 cmd,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                universal_newlines=True,
-                bufsize=1
+                bufsize=0
             )
+            stdout_fd = process.stdout.fileno()
+            buf = bytearray()
             
             while self.running and process.poll() is None:
                 try:
                     # Use select to check if data is available
-                    ready, _, _ = select.select([process.stdout], [], [], 1.0)
-                    if ready:
-                        line = process.stdout.readline()
-                        if line:
-                            try:
-                                journal_entry = json.loads(line.strip())
-                                message = journal_entry.get('MESSAGE', '')
-                                if message:
-                                    metadata = {
-                                        'unit': journal_entry.get('_SYSTEMD_UNIT', ''),
-                                        'pid': journal_entry.get('_PID', ''),
-                                        'priority': journal_entry.get('PRIORITY', '')
-                                    }
-                                    self._queue_event('systemd-journal', message, metadata)
-                            except json.JSONDecodeError:
-                                continue
+                    ready, _, _ = select.select([stdout_fd], [], [], 1.0)
+                    if not ready:
+                        continue
+                    
+                    chunk = os.read(stdout_fd, 65536)
+                    if not chunk:
+                        break
+                    buf += chunk
+                    
+                    entries, consumed = parse_journal_export(buf)
+                    del buf[:consumed]
+                    
+                    for journal_entry in entries:
+                        message = journal_entry.get('MESSAGE', '')
+                        if message:
+                            metadata = {
+                                'unit': journal_entry.get('_SYSTEMD_UNIT', ''),
+                                'pid': journal_entry.get('_PID', ''),
+                                'priority': journal_entry.get('PRIORITY', '')
+                            }
+                            self._queue_event('systemd-journal', message, metadata)
                 except Exception as e:
                     logger.error(f"Error reading journal: {e}")
                     break
@@ -249,103 +931,143 @@ class SIEMAgent:
         except Exception as e:
             logger.error(f"Error starting journal reader: {e}")
     
+    def _timestamp(self):
+        """Return the current UTC time as ISO-8601, formatting the seconds part once per second"""
+        now = time.time()
+        second = int(now)
+        clock = self._clock_local
+        if getattr(clock, 'second', None) != second:
+            clock.second = second
+            clock.prefix = datetime.fromtimestamp(second, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+        return f"{clock.prefix}.{int((now - second) * 1000):03d}Z"
+    
     def _queue_event(self, source, raw_data, metadata=None):
         """Queue an event for sending to SIEM"""
-        event = {
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'host': self.hostname,
-            'source': source,
-            'raw': raw_data,
-            'agent_info': {
-                'version': '1.0.0',
-                'agent_id': self.hostname
-            }
-        }
-        
+        # Events without metadata share the constant agent_info dict
+        agent_info = self._agent_info
         if metadata:
-            event['agent_info'].update(metadata)
+            agent_info = {**agent_info, **metadata}
         
-        try:
-            self.event_queue.put(event, timeout=1)
-            self.stats['events_collected'] += 1
-        except:
-            logger.warning("Event queue is full, dropping event")
+        event = Event(self._timestamp(), self.hostname, source, raw_data, agent_info)
+        
+        if self.event_queue.put(event):
+            self.events_collected.add()
+        else:
+            # Reported in aggregate by the stats reporter and metrics
+            self.events_dropped.add()
     
     def _event_sender(self):
         """Send events to SIEM platform"""
         logger.info("Starting event sender thread")
         
-        session = requests.Session()
-        session.headers.update({
-            'Content-Type': 'application/json',
-            'Authorization': f"Bearer {self.config['api_token']}"
-        })
-        
-        batch_size = self.config.get('batch_size', 10)
+        min_batch = self.config.get('min_batch', self.config.get('batch_size', 10))
+        max_batch = self.config.get('max_batch', 500)
+        high_watermark = int(self.event_queue.maxsize * self.config.get('high_watermark', 0.75))
         batch_timeout = self.config.get('batch_timeout', 5)
         
         events_batch = []
-        last_send = time.time()
+        batch_started = None
         
         while self.running or not self.event_queue.empty():
             try:
-                # Get event with timeout
-                event = self.event_queue.get(timeout=1)
-                events_batch.append(event)
+                # Grow the batch with the backlog so bursts ship in fewer, larger requests
+                backlog = self.event_queue.qsize()
+                target = min(max_batch, max(min_batch, len(events_batch) + backlog))
                 
-                # Send batch if size or timeout reached
-                current_time = time.time()
-                if (len(events_batch) >= batch_size or 
-                    current_time - last_send >= batch_timeout):
-                    
-                    self._send_batch(session, events_batch)
+                # Take as many events as fit in the batch under one lock
+                events_batch.extend(self.event_queue.drain(target - len(events_batch)))
+                
+                if len(events_batch) >= target or (events_batch and backlog >= high_watermark):
+                    # Batch full or queue under pressure - send without waiting
+                    self._submit_batch(events_batch)
                     events_batch = []
-                    last_send = current_time
-                    
-            except Empty:
-                # Timeout - send any pending events
-                if events_batch:
-                    self._send_batch(session, events_batch)
+                    batch_started = None
+                    continue
+                
+                if not events_batch:
+                    self.event_queue.wait(timeout=1)
+                    continue
+                
+                # Partial batch - only wait out what is left of batch_timeout
+                if batch_started is None:
+                    batch_started = time.time()
+                remaining = batch_timeout - (time.time() - batch_started)
+                if remaining <= 0:
+                    self._submit_batch(events_batch)
                     events_batch = []
-                    last_send = time.time()
-                continue
+                    batch_started = None
+                    continue
+                
+                self.event_queue.wait(timeout=min(remaining, 1))
+                    
             except Exception as e:
                 logger.error(f"Error in event sender: {e}")
                 time.sleep(1)
         
         # Send any remaining events
         if events_batch:
-            self._send_batch(session, events_batch)
+            self._submit_batch(events_batch)
+        
+        self._sender_pool.shutdown(wait=True)
     
-    def _send_batch(self, session, events):
+    def _submit_batch(self, events):
+        """Hand a batch to the sender pool, blocking while too many are in flight"""
+        self._in_flight.acquire()
+        try:
+            future = self._sender_pool.submit(self._send_batch, events)
+        except RuntimeError:
+            # Pool already shut down
+            self._in_flight.release()
+            raise
+        future.add_done_callback(lambda _: self._in_flight.release())
+    
+    def _create_session(self, pool_maxsize=4):
+        """Create an HTTP session with keep-alive pooling and retries"""
+        connection_config = self.config.get('connection') or {}
+        
+        session = requests.Session()
+        session.headers.update(self._session_headers)
+        
+        retry = Retry(
+            total=connection_config.get('retry_attempts', 3),
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset(['POST'])
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        
+        return session
+    
+    def _post_events(self, url, payload):
+        """POST a JSON payload, gzip-compressed unless disabled in config"""
+        body = dumps_json(payload)
+        if self._compress:
+            body = gzip.compress(body, compresslevel=1)
+        return self._session.post(url, data=body, timeout=self._request_timeout)
+    
+    def _send_batch(self, events):
         """Send a batch of events to SIEM"""
         try:
             if len(events) == 1:
                 # Send single event
-                response = session.post(
-                    self.config['siem_endpoint'],
-                    json=events[0],
-                    timeout=10
-                )
+                response = self._post_events(self.config['siem_endpoint'], events[0])
             else:
                 # Send batch (if batch endpoint exists)
                 batch_endpoint = self.config.get('batch_endpoint', 
                                                 self.config['siem_endpoint'] + '/batch')
-                response = session.post(
-                    batch_endpoint,
-                    json={'events': events},
-                    timeout=10
-                )
+                response = self._post_events(batch_endpoint, {'events': events})
             
-            if response.status_code in [200, 201]:
-                self.stats['events_sent'] += len(events)
+            if response.status_code in [200, 201, 202]:
+                self.events_sent.add(len(events))
                 logger.debug(f"Successfully sent {len(events)} events")
             else:
-                self.stats['events_failed'] += len(events)
+                self.events_failed.add(len(events))
                 logger.error(f"Failed to send events: HTTP {response.status_code} - {response.text}")
                 
         except Exception as e:
-            self.stats['events_failed'] += len(events)
+            self.events_failed.add(len(events))
             logger.error(f"Error sending events to SIEM: {e}")
     
     def _flush_event_queue(self):
@@ -354,36 +1076,23 @@ class SIEMAgent:
             return
         
         logger.info("Flushing remaining events...")
-        session = requests.Session()
-        session.headers.update({
-            'Content-Type': 'application/json',
-            'Authorization': f"Bearer {self.config['api_token']}"
-        })
-        
-        events = []
         while not self.event_queue.empty():
-            try:
-                events.append(self.event_queue.get_nowait())
-                if len(events) >= 50:  # Send in chunks
-                    self._send_batch(session, events)
-                    events = []
-            except Empty:
-                break
-        
-        if events:
-            self._send_batch(session, events)
+            events = list(self.event_queue.drain(50))  # Send in chunks
+            if events:
+                self._send_batch(events)
     
     def _stats_reporter(self):
         """Report statistics periodically"""
         while self.running:
             time.sleep(60)  # Report every minute
             
-            uptime = datetime.now(timezone.utc) - self.stats['start_time']
+            uptime = datetime.now(timezone.utc) - self.start_time
             logger.info(
                 f"Agent Stats - Uptime: {uptime}, "
-                f"Collected: {self.stats['events_collected']}, "
-                f"Sent: {self.stats['events_sent']}, "
-                f"Failed: {self.stats['events_failed']}, "
+                f"Collected: {self.events_collected.value}, "
+                f"Sent: {self.events_sent.value}, "
+                f"Failed: {self.events_failed.value}, "
+                f"Dropped: {self.events_dropped.value}, "
                 f"Queue Size: {self.event_queue.qsize()}"
             )
 
@@ -4,40 +4,107 @@ Handles parsing, enrichment, alerting, and other background processing
 """
 
 import os
+import gzip
 import json
+import time
 import logging
-from datetime import datetime, timezone
+import threading
+from datetime import datetime, timezone, timedelta
 
 from celery import Celery, Task
+from celery.exceptions import Reject
+from celery.schedules import crontab
+from celery.signals import worker_process_init, task_postrun
+from flask import has_app_context
+import psutil
+from sqlalchemy import text, insert
+from sqlalchemy.exc import OperationalError
 from app import create_app, db
+from config import SETTINGS
 from models import EventsRaw, EventsEnriched, AlertRule, AlertEvent
-from services.parser import EventParser
-from services.enrichment import EnrichmentService
+from services.parser import get_event_parser
+from services.enrichment import get_enrichment_service
 from services.alert_engine import AlertEngine
-from services.rabbitmq_client import RabbitMQClient
+from services.ingestion import IngestionService
+from services.rabbitmq_client import RabbitMQClient, RAW_QUEUES
+from init_db import create_partitions
+from utils.json_utils import loads
+from utils.geoip import get_geoip_instance
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING').upper())
 logger = logging.getLogger(__name__)
 
 # Create Flask app context
 flask_app = create_app()
 
+# Prime the CPU counters so health checks can sample without blocking
+psutil.cpu_percent(interval=None)
+
+# Rows removed per transaction by the retention cleanup
+CLEANUP_BATCH_SIZE = int(os.environ.get('CLEANUP_BATCH_SIZE', '10000'))
+
+# Row-level deletes allowed per cleanup run across all tables
+CLEANUP_MAX_ROWS_PER_RUN = int(os.environ.get('CLEANUP_MAX_ROWS_PER_RUN', '50000'))
+
+# Errors worth retrying; anything else is treated as bad event data
+TRANSIENT_ERRORS = (OperationalError, ConnectionError, TimeoutError)
+
+# Redis key holding the events_raw insert counter seen by the last health check
+HEALTH_INSERTS_KEY = 'siem:health:events_raw_inserts'
+
+# Redis key holding the overall status recorded by the last health check
+HEALTH_STATUS_KEY = 'siem:health:last_status'
+
+# RabbitMQ deliveries buffered before dispatching them to Celery, the
+# longest a partial buffer waits, and raw events handled per parse task
+DISPATCH_BATCH_SIZE = int(os.environ.get('DISPATCH_BATCH_SIZE', '500'))
+DISPATCH_FLUSH_INTERVAL = 0.2
+PARSE_CHUNK_SIZE = 50
+
+# Seconds to wait before redelivering a batch that could not be dispatched,
+# and before reconnecting a raw queue consumer that failed
+DISPATCH_RETRY_DELAY = 5
+
+# Rows fetched per round trip when exporting a partition to an archive file
+ARCHIVE_BATCH_SIZE = 10000
+
 # Configure Celery
 celery = Celery(__name__)
 celery.conf.update(
     broker_url=os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0'),
     result_backend=os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0'),
-    task_serializer='json',
-    accept_content=['json'],
-    result_serializer='json',
+    task_serializer='msgpack',
+    accept_content=['msgpack', 'json'],
+    result_serializer='msgpack',
     timezone='UTC',
     enable_utc=True,
+    # Ack after completion and hand out one task at a time so a slow or
+    # crashed worker neither stalls nor loses a prefetched batch
+    worker_prefetch_multiplier=1,
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    worker_max_tasks_per_child=1000,
+    broker_transport_options={'visibility_timeout': 3600},
+    task_compression='gzip',
     task_routes={
-        'parse_raw_event': {'queue': 'parsing'},
-        'enrich_event': {'queue': 'enrichment'},
+        'parse_and_enrich': {'queue': 'parsing'},
+        'parse_and_enrich_events': {'queue': 'parsing'},
         'evaluate_alert_rules': {'queue': 'alerting'},
+        'flush_alert_emails': {'queue': 'alerting'},
         'cleanup_old_events': {'queue': 'maintenance'},
+        'ensure_future_partitions': {'queue': 'maintenance'},
+        'archive_cold_partitions': {'queue': 'maintenance'},
+        'refresh_ingestion_stats': {'queue': 'maintenance'},
+        'republish_raw_events': {'queue': 'maintenance'},
+        'refresh_dashboard_stats': {'queue': 'maintenance'},
         'cleanup_expired_sessions': {'queue': 'maintenance'},
         'log_active_sessions': {'queue': 'maintenance'}
     }
@@ -52,12 +119,36 @@ celery.conf.beat_schedule = {
         'task': 'evaluate_alert_rules',
         'schedule': 60.0,  # Every minute
     },
+    'flush-alert-emails': {
+        'task': 'flush_alert_emails',
+        'schedule': 30.0,  # Every 30 seconds
+    },
     'system-health-check': {
         'task': 'system_health_check',
         'schedule': 300.0,  # Every 5 minutes
     },
     'cleanup-old-events': {
         'task': 'cleanup_old_events',
+        'schedule': 300.0,  # Every 5 minutes, bounded by CLEANUP_MAX_ROWS_PER_RUN
+    },
+    'ensure-future-partitions': {
+        'task': 'ensure_future_partitions',
+        'schedule': crontab(hour=1, minute=0),  # Daily at 1 AM
+    },
+    'republish-raw-events': {
+        'task': 'republish_raw_events',
+        'schedule': 60.0,  # Every minute
+    },
+    'refresh-ingestion-stats': {
+        'task': 'refresh_ingestion_stats',
+        'schedule': 30.0,  # Every 30 seconds
+    },
+    'refresh-dashboard-stats': {
+        'task': 'refresh_dashboard_stats',
+        'schedule': 60.0,  # Every minute
+    },
+    'archive-cold-partitions': {
+        'task': 'archive_cold_partitions',
         'schedule': crontab(hour=2, minute=0),  # Daily at 2 AM
     },
     'cleanup-expired-sessions': {
@@ -75,61 +166,149 @@ celery.conf.beat_schedule = {
 class ContextTask(Task):
     """
     Custom Celery task that provides Flask application context
+    
+    Worker processes keep one application context pushed for their whole
+    lifetime, so tasks only enter a fresh one when none is active (solo
+    pool, eager execution).
     """
     def __call__(self, *args, **kwargs):
+        if has_app_context():
+            return self.run(*args, **kwargs)
         with flask_app.app_context():
             return self.run(*args, **kwargs)
 
+@worker_process_init.connect
+def _push_app_context(**kwargs):
+    """
+    Push a long-lived application context in each worker process, and open
+    the GeoIP database in the background so the first task doesn't wait on it
+    """
+    flask_app.app_context().push()
+    threading.Thread(target=get_geoip_instance, name='geoip-preload', daemon=True).start()
+
+@task_postrun.connect
+def _remove_db_session(**kwargs):
+    """
+    Release the task's database session, as the app context teardown would
+    """
+    if has_app_context():
+        db.session.remove()
+
 celery.Task = ContextTask
 
-@celery.task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 60})
-def parse_raw_event(self, raw_event_data):
+# Per-thread service instances, reused across tasks in the same worker
+_worker_local = threading.local()
+
+def _get_rabbitmq_client():
+    """
+    Get the worker's RabbitMQClient, creating it on first use
+    """
+    rabbitmq = getattr(_worker_local, 'rabbitmq', None)
+    if rabbitmq is None:
+        rabbitmq = _worker_local.rabbitmq = RabbitMQClient()
+    return rabbitmq
+
+def parse_raw_event(parser, raw_event_data):
     """
     Parse a raw event and create normalized event
     
     Args:
+        parser: EventParser instance
         raw_event_data: Dictionary containing raw event information
     """
-    try:
-        logger.info(f"Parsing raw event: {raw_event_data.get('raw_id')}")
-        
-        parser = EventParser()
-        parsed_event = parser.parse_message(raw_event_data)
-        normalized_event = parser.normalize_fields(parsed_event)
-        
-        # Add source information
-        normalized_event['source'] = raw_event_data.get('source')
-        normalized_event['host'] = raw_event_data.get('host')
-        
-        # Trigger enrichment
-        enrich_event.delay(raw_event_data.get('raw_id'), normalized_event)
-        
-        logger.info(f"Successfully parsed event {raw_event_data.get('raw_id')}")
-        
-    except Exception as e:
-        logger.error(f"Error parsing event {raw_event_data.get('raw_id')}: {e}")
-        raise
+    normalized_event = parser.parse_message(raw_event_data)
+    
+    # Add source information
+    normalized_event['source'] = raw_event_data.get('source')
+    normalized_event['host'] = raw_event_data.get('host')
+    
+    return normalized_event
 
-@celery.task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 60})
-def enrich_event(self, raw_id, parsed_event):
+def enrich_event(enrichment_service, raw_id, parsed_event):
     """
     Enrich a parsed event with additional context
     
     Args:
+        enrichment_service: EnrichmentService instance
         raw_id: ID of the raw event
         parsed_event: Parsed event data
     """
+    return enrichment_service.enrich_event(raw_id, parsed_event)
+
+@celery.task(bind=True, autoretry_for=TRANSIENT_ERRORS, retry_backoff=True, retry_backoff_max=600,
+             retry_jitter=True, retry_kwargs={'max_retries': 5})
+def parse_and_enrich(self, raw_event_data):
+    """
+    Parse, normalize and enrich a raw event in a single task
+    
+    Args:
+        raw_event_data: Dictionary containing raw event information
+    """
+    raw_id = raw_event_data.get('raw_id')
+    
     try:
-        logger.info(f"Enriching event: {raw_id}")
+        logger.debug("Processing raw event: %s", raw_id)
         
-        enrichment_service = EnrichmentService()
-        enriched_event = enrichment_service.enrich_event(raw_id, parsed_event)
+        normalized_event = parse_raw_event(get_event_parser(), raw_event_data)
+        enriched_event = enrich_event(get_enrichment_service(), raw_id, normalized_event)
         
-        logger.info(f"Successfully enriched event {enriched_event.id}")
+        logger.debug("Successfully enriched event %s", enriched_event.id)
         
-    except Exception as e:
-        logger.error(f"Error enriching event {raw_id}: {e}")
+    except TRANSIENT_ERRORS as e:
+        logger.warning("Transient error processing event %s: %s", raw_id, e)
         raise
+    except Exception as e:
+        # Bad data fails the same way every time, so reject without requeueing
+        logger.error("Error processing event %s: %s", raw_id, e)
+        raise Reject(e, requeue=False)
+
+@celery.task(bind=True)
+def parse_and_enrich_events(self, raw_events):
+    """
+    Parse and enrich a chunk of raw events in a single task
+    
+    The chunk is enriched and stored as one batch. If that hits a transient
+    error its events are re-dispatched individually through parse_and_enrich
+    so they keep its retry behaviour; any other error falls back to enriching
+    one event at a time so only events with bad data are dropped.
+    
+    Args:
+        raw_events: List of raw event dictionaries
+    """
+    parser = get_event_parser()
+    enrichment_service = get_enrichment_service()
+    failed = 0
+    
+    # Parse the whole chunk at once; failures come back as parse_error events
+    parsed = []
+    for raw_event_data, normalized_event in zip(raw_events, parser.parse_messages(raw_events)):
+        normalized_event['source'] = raw_event_data.get('source')
+        normalized_event['host'] = raw_event_data.get('host')
+        parsed.append((raw_event_data, normalized_event))
+    
+    try:
+        enrichment_service.enrich_events([(data.get('raw_id'), event) for data, event in parsed])
+    except TRANSIENT_ERRORS as e:
+        failed += len(parsed)
+        logger.warning("Transient error enriching chunk, re-dispatching %d events: %s", len(parsed), e)
+        for raw_event_data, _ in parsed:
+            parse_and_enrich.delay(raw_event_data)
+    except Exception as e:
+        # Isolate the bad event(s) by retrying the chunk one event at a time
+        logger.warning("Error enriching chunk, falling back to single events: %s", e)
+        for raw_event_data, normalized_event in parsed:
+            raw_id = raw_event_data.get('raw_id')
+            try:
+                enrich_event(enrichment_service, raw_id, normalized_event)
+            except TRANSIENT_ERRORS as e:
+                failed += 1
+                logger.warning("Transient error processing event %s: %s", raw_id, e)
+                parse_and_enrich.delay(raw_event_data)
+            except Exception as e:
+                failed += 1
+                logger.error("Error processing event %s: %s", raw_id, e)
+    
+    logger.debug("Processed %d/%d events", len(raw_events) - failed, len(raw_events))
 
 @celery.task
 def evaluate_alert_rules():
@@ -148,6 +327,189 @@ def evaluate_alert_rules():
         logger.error(f"Error evaluating alert rules: {e}")
         raise
 
+@celery.task
+def flush_alert_emails():
+    """
+    Send queued alert notifications as one digest per recipient list
+    """
+    try:
+        sent = AlertEngine().flush_alert_emails()
+        if sent:
+            logger.info(f"Sent alert emails for {sent} alerts")
+        
+    except Exception as e:
+        logger.error(f"Error sending alert emails: {e}")
+        raise
+
+def _delete_in_batches(table, column, cutoff, batch_size=None, max_rows=None):
+    """
+    Delete rows older than cutoff in short transactions of at most batch_size rows
+    
+    Args:
+        table: Table to delete from
+        column: Timestamp column compared against cutoff
+        cutoff: Rows with column < cutoff are deleted
+        batch_size: Rows per transaction (defaults to CLEANUP_BATCH_SIZE)
+        max_rows: Stop once this many rows were deleted (None for no limit)
+        
+    Returns:
+        Total number of rows deleted
+    """
+    batch_size = batch_size or CLEANUP_BATCH_SIZE
+    total_deleted = 0
+    
+    # ctid is only unique per partition, so the outer filter repeats the cutoff
+    delete_sql = text(f"""
+        DELETE FROM {table}
+        WHERE {column} < :cutoff
+        AND ctid = ANY(ARRAY(
+            SELECT ctid FROM {table}
+            WHERE {column} < :cutoff
+            ORDER BY {column}
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        ))
+    """)
+    
+    while max_rows is None or total_deleted < max_rows:
+        limit = batch_size if max_rows is None else min(batch_size, max_rows - total_deleted)
+        result = db.session.execute(delete_sql, {'cutoff': cutoff, 'batch_size': limit})
+        db.session.commit()
+        total_deleted += result.rowcount
+        
+        if result.rowcount < limit:
+            break
+        
+        # Yield to ingestion between batches
+        time.sleep(0.05)
+    
+    return total_deleted
+
+def _expired_partitions(parent_table, cutoff):
+    """
+    Names of daily partitions (<parent>_YYYYMMDD) that end before cutoff
+    """
+    partitions = db.session.execute(text("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:parent_table)
+    """), {'parent_table': parent_table}).scalars().all()
+    db.session.commit()
+    
+    prefix = f"{parent_table}_"
+    expired = []
+    for partition in partitions:
+        if not partition.startswith(prefix):
+            continue
+        try:
+            day = datetime.strptime(partition[len(prefix):], '%Y%m%d').date()
+        except ValueError:
+            continue
+        
+        # A daily partition covers [day, day + 1)
+        if day + timedelta(days=1) <= cutoff.date():
+            expired.append(partition)
+    
+    return sorted(expired)
+
+def _drop_partition(conn, parent_table, partition):
+    # Postgres refuses DETACH ... CONCURRENTLY while the parent has a default
+    # partition, as databases set up by earlier versions may until
+    # create_partitions next runs; those take the plain, locking DETACH
+    has_default = conn.execute(text("""
+        SELECT partdefid <> 0 FROM pg_partitioned_table
+        WHERE partrelid = to_regclass(:parent_table)
+    """), {'parent_table': parent_table}).scalar()
+    
+    # DETACH ... CONCURRENTLY cannot run inside a transaction block
+    concurrently = '' if has_default else ' CONCURRENTLY'
+    conn.execute(text(f"ALTER TABLE {parent_table} DETACH PARTITION {partition}{concurrently}"))
+    conn.execute(text(f"DROP TABLE {partition}"))
+
+def _drop_expired_partitions(parent_table, cutoff):
+    """
+    Detach and drop daily partitions (<parent>_YYYYMMDD) that end before cutoff
+    
+    Args:
+        parent_table: Partitioned table name
+        cutoff: Partitions whose whole day range is before cutoff are dropped
+        
+    Returns:
+        List of dropped partition names
+    """
+    dropped = []
+    
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for partition in _expired_partitions(parent_table, cutoff):
+            _drop_partition(conn, parent_table, partition)
+            dropped.append(partition)
+    
+    return dropped
+
+def _write_parquet_archive(conn, partition, path):
+    """
+    Stream a raw event partition into a zstd-compressed Parquet file
+    
+    Timestamps are stored as microsecond columns (delta encoded by Parquet)
+    and source/host are dictionary encoded since they repeat heavily.
+    """
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('received_at', pa.timestamp('us', tz='UTC')),
+        ('source', pa.string()),
+        ('host', pa.string()),
+        ('payload', pa.string()),
+    ])
+    result = conn.execution_options(stream_results=True, yield_per=ARCHIVE_BATCH_SIZE).execute(
+        text(f"SELECT id, received_at, source, host, payload::text FROM {partition} ORDER BY received_at")
+    )
+    
+    with pq.ParquetWriter(path, schema, compression='zstd',
+                          use_dictionary=['source', 'host']) as writer:
+        for rows in result.partitions():
+            writer.write_table(pa.Table.from_pylist([row._asdict() for row in rows], schema=schema))
+
+def _write_csv_archive(conn, partition, path):
+    """
+    Stream a raw event partition into a gzipped CSV file with COPY
+    """
+    cursor = conn.connection.cursor()
+    try:
+        with gzip.open(path, 'wb') as f:
+            cursor.copy_expert(
+                f"COPY (SELECT id, received_at, source, host, payload FROM {partition} "
+                "ORDER BY received_at) TO STDOUT WITH (FORMAT csv, HEADER)",
+                f
+            )
+    finally:
+        cursor.close()
+
+def _archive_partition(conn, partition):
+    """
+    Export a partition to ARCHIVE_DIR, returning the archive file path
+    """
+    os.makedirs(SETTINGS.ARCHIVE_DIR, exist_ok=True)
+    if PYARROW_AVAILABLE:
+        path = os.path.join(SETTINGS.ARCHIVE_DIR, f"{partition}.parquet")
+        write = _write_parquet_archive
+    else:
+        path = os.path.join(SETTINGS.ARCHIVE_DIR, f"{partition}.csv.gz")
+        write = _write_csv_archive
+    
+    # Only publish complete files so a failed run never leaves a partial
+    # archive behind for a partition that still exists
+    tmp_path = f"{path}.tmp"
+    try:
+        write(conn, partition, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    return path
+
 @celery.task
 def cleanup_old_events():
     """
@@ -156,63 +518,33 @@ def cleanup_old_events():
     try:
         logger.info("Starting event cleanup")
         
-        # Get retention settings
-        days_to_keep_hot = int(os.environ.get('DAYS_TO_KEEP_HOT', '7'))
-        days_to_keep_archive = int(os.environ.get('DAYS_TO_KEEP_ARCHIVE', '365'))
+        # Delete very old events
+        delete_cutoff = datetime.now(timezone.utc) - timedelta(days=SETTINGS.DAYS_TO_KEEP_ARCHIVE)
         
-        from sqlalchemy import text
-        from datetime import timedelta
+        # Drop whole expired daily partitions; enriched first since it references raw
+        for parent_table in ('events_enriched', 'events_raw'):
+            dropped = _drop_expired_partitions(parent_table, delete_cutoff)
+            if dropped:
+                logger.info(f"Dropped {len(dropped)} expired partitions of {parent_table}")
         
-        # Archive old enriched events (move to archive table or compress)
-        archive_cutoff = datetime.now(timezone.utc) - timedelta(days=days_to_keep_hot)
+        # Delete remaining old rows in bounded batches, sharing one row budget
+        # per run so the load is spread over the day (implement archiving first in production)
+        budget = CLEANUP_MAX_ROWS_PER_RUN
+        deleted_events = _delete_in_batches('events_enriched', 'ts', delete_cutoff, max_rows=budget)
+        budget -= deleted_events
+        deleted_raw = _delete_in_batches('events_raw', 'received_at', delete_cutoff, max_rows=budget) if budget > 0 else 0
+        budget -= deleted_raw
         
-        # Delete very old events
-        delete_cutoff = datetime.now(timezone.utc) - timedelta(days=days_to_keep_archive)
-        
-        # Count events to be archived/deleted
-        events_to_archive = db.session.execute(text("""
-            SELECT COUNT(*) FROM events_enriched 
-            WHERE ts < :archive_cutoff AND ts >= :delete_cutoff
-        """), {
-            'archive_cutoff': archive_cutoff,
-            'delete_cutoff': delete_cutoff
-        }).scalar()
-        
-        events_to_delete = db.session.execute(text("""
-            SELECT COUNT(*) FROM events_enriched 
-            WHERE ts < :delete_cutoff
-        """), {'delete_cutoff': delete_cutoff}).scalar()
-        
-        logger.info(f"Events to archive: {events_to_archive}, Events to delete: {events_to_delete}")
-        
-        # Delete old events (implement archiving first in production)
-        if events_to_delete > 0:
-            db.session.execute(text("""
-                DELETE FROM events_enriched WHERE ts < :delete_cutoff
-            """), {'delete_cutoff': delete_cutoff})
-            
-            db.session.execute(text("""
-                DELETE FROM events_raw WHERE received_at < :delete_cutoff
-            """), {'delete_cutoff': delete_cutoff})
-            
-            db.session.commit()
-            
-            logger.info(f"Deleted {events_to_delete} old events")
+        if deleted_events or deleted_raw:
+            logger.info(f"Deleted {deleted_events} old events ({deleted_raw} raw events)")
         
         # Clean up old alert events
         alert_retention_days = 90
         alert_cutoff = datetime.now(timezone.utc) - timedelta(days=alert_retention_days)
         
-        old_alerts = db.session.execute(text("""
-            SELECT COUNT(*) FROM alert_events WHERE triggered_at < :cutoff
-        """), {'cutoff': alert_cutoff}).scalar()
+        old_alerts = _delete_in_batches('alert_events', 'triggered_at', alert_cutoff, max_rows=budget) if budget > 0 else 0
         
         if old_alerts > 0:
-            db.session.execute(text("""
-                DELETE FROM alert_events WHERE triggered_at < :cutoff
-            """), {'cutoff': alert_cutoff})
-            db.session.commit()
-            
             logger.info(f"Deleted {old_alerts} old alert events")
         
         logger.info("Event cleanup completed")
@@ -221,6 +553,115 @@ def cleanup_old_events():
         logger.error(f"Error during cleanup: {e}")
         raise
 
+@celery.task
+def ensure_future_partitions():
+    """
+    Create the next 30 days of event partitions ahead of time
+    """
+    try:
+        create_partitions()
+    except Exception as e:
+        logger.error(f"Error creating future partitions: {e}")
+        raise
+
+@celery.task
+def archive_cold_partitions():
+    """
+    Move raw event partitions older than DAYS_TO_KEEP_HOT to archive files
+    
+    Each partition is exported to SETTINGS.ARCHIVE_DIR and then detached and
+    dropped, so events_raw only holds the hot window.
+    """
+    try:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=SETTINGS.DAYS_TO_KEEP_HOT)
+        archived = 0
+        
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            for partition in _expired_partitions('events_raw', cutoff):
+                # Export inside a transaction so rows can stream from a
+                # server-side cursor
+                with db.engine.connect() as export_conn:
+                    path = _archive_partition(export_conn, partition)
+                _drop_partition(conn, 'events_raw', partition)
+                archived += 1
+                logger.info(f"Archived {partition} to {path}")
+        
+        if archived:
+            logger.info(f"Archived {archived} events_raw partitions")
+        
+    except Exception as e:
+        logger.error(f"Error archiving cold partitions: {e}")
+        raise
+
+@celery.task
+def republish_raw_events():
+    """
+    Publish stored raw events whose hand-off to RabbitMQ never completed
+    """
+    try:
+        republished = IngestionService().republish_pending(_get_rabbitmq_client())
+        if republished:
+            logger.warning(f"Republished {republished} stored raw events")
+    except Exception as e:
+        logger.error(f"Error republishing raw events: {e}")
+        db.session.rollback()
+        _worker_local.rabbitmq = None
+        raise
+
+@celery.task
+def refresh_ingestion_stats():
+    """
+    Refresh the per-minute ingestion counters behind /api/stats
+    """
+    try:
+        # CONCURRENTLY keeps the view readable while it is rebuilt
+        db.session.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_ingestion_stats"))
+        db.session.commit()
+    except Exception as e:
+        logger.error(f"Error refreshing ingestion stats: {e}")
+        db.session.rollback()
+        raise
+
+@celery.task
+def refresh_dashboard_stats():
+    """
+    Refresh the hourly event counts behind the dashboard
+    """
+    try:
+        db.session.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_events_hourly"))
+        db.session.commit()
+    except Exception as e:
+        logger.error(f"Error refreshing dashboard stats: {e}")
+        db.session.rollback()
+        raise
+
+def _events_raw_inserts_since_last_check():
+    """
+    Rows inserted into events_raw and its partitions since the previous call
+    
+    The cumulative insert counter is kept in Redis so the baseline survives
+    worker restarts.
+    
+    Returns:
+        Number of inserted rows, or None when there is no usable baseline yet
+    """
+    inserts = db.session.execute(text("""
+        SELECT COALESCE(SUM(n_tup_ins), 0) FROM pg_stat_all_tables
+        WHERE relname LIKE 'events\\_raw%'
+    """)).scalar()
+    
+    try:
+        previous = flask_app.session_manager.redis.getset(HEALTH_INSERTS_KEY, int(inserts))
+    except Exception as e:
+        logger.warning(f"Could not read ingestion baseline from Redis: {e}")
+        return None
+    
+    # A lower counter means the statistics were reset
+    if previous is None or int(previous) > inserts:
+        return None
+    
+    return int(inserts) - int(previous)
+
 @celery.task
 def system_health_check():
     """
@@ -230,10 +671,9 @@ def system_health_check():
         logger.info("Performing system health check")
         
         from models import SystemHealth
-        import psutil
         
-        # Check system metrics
-        cpu_percent = psutil.cpu_percent(interval=1)
+        # Check system metrics; non-blocking, averaged since the previous call
+        cpu_percent = psutil.cpu_percent(interval=None)
         memory = psutil.virtual_memory()
         disk = psutil.disk_usage('/')
         
@@ -244,13 +684,14 @@ def system_health_check():
         except Exception:
             db_status = 'critical'
         
-        # Check recent event ingestion
-        recent_events = db.session.execute(text("""
-            SELECT COUNT(*) FROM events_raw 
-            WHERE received_at > NOW() - INTERVAL '5 minutes'
-        """)).scalar()
+        # Check recent event ingestion from the insert counters instead of
+        # scanning the hot partition
+        recent_events = _events_raw_inserts_since_last_check()
         
-        ingestion_status = 'healthy' if recent_events > 0 else 'warning'
+        if recent_events is None:
+            ingestion_status = 'unknown'
+        else:
+            ingestion_status = 'healthy' if recent_events > 0 else 'warning'
         
         # Determine overall status
         if db_status == 'critical' or cpu_percent > 90 or memory.percent > 90:
@@ -260,33 +701,49 @@ def system_health_check():
         else:
             overall_status = 'healthy'
         
-        # Store health data
-        health_record = SystemHealth(
-            component='system',
-            status=overall_status,
-            metrics={
+        health_data = {
+            'component': 'system',
+            'status': overall_status,
+            'metrics': {
                 'cpu_percent': cpu_percent,
                 'memory_percent': memory.percent,
                 'disk_percent': disk.percent,
                 'recent_events': recent_events,
                 'database_status': db_status,
                 'ingestion_status': ingestion_status
-            }
-        )
+            },
+            'timestamp': datetime.now(timezone.utc).isoformat()
+        }
         
-        db.session.add(health_record)
-        db.session.commit()
+        # Store health data in the capped Redis stream; only status changes
+        # (or an unreachable Redis) are recorded in Postgres
+        try:
+            redis_client = flask_app.session_manager.redis
+            redis_client.xadd(
+                flask_app.config['HEALTH_STREAM_KEY'],
+                {'data': json.dumps(health_data)},
+                maxlen=flask_app.config['HEALTH_STREAM_MAXLEN'],
+                approximate=True
+            )
+            last_status = redis_client.getset(HEALTH_STATUS_KEY, overall_status)
+            status_changed = last_status is None or last_status.decode() != overall_status
+        except Exception as e:
+            logger.warning(f"Could not write health data to Redis: {e}")
+            status_changed = True
+        
+        if status_changed:
+            db.session.execute(insert(SystemHealth), [{
+                'component': health_data['component'],
+                'status': overall_status,
+                'metrics': health_data['metrics']
+            }])
+            db.session.commit()
         
         logger.info(f"System health check completed: {overall_status}")
         
         # Send alert if critical
         if overall_status == 'critical':
-            send_health_alert.delay({
-                'status': overall_status,
-                'component': 'system',
-                'metrics': health_record.metrics,
-                'timestamp': health_record.timestamp
-            })
+            send_health_alert.delay(health_data)
         
     except Exception as e:
         logger.error(f"Error during health check: {e}")
@@ -326,26 +783,86 @@ def process_rabbitmq_queue(queue_name):
     try:
         logger.info(f"Processing RabbitMQ queue: {queue_name}")
         
-        rabbitmq = RabbitMQClient()
+        rabbitmq = _get_rabbitmq_client()
+        pending = []
         
-        def callback(ch, method, properties, body):
+        def flush(ch):
+            if not pending:
+                return
+            
+            last_tag = pending[-1][0]
+            messages = [message for _, message in pending]
+            del pending[:]
+            
             try:
-                message = json.loads(body)
-                
-                # Process the message based on queue type
+                # Process the messages based on queue type, publishing every
+                # chunk over one broker connection
                 if 'raw' in queue_name:
-                    parse_raw_event.delay(message)
+                    with celery.producer_or_acquire() as producer:
+                        for i in range(0, len(messages), PARSE_CHUNK_SIZE):
+                            parse_and_enrich_events.apply_async(
+                                (messages[i:i + PARSE_CHUNK_SIZE],),
+                                producer=producer
+                            )
                 
-                # Acknowledge message
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+                # Acknowledge every delivery up to and including the last one
+                ch.basic_ack(delivery_tag=last_tag, multiple=True)
                 
             except Exception as e:
-                logger.error(f"Error processing message from {queue_name}: {e}")
-                # Reject message and requeue for retry
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                logger.error("Error dispatching %d messages from %s: %s", len(messages), queue_name, e)
+                # The Celery broker is unreachable rather than the messages
+                # being bad; back off, then requeue the batch for retry
+                time.sleep(DISPATCH_RETRY_DELAY)
+                ch.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
         
-        rabbitmq.consume_messages(queue_name, callback)
+        def callback(ch, method, properties, body):
+            try:
+                message = loads(body)
+            except Exception as e:
+                # Undecodable bodies fail the same way every time, so park
+                # them on the dead letter queue instead of redelivering
+                logger.error("Dead-lettering undecodable message from %s: %s", queue_name, e)
+                rabbitmq.dead_letter(body)
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+            
+            if not pending:
+                ch.connection.call_later(DISPATCH_FLUSH_INTERVAL, lambda: flush(ch))
+            pending.append((method.delivery_tag, message))
+            
+            if len(pending) >= DISPATCH_BATCH_SIZE:
+                flush(ch)
+        
+        rabbitmq.consume_messages(queue_name, callback, prefetch_count=DISPATCH_BATCH_SIZE)
         
     except Exception as e:
         logger.error(f"Error processing queue {queue_name}: {e}")
         raise
+
+def _consume_raw_queue(queue_name):
+    """
+    Keep dispatching one raw queue, reconnecting after failures
+    """
+    while True:
+        try:
+            process_rabbitmq_queue(queue_name)
+        except Exception as e:
+            logger.error("Consumer for %s stopped, reconnecting: %s", queue_name, e)
+            _worker_local.rabbitmq = None
+        time.sleep(DISPATCH_RETRY_DELAY)
+
+def consume_raw_queues():
+    """
+    Consume every raw queue and hand its events to the parsing workers
+    
+    Runs in its own long-lived process (the consumer service) rather than as
+    a Celery task, which would tie up a worker slot forever.
+    """
+    threads = [
+        threading.Thread(target=_consume_raw_queue, args=(queue_name,), name=f'consume-{queue_name}', daemon=True)
+        for queue_name in RAW_QUEUES
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
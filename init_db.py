@@ -8,13 +8,16 @@ import os
 import sys
 import logging
 from datetime import datetime, timezone, timedelta
-from sqlalchemy import text
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import text, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 # Add the current directory to Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from app import create_app, db
 from models import User, EventsRaw, EventsEnriched, AlertRule, AlertEvent, Dashboard, SystemHealth
+from models import EVENT_PARTITION_DAYS_AHEAD, EVENT_PARTITION_DAYS_BEHIND
 from werkzeug.security import generate_password_hash
 
 # Configure logging
@@ -32,30 +35,77 @@ def create_database_tables():
         logger.error(f"Error creating tables: {e}")
         raise
 
-def create_partitions():
+# Parallel index builds and the per-connection settings used for each build
+INDEX_BUILD_WORKERS = 8
+INDEX_MAINTENANCE_WORK_MEM = os.environ.get('INDEX_MAINTENANCE_WORK_MEM', '1GB')
+INDEX_PARALLEL_WORKERS = 4
+
+# Tables partitioned by day, and the column each is partitioned on
+PARTITIONED_TABLES = {'events_raw': 'received_at', 'events_enriched': 'ts'}
+
+def create_partitions(days=EVENT_PARTITION_DAYS_AHEAD, days_behind=EVENT_PARTITION_DAYS_BEHIND):
     """Create table partitions for better performance"""
     logger.info("Creating table partitions...")
     
-    try:
-        # Create partitions for events_raw table for the next 30 days
-        for i in range(30):
-            date = datetime.now(timezone.utc) + timedelta(days=i)
-            table_name = f"events_raw_{date.strftime('%Y%m%d')}"
-            start_date = date.strftime('%Y-%m-%d')
-            end_date = (date + timedelta(days=1)).strftime('%Y-%m-%d')
+    tables = ", ".join(f"ARRAY['{table}', '{column}']" for table, column in PARTITIONED_TABLES.items())
+    
+    # One server-side loop instead of a round-trip per partition; a failing
+    # partition (e.g. an overlapping range) is reported without aborting the rest.
+    # There is no DEFAULT partition: it would stop DETACH ... CONCURRENTLY and
+    # the creation of any day it held rows for. One left by an earlier version
+    # is detached and its rows moved into daily partitions.
+    partition_sql = f"""
+    DO $$
+    DECLARE
+        entry text[];
+        parent text;
+        legacy text;
+        column_list text;
+        d date;
+    BEGIN
+        FOREACH entry SLICE 1 IN ARRAY ARRAY[{tables}] LOOP
+            parent := entry[1];
+            legacy := parent || '_default';
             
-            partition_sql = f"""
-            CREATE TABLE IF NOT EXISTS {table_name} PARTITION OF events_raw
-            FOR VALUES FROM ('{start_date}') TO ('{end_date}');
-            """
+            IF EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(legacy)) THEN
+                EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, legacy);
+                
+                FOR d IN EXECUTE format('SELECT DISTINCT (%I)::date FROM %I', entry[2], legacy) LOOP
+                    EXECUTE format(
+                        'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                        parent || '_' || to_char(d, 'YYYYMMDD'), parent, d, d + 1
+                    );
+                END LOOP;
+                
+                -- Generated columns are recomputed on insert
+                SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO column_list
+                FROM pg_attribute
+                WHERE attrelid = to_regclass(parent) AND attnum > 0
+                  AND NOT attisdropped AND attgenerated = '';
+                EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM %I', parent, column_list, column_list, legacy);
+                EXECUTE format('DROP TABLE %I', legacy);
+            END IF;
             
-            try:
-                db.session.execute(text(partition_sql))
-                logger.debug(f"Created partition: {table_name}")
-            except Exception as e:
-                # Partition might already exist
-                logger.debug(f"Partition {table_name} already exists or error: {e}")
-        
+            FOR d IN SELECT generate_series(
+                (now() AT TIME ZONE 'UTC')::date - {int(days_behind)},
+                (now() AT TIME ZONE 'UTC')::date + {int(days) - 1},
+                INTERVAL '1 day'
+            )::date LOOP
+                BEGIN
+                    EXECUTE format(
+                        'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                        parent || '_' || to_char(d, 'YYYYMMDD'), parent, d, d + 1
+                    );
+                EXCEPTION WHEN others THEN
+                    RAISE WARNING 'Partition %_% not created: %', parent, to_char(d, 'YYYYMMDD'), SQLERRM;
+                END;
+            END LOOP;
+        END LOOP;
+    END $$;
+    """
+    
+    try:
+        db.session.execute(text(partition_sql))
         db.session.commit()
         logger.info("Table partitions created successfully")
         
@@ -69,10 +119,8 @@ def create_indexes():
     logger.info("Creating database indexes...")
     
     indexes = [
-        # Additional indexes for events_enriched
-        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_events_enriched_source_ts ON events_enriched(source, ts DESC);",
-        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_events_enriched_host_ts ON events_enriched(host, ts DESC);",
-        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_events_enriched_event_type_ts ON events_enriched(event_type, ts DESC);",
+        # Additional indexes for events_enriched (partitioned tables cannot build CONCURRENTLY)
+        "CREATE INDEX IF NOT EXISTS idx_events_enriched_host_ts ON events_enriched(host, ts DESC);",
         
         # Indexes for alert events
         "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_alert_events_rule_id_triggered_at ON alert_events(rule_id, triggered_at DESC);",
@@ -86,59 +134,125 @@ def create_indexes():
         "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_last_login ON users(last_login DESC);",
     ]
     
-    for index_sql in indexes:
-        try:
-            db.session.execute(text(index_sql))
-            logger.debug(f"Created index: {index_sql.split()[5]}")
-        except Exception as e:
-            logger.warning(f"Index creation failed (might already exist): {e}")
+    # Worker threads have no app context, so resolve the engine up front
+    engine = db.engine
+    
+    def build_index(index_sql):
+        # CONCURRENTLY cannot run inside a transaction block
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text(f"SET maintenance_work_mem = '{INDEX_MAINTENANCE_WORK_MEM}'"))
+            conn.execute(text(f"SET max_parallel_maintenance_workers = {INDEX_PARALLEL_WORKERS}"))
+            conn.execute(text(index_sql))
+    
+    # Concurrent builds on different tables do not block each other
+    with ThreadPoolExecutor(max_workers=INDEX_BUILD_WORKERS) as pool:
+        futures = {pool.submit(build_index, index_sql): index_sql for index_sql in indexes}
+        
+        for future in as_completed(futures):
+            index_name = futures[future].split(' ON ')[0].split()[-1]
+            try:
+                future.result()
+                logger.debug(f"Created index: {index_name}")
+            except Exception as e:
+                logger.warning(f"Index creation failed for {index_name}: {e}")
+    
+    logger.info("Database indexes created successfully")
+
+def create_materialized_views():
+    """Create materialized views backing the stats endpoints"""
+    logger.info("Creating materialized views...")
+    
+    # Only the last day is kept so a refresh scans the newest partitions
+    # rather than the whole table
+    view_sql = [
+        # Per-minute ingestion counters behind /api/stats
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS mv_ingestion_stats AS
+        SELECT
+            source,
+            date_trunc('minute', received_at) AS m,
+            COUNT(*) AS count,
+            MAX(received_at) AS last_received
+        FROM events_raw
+        WHERE received_at > NOW() - INTERVAL '25 hours'
+        GROUP BY 1, 2
+        """,
+        # REFRESH ... CONCURRENTLY requires a unique index
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_ingestion_stats_source_m ON mv_ingestion_stats(source, m)",
+        
+        # Hourly enriched event counts behind the dashboard widgets
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS mv_events_hourly AS
+        SELECT
+            date_trunc('hour', ts) AS hour,
+            event_type,
+            host,
+            COUNT(*) AS c
+        FROM events_enriched
+        WHERE ts > NOW() - INTERVAL '25 hours'
+        GROUP BY 1, 2, 3
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_events_hourly_hour_type_host ON mv_events_hourly(hour, event_type, host)",
+    ]
     
     try:
+        for sql in view_sql:
+            db.session.execute(text(sql))
         db.session.commit()
-        logger.info("Database indexes created successfully")
+        logger.info("Materialized views created successfully")
+        
     except Exception as e:
-        logger.error(f"Error creating indexes: {e}")
+        logger.error(f"Error creating materialized views: {e}")
         db.session.rollback()
+        raise
+
+# Seed accounts ship with published default passwords, so a cheaper KDF
+# costs nothing in security and keeps bootstraps fast
+SEED_PASSWORD_METHOD = 'pbkdf2:sha256:100000'
+
+DEFAULT_USERS = [
+    {'username': 'admin', 'email': 'admin@siem.local', 'password': 'admin123', 'is_admin': True},
+    {'username': 'analyst', 'email': 'analyst@siem.local', 'password': 'analyst123', 'is_admin': False},
+]
 
 def create_default_users():
     """Create default admin user and sample users"""
     logger.info("Creating default users...")
     
     try:
-        # Create admin user
-        admin = User.query.filter_by(username='admin').first()
-        if not admin:
-            admin = User(
-                username='admin',
-                email='admin@siem.local',
-                password_hash=generate_password_hash('admin123'),
-                is_admin=True
+        existing = {
+            username for (username,) in db.session.query(User.username).filter(
+                User.username.in_([user['username'] for user in DEFAULT_USERS])
             )
-            db.session.add(admin)
-            logger.info("Created default admin user: admin/admin123")
-        else:
-            logger.info("Admin user already exists")
+        }
         
-        # Create analyst user
-        analyst = User.query.filter_by(username='analyst').first()
-        if not analyst:
-            analyst = User(
-                username='analyst',
-                email='analyst@siem.local',
-                password_hash=generate_password_hash('analyst123'),
-                is_admin=False
+        # Only hash passwords for accounts that are actually inserted
+        to_insert = [
+            {
+                'username': user_data['username'],
+                'email': user_data['email'],
+                'password_hash': generate_password_hash(user_data['password'], method=SEED_PASSWORD_METHOD),
+                'is_admin': user_data['is_admin']
+            }
+            for user_data in DEFAULT_USERS
+            if user_data['username'] not in existing
+        ]
+        
+        if to_insert:
+            db.session.execute(
+                pg_insert(User).values(to_insert).on_conflict_do_nothing(index_elements=['username'])
             )
-            db.session.add(analyst)
-            logger.info("Created analyst user: analyst/analyst123")
-        else:
-            logger.info("Analyst user already exists")
         
-        db.session.commit()
+        for user_data in DEFAULT_USERS:
+            if user_data['username'] in existing:
+                logger.info(f"User already exists: {user_data['username']}")
+            else:
+                logger.info(f"Created user: {user_data['username']}/{user_data['password']}")
+        
         logger.info("Default users created successfully")
         
     except Exception as e:
         logger.error(f"Error creating default users: {e}")
-        db.session.rollback()
         raise
 
 def create_default_alert_rules():
@@ -147,7 +261,7 @@ def create_default_alert_rules():
     
     try:
         # Get admin user for rule ownership
-        admin = User.query.filter_by(username='admin').first()
+        admin = db.session.query(User.id).filter_by(username='admin').first()
         if not admin:
             logger.warning("Admin user not found, skipping default alert rules")
             return
@@ -182,30 +296,32 @@ def create_default_alert_rules():
             }
         ]
         
+        existing = {
+            name for (name,) in db.session.query(AlertRule.name).filter(
+                AlertRule.name.in_([rule_data['name'] for rule_data in default_rules])
+            )
+        }
+        
+        to_insert = [
+            dict(rule_data, created_by=admin.id)
+            for rule_data in default_rules
+            if rule_data['name'] not in existing
+        ]
+        
+        if to_insert:
+            db.session.execute(insert(AlertRule).values(to_insert))
+        
         for rule_data in default_rules:
-            existing_rule = AlertRule.query.filter_by(name=rule_data['name']).first()
-            if not existing_rule:
-                rule = AlertRule(
-                    name=rule_data['name'],
-                    description=rule_data['description'],
-                    rule_type=rule_data['rule_type'],
-                    filter_query=rule_data['filter_query'],
-                    threshold_count=rule_data['threshold_count'],
-                    time_window_minutes=rule_data['time_window_minutes'],
-                    email_recipients=rule_data['email_recipients'],
-                    created_by=admin.id
-                )
-                db.session.add(rule)
-                logger.info(f"Created alert rule: {rule_data['name']}")
-            else:
+            if rule_data['name'] in existing:
                 logger.info(f"Alert rule already exists: {rule_data['name']}")
+            else:
+                logger.info(f"Created alert rule: {rule_data['name']}")
         
-        db.session.commit()
         logger.info("Default alert rules created successfully")
         
     except Exception as e:
         logger.error(f"Error creating default alert rules: {e}")
-        db.session.rollback()
+        raise
 
 def create_default_dashboard():
     """Create default dashboard"""
@@ -213,7 +329,7 @@ def create_default_dashboard():
     
     try:
         # Get admin user for dashboard ownership
-        admin = User.query.filter_by(username='admin').first()
+        admin = db.session.query(User.id).filter_by(username='admin').first()
         if not admin:
             logger.warning("Admin user not found, skipping default dashboard")
             return
@@ -249,46 +365,42 @@ def create_default_dashboard():
                 ]
             }
             
-            dashboard = Dashboard(
-                name='Security Overview',
-                description='Default security monitoring dashboard',
-                layout_config=dashboard_config,
-                created_by=admin.id,
-                is_public=True
-            )
-            db.session.add(dashboard)
+            db.session.execute(insert(Dashboard), [{
+                'name': 'Security Overview',
+                'description': 'Default security monitoring dashboard',
+                'layout_config': dashboard_config,
+                'created_by': admin.id,
+                'is_public': True
+            }])
             logger.info("Created default dashboard: Security Overview")
         else:
             logger.info("Default dashboard already exists")
         
-        db.session.commit()
         logger.info("Default dashboard created successfully")
         
     except Exception as e:
         logger.error(f"Error creating default dashboard: {e}")
-        db.session.rollback()
+        raise
 
 def create_system_health_record():
     """Create initial system health record"""
     logger.info("Creating initial system health record...")
     
     try:
-        health_record = SystemHealth(
-            component='system',
-            status='healthy',
-            metrics={
+        db.session.execute(insert(SystemHealth), [{
+            'component': 'system',
+            'status': 'healthy',
+            'metrics': {
                 'initialization': True,
                 'database': 'connected',
                 'timestamp': datetime.now(timezone.utc).isoformat()
             }
-        )
-        db.session.add(health_record)
-        db.session.commit()
+        }])
         logger.info("Initial system health record created")
         
     except Exception as e:
         logger.error(f"Error creating system health record: {e}")
-        db.session.rollback()
+        raise
 
 def optimize_database():
     """Run database optimization commands"""
@@ -359,17 +471,22 @@ def main():
             # Step 3: Create indexes
             create_indexes()
             
-            # Step 4: Create default users
-            create_default_users()
-            
-            # Step 5: Create default alert rules
-            create_default_alert_rules()
+            # Step 3b: Create materialized views
+            create_materialized_views()
             
-            # Step 6: Create default dashboard
-            create_default_dashboard()
-            
-            # Step 7: Create initial system health record
-            create_system_health_record()
+            # Steps 4-7: Seed default data in a single transaction
+            with db.session.begin():
+                # Step 4: Create default users
+                create_default_users()
+                
+                # Step 5: Create default alert rules
+                create_default_alert_rules()
+                
+                # Step 6: Create default dashboard
+                create_default_dashboard()
+                
+                # Step 7: Create initial system health record
+                create_system_health_record()
             
             # Step 8: Optimize database
             optimize_database()
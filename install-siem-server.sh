@@ -365,7 +365,29 @@ Group=$SIEM_GROUP
 WorkingDirectory=$INSTALL_DIR
 Environment=PYTHONPATH=$INSTALL_DIR
 EnvironmentFile=/etc/siem/config.env
-ExecStart=$INSTALL_DIR/venv/bin/celery -A celery_worker worker --loglevel=info --concurrency=4
+ExecStart=$INSTALL_DIR/venv/bin/celery -A celery_worker worker --loglevel=info --concurrency=4 -Q celery,parsing,alerting,maintenance
+Restart=always
+RestartSec=10
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+    # SIEM RabbitMQ Consumer Service (feeds raw events to the workers)
+    cat > /etc/systemd/system/siem-consumer.service << EOF
+[Unit]
+Description=SIEM RabbitMQ Consumer
+After=network.target postgresql.service redis.service rabbitmq-server.service
+Wants=postgresql.service redis.service rabbitmq-server.service
+
+[Service]
+Type=simple
+User=$SIEM_USER
+Group=$SIEM_GROUP
+WorkingDirectory=$INSTALL_DIR
+Environment=PYTHONPATH=$INSTALL_DIR
+EnvironmentFile=/etc/siem/config.env
+ExecStart=$INSTALL_DIR/venv/bin/python -c "from celery_worker import consume_raw_queues; consume_raw_queues()"
 Restart=always
 RestartSec=10
 
@@ -521,10 +543,12 @@ start_services() {
     # Start SIEM services
     systemctl enable siem-server
     systemctl enable siem-worker
+    systemctl enable siem-consumer
     systemctl enable siem-scheduler
     
     systemctl start siem-server
     systemctl start siem-worker
+    systemctl start siem-consumer
     systemctl start siem-scheduler
     
     # Start web server
@@ -559,7 +583,7 @@ verify_installation() {
     log_step "Verifying installation..."
     
     # Check services
-    services=("postgresql" "redis-server" "rabbitmq-server" "nginx" "siem-server" "siem-worker" "siem-scheduler")
+    services=("postgresql" "redis-server" "rabbitmq-server" "nginx" "siem-server" "siem-worker" "siem-consumer" "siem-scheduler")
     
     for service in "${services[@]}"; do
         if systemctl is-active --quiet "$service" || systemctl is-active --quiet "${service%%-*}"; then
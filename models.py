@@ -1,8 +1,11 @@
-from datetime import datetime, timezone
 from sqlalchemy import text, Index
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR
 from app import db
 from flask_login import UserMixin
 
+# Timestamp columns are naive UTC, so stamp them with the UTC wall clock
+UTC_NOW = text("(now() AT TIME ZONE 'utc')")
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
     
@@ -11,46 +14,87 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, server_default=UTC_NOW)
     last_login = db.Column(db.DateTime)
 
 class EventsRaw(db.Model):
     __tablename__ = 'events_raw'
     
-    id = db.Column(db.BigInteger, primary_key=True)
-    received_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    # Partitioned by received_at, which must therefore be part of the primary key
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    received_at = db.Column(db.DateTime, primary_key=True, nullable=False, server_default=UTC_NOW)
     source = db.Column(db.Text, nullable=False)
     host = db.Column(db.Text)
-    payload = db.Column(db.JSON, nullable=False)
+    payload = db.Column(JSONB, nullable=False)
     
-    # Add index for better query performance
+    # Add index for better query performance (created per partition)
     __table_args__ = (
         Index('idx_events_raw_received_at', 'received_at'),
         Index('idx_events_raw_source', 'source'),
+        {'postgresql_partition_by': 'RANGE (received_at)'},
     )
 
+class RawPublishOutbox(db.Model):
+    __tablename__ = 'raw_publish_outbox'
+    
+    # One row per stored events_raw batch not yet handed to RabbitMQ, written
+    # in the batch's transaction; received_at matches the batch's rows
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    raw_ids = db.Column(ARRAY(db.BigInteger), nullable=False)
+    received_at = db.Column(db.DateTime, nullable=False, server_default=UTC_NOW)
+
+# Daily event partitions exist from this many days before the current UTC
+# day to this many days after it; enrichment stores events timestamped
+# outside that range under the time they were enriched
+EVENT_PARTITION_DAYS_BEHIND = 7
+EVENT_PARTITION_DAYS_AHEAD = 30
+
 class EventsEnriched(db.Model):
     __tablename__ = 'events_enriched'
     
-    id = db.Column(db.BigInteger, primary_key=True)
-    raw_id = db.Column(db.BigInteger, db.ForeignKey('events_raw.id'))
-    ts = db.Column(db.DateTime, nullable=False)
+    # Partitioned by ts, which must therefore be part of the primary key
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    raw_id = db.Column(db.BigInteger)
+    ts = db.Column(db.DateTime, primary_key=True, nullable=False)
     source = db.Column(db.Text, nullable=False)
     host = db.Column(db.Text)
     event_type = db.Column(db.Text)
     message = db.Column(db.Text)
-    enrichment = db.Column(db.JSON)  # GeoIP, threat intel, etc.
-    event_metadata = db.Column(db.JSON)    # parsed fields
+    message_tsv = db.Column(TSVECTOR, db.Computed("to_tsvector('english', coalesce(message, ''))", persisted=True))
+    enrichment = db.Column(JSONB)  # GeoIP, threat intel, etc.
+    event_metadata = db.Column(JSONB)    # parsed fields
     
-    # Relationships
-    raw_event = db.relationship('EventsRaw', backref='enriched_events')
+    # Relationships (no foreign key: events_raw.id alone is not unique across partitions)
+    raw_event = db.relationship(
+        'EventsRaw',
+        primaryjoin='foreign(EventsEnriched.raw_id) == EventsRaw.id',
+        viewonly=True,
+        lazy='raise',
+        backref=db.backref('enriched_events', viewonly=True)
+    )
     
-    # Indexes for better performance
+    # Indexes for better performance (created per partition)
     __table_args__ = (
         Index('idx_events_enriched_ts_desc', 'ts', postgresql_using='btree'),
-        Index('idx_events_enriched_event_type', 'event_type'),
-        Index('idx_events_enriched_source', 'source'),
-
+        # Block-range summary for wide time scans; tiny on append-only data
+        Index('idx_events_enriched_ts_brin', 'ts', postgresql_using='brin',
+              postgresql_with={'pages_per_range': 32}),
+        # Covers the hourly (ts, event_type, host) rollup without heap reads
+        Index('idx_events_enriched_ts_type_host', text('ts DESC'), 'event_type', 'host'),
+        # Filter-then-order-by-ts lookups used by search
+        Index('idx_events_enriched_event_type_ts', 'event_type', text('ts DESC')),
+        Index('idx_events_enriched_source_ts', 'source', text('ts DESC')),
+        # Containment (@>) lookups on parsed fields and enrichment data
+        Index('idx_events_enriched_metadata_gin', 'event_metadata',
+              postgresql_using='gin', postgresql_ops={'event_metadata': 'jsonb_path_ops'}),
+        Index('idx_events_enriched_enrichment_gin', 'enrichment',
+              postgresql_using='gin', postgresql_ops={'enrichment': 'jsonb_path_ops'}),
+        # Full-text search over messages
+        Index('idx_events_enriched_message_tsv', 'message_tsv', postgresql_using='gin'),
+        # Equality lookups on frequently filtered parsed fields
+        Index('idx_events_enriched_meta_user', text("(event_metadata->>'user')")),
+        Index('idx_events_enriched_meta_src_ip', text("(event_metadata->>'src_ip')")),
+        {'postgresql_partition_by': 'RANGE (ts)'},
     )
 
 class AlertRule(db.Model):
@@ -63,26 +107,26 @@ class AlertRule(db.Model):
     filter_query = db.Column(db.Text, nullable=False)
     threshold_count = db.Column(db.Integer)
     time_window_minutes = db.Column(db.Integer)
-    email_recipients = db.Column(db.JSON)
+    email_recipients = db.Column(JSONB)
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, server_default=UTC_NOW)
     created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
     
     # Relationships
-    creator = db.relationship('User', backref='alert_rules')
+    creator = db.relationship('User', backref='alert_rules', lazy='raise')
 
 class AlertEvent(db.Model):
     __tablename__ = 'alert_events'
     
     id = db.Column(db.Integer, primary_key=True)
     rule_id = db.Column(db.Integer, db.ForeignKey('alert_rules.id'), nullable=False)
-    triggered_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    triggered_at = db.Column(db.DateTime, server_default=UTC_NOW)
     event_count = db.Column(db.Integer)
-    details = db.Column(db.JSON)
+    details = db.Column(JSONB)
     email_sent = db.Column(db.Boolean, default=False)
     
     # Relationships
-    rule = db.relationship('AlertRule', backref='triggered_events')
+    rule = db.relationship('AlertRule', backref='triggered_events', lazy='raise')
 
 class Dashboard(db.Model):
     __tablename__ = 'dashboards'
@@ -90,22 +134,22 @@ class Dashboard(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text)
-    layout_config = db.Column(db.JSON)  # Widget configuration
+    layout_config = db.Column(JSONB)  # Widget configuration
     created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, server_default=UTC_NOW)
     is_public = db.Column(db.Boolean, default=False)
     
     # Relationships
-    creator = db.relationship('User', backref='dashboards')
+    creator = db.relationship('User', backref='dashboards', lazy='raise')
 
 class SystemHealth(db.Model):
     __tablename__ = 'system_health'
     
     id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    timestamp = db.Column(db.DateTime, server_default=UTC_NOW)
     component = db.Column(db.String(100), nullable=False)  # ingestion, parser, enricher
     status = db.Column(db.String(20), nullable=False)  # healthy, warning, critical
-    metrics = db.Column(db.JSON)  # CPU, memory, queue depth, etc.
+    metrics = db.Column(JSONB)  # CPU, memory, queue depth, etc.
     
     __table_args__ = (
         Index('idx_system_health_timestamp', 'timestamp'),
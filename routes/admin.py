@@ -2,15 +2,22 @@
 Admin routes for SIEM management
 """
 
+import io
 import os
+import string
 import zipfile
-import tempfile
+from functools import lru_cache
 from flask import Blueprint, render_template, request, jsonify, send_file, flash, redirect, url_for
 from flask_login import login_required, current_user
 from functools import wraps
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
+AGENT_DIR = os.path.join(os.path.dirname(__file__), '..', 'agent')
+
+# Files shipped unchanged in every agent package
+AGENT_PACKAGE_FILES = ('siem_agent.py', 'install.sh', 'siem-agent.service')
+
 def admin_required(f):
     """Decorator to require admin privileges"""
     @wraps(f)
@@ -46,10 +53,10 @@ def generate_agent():
         config_content = generate_agent_config(data)
         
         # Create agent package
-        package_path = create_agent_package(config_content, data.get('agent_id', 'siem-agent'))
+        package = create_agent_package(config_content, data.get('agent_id', 'siem-agent'))
         
         return send_file(
-            package_path,
+            package,
             as_attachment=True,
             download_name=f"siem-agent-{data.get('agent_id', 'package')}.zip",
             mimetype='application/zip'
@@ -58,93 +65,102 @@ def generate_agent():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def generate_agent_config(data):
-    """Generate agent configuration YAML"""
-    log_sources = data.get('log_sources', [])
-    syslog_ports = data.get('syslog_ports', [])
-    
-    # Build file sources
-    file_sources_yaml = ""
-    if log_sources:
-        file_sources_yaml = "file_sources:\n"
-        for source in log_sources:
-            if source.get('path'):
-                file_sources_yaml += f'  - name: "{source.get("name", "custom")}"\n'
-                file_sources_yaml += f'    path: "{source["path"]}"\n'
-    
-    # Build syslog sources
-    syslog_sources_yaml = ""
-    if syslog_ports:
-        syslog_sources_yaml = "syslog_sources:\n"
-        for port_config in syslog_ports:
-            port = port_config.get('port')
-            if port:
-                syslog_sources_yaml += f'  - name: "syslog-{port}"\n'
-                syslog_sources_yaml += f'    port: {port}\n'
-    
-    config_template = f"""# SIEM Agent Configuration File
-# Generated automatically for {data.get('agent_id', 'agent')}
+AGENT_CONFIG_TEMPLATE = string.Template("""# SIEM Agent Configuration File
+# Generated automatically for ${agent_name}
 
 # SIEM Platform Connection
-siem_endpoint: "{data['siem_endpoint']}"
-api_token: "{data['api_token']}"
+siem_endpoint: "${siem_endpoint}"
+api_token: "${api_token}"
 
 # Batch Settings
-batch_size: {data.get('batch_size', 10)}
-batch_timeout: {data.get('batch_timeout', 5)}
+batch_size: ${batch_size}
+batch_timeout: ${batch_timeout}
 
 # Log Sources
-{file_sources_yaml}
+${file_sources}
 
 # Syslog Listeners
-{syslog_sources_yaml}
+${syslog_sources}
 
 # Systemd Journal Integration
 systemd_journal:
-  enabled: {str(data.get('systemd_enabled', True)).lower()}
+  enabled: ${systemd_enabled}
 
 # Log Level
-log_level: "{data.get('log_level', 'INFO')}"
+log_level: "${log_level}"
 
 # Agent Identification
-agent_id: "{data['agent_id']}"
+agent_id: "${agent_id}"
 
 # Connection Settings
 connection:
-  timeout: {data.get('timeout', 10)}
-  retry_attempts: {data.get('retry_attempts', 3)}
-  retry_delay: {data.get('retry_delay', 5)}
+  timeout: ${timeout}
+  retry_attempts: ${retry_attempts}
+  retry_delay: ${retry_delay}
 
 # Security Settings
 security:
-  verify_ssl: {str(data.get('verify_ssl', True)).lower()}
-  ca_cert_path: {f'"{data["ca_cert_path"]}"' if data.get('ca_cert_path') else 'null'}
-"""
+  verify_ssl: ${verify_ssl}
+  ca_cert_path: ${ca_cert_path}
+""")
+
+def generate_agent_config(data):
+    """Generate agent configuration YAML"""
+    log_sources = data.get('log_sources', [])
+    syslog_ports = data.get('syslog_ports', [])
+    
+    # Build file sources
+    file_sources_yaml = ""
+    if log_sources:
+        file_sources_yaml = "file_sources:\n" + "".join(
+            f'  - name: "{source.get("name", "custom")}"\n    path: "{source["path"]}"\n'
+            for source in log_sources if source.get('path')
+        )
     
-    return config_template
+    # Build syslog sources
+    syslog_sources_yaml = ""
+    if syslog_ports:
+        syslog_sources_yaml = "syslog_sources:\n" + "".join(
+            f'  - name: "syslog-{port_config["port"]}"\n    port: {port_config["port"]}\n'
+            for port_config in syslog_ports if port_config.get('port')
+        )
+    
+    return AGENT_CONFIG_TEMPLATE.substitute(
+        agent_name=data.get('agent_id', 'agent'),
+        siem_endpoint=data['siem_endpoint'],
+        api_token=data['api_token'],
+        batch_size=data.get('batch_size', 10),
+        batch_timeout=data.get('batch_timeout', 5),
+        file_sources=file_sources_yaml,
+        syslog_sources=syslog_sources_yaml,
+        systemd_enabled=str(data.get('systemd_enabled', True)).lower(),
+        log_level=data.get('log_level', 'INFO'),
+        agent_id=data['agent_id'],
+        timeout=data.get('timeout', 10),
+        retry_attempts=data.get('retry_attempts', 3),
+        retry_delay=data.get('retry_delay', 5),
+        verify_ssl=str(data.get('verify_ssl', True)).lower(),
+        ca_cert_path=f'"{data["ca_cert_path"]}"' if data.get('ca_cert_path') else 'null'
+    )
+
+@lru_cache(maxsize=1)
+def _base_agent_package():
+    """Build the static part of the agent package once per process"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
+        for name in AGENT_PACKAGE_FILES:
+            zipf.write(os.path.join(AGENT_DIR, name), name)
+    return buf.getvalue()
 
 def create_agent_package(config_content, agent_id):
     """Create agent installation package"""
-    # Create temporary directory
-    temp_dir = tempfile.mkdtemp()
-    package_path = os.path.join(temp_dir, f'siem-agent-{agent_id}.zip')
+    # Start from the prebuilt archive and append the per-agent files
+    package = io.BytesIO(_base_agent_package())
     
-    with zipfile.ZipFile(package_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        # Add agent script
-        agent_script_path = os.path.join(os.path.dirname(__file__), '..', 'agent', 'siem_agent.py')
-        zipf.write(agent_script_path, 'siem_agent.py')
-        
+    with zipfile.ZipFile(package, 'a', zipfile.ZIP_STORED) as zipf:
         # Add configuration
         zipf.writestr('config.yaml', config_content)
         
-        # Add installation script
-        install_script_path = os.path.join(os.path.dirname(__file__), '..', 'agent', 'install.sh')
-        zipf.write(install_script_path, 'install.sh')
-        
-        # Add systemd service file
-        service_path = os.path.join(os.path.dirname(__file__), '..', 'agent', 'siem-agent.service')
-        zipf.write(service_path, 'siem-agent.service')
-        
         # Add README
         readme_content = f"""# SIEM Agent Installation Package
 # Generated for: {agent_id}
@@ -178,4 +194,5 @@ Check the SIEM dashboard for incoming events after installation.
 """
         zipf.writestr('README.txt', readme_content)
     
-    return package_path
\ No newline at end of file
+    package.seek(0)
+    return package
\ No newline at end of file
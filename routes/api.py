@@ -1,16 +1,47 @@
-from flask import Blueprint, request, jsonify, current_app
+import json
+import zlib
+from datetime import datetime, timezone
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
+from sqlalchemy import select, text
 from flask_login import login_required, current_user
 from services.ingestion import IngestionService, authenticate_agent
-from services.alert_engine import AlertEngine
+from services.alert_engine import AlertEngine, FilterQueryError, notify_rules_changed, parse_filter_query
 from models import AlertRule
 from app import db
+from utils.json_utils import dumps, json_response
 
 api_bp = Blueprint('api', __name__)
 
+def _get_ingest_json():
+    """
+    Parse the request body as JSON, decoding gzip-compressed agent payloads
+    
+    Compressed bodies are inflated to at most MAX_INGEST_BODY_SIZE bytes.
+    
+    Returns:
+        (parsed body or None, (error, status) or None)
+    """
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        limit = current_app.config['MAX_INGEST_BODY_SIZE']
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(request.get_data(), limit)
+            if decompressor.unconsumed_tail or (len(body) == limit and not decompressor.eof):
+                return None, ({'error': f'Decompressed body exceeds {limit} bytes'}, 413)
+            return json.loads(body), None
+        except (zlib.error, ValueError):
+            return None, None
+    return request.get_json(), None
+
 @api_bp.route('/ingest', methods=['POST'])
+@api_bp.route('/ingest/batch', methods=['POST'])
 def ingest():
     """
     Ingest events from agents
+    
+    Accepts a single event object, a list of events, or {"events": [...]}
+    as sent by the agent's batch sender. Events are written asynchronously,
+    so a successful request returns 202.
     """
     # Check authentication
     auth_header = request.headers.get('Authorization', '')
@@ -25,15 +56,25 @@ def ingest():
     if not request.is_json:
         return jsonify({'error': 'Content-Type must be application/json'}), 400
     
-    data = request.get_json()
+    data, error = _get_ingest_json()
+    if error:
+        return jsonify(error[0]), error[1]
     if not data:
         return jsonify({'error': 'Empty request body'}), 400
     
-    # Ingest the event
-    ingestion_service = IngestionService()
-    result, status_code = ingestion_service.ingest_event(data)
+    if isinstance(data, dict) and isinstance(data.get('events'), list):
+        data = data['events']
     
-    return jsonify(result), status_code
+    if not isinstance(data, list):
+        data = [data]
+    
+    # Queue the event(s) for the background writers
+    result, status_code = IngestionService().enqueue_events(data)
+    
+    response = jsonify(result)
+    if status_code == 503:
+        response.headers['Retry-After'] = '1'
+    return response, status_code
 
 @api_bp.route('/health', methods=['GET'])
 def health():
@@ -64,21 +105,20 @@ def alert_rules():
     Manage alert rules
     """
     if request.method == 'GET':
-        rules = AlertRule.query.all()
-        return jsonify({
-            'rules': [{
-                'id': rule.id,
-                'name': rule.name,
-                'description': rule.description,
-                'rule_type': rule.rule_type,
-                'filter_query': rule.filter_query,
-                'threshold_count': rule.threshold_count,
-                'time_window_minutes': rule.time_window_minutes,
-                'email_recipients': rule.email_recipients,
-                'is_active': rule.is_active,
-                'created_at': rule.created_at.isoformat()
-            } for rule in rules]
-        })
+        rows = db.session.execute(select(
+            AlertRule.id,
+            AlertRule.name,
+            AlertRule.description,
+            AlertRule.rule_type,
+            AlertRule.filter_query,
+            AlertRule.threshold_count,
+            AlertRule.time_window_minutes,
+            AlertRule.email_recipients,
+            AlertRule.is_active,
+            AlertRule.created_at
+        )).all()
+        
+        return json_response({'rules': [row._asdict() for row in rows]})
     
     elif request.method == 'POST':
         if not current_user.is_admin:
@@ -110,6 +150,8 @@ def alert_rules():
                 'rule_id': rule.id
             }), 201
             
+        except FilterQueryError as e:
+            return jsonify({'error': f'Invalid filter_query: {e}'}), 400
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
@@ -128,6 +170,7 @@ def alert_rule_detail(rule_id):
         try:
             db.session.delete(rule)
             db.session.commit()
+            notify_rules_changed()
             return jsonify({'message': 'Alert rule deleted successfully'})
         except Exception as e:
             db.session.rollback()
@@ -143,6 +186,7 @@ def alert_rule_detail(rule_id):
             if 'description' in data:
                 rule.description = data['description']
             if 'filter_query' in data:
+                parse_filter_query(data['filter_query'])
                 rule.filter_query = data['filter_query']
             if 'threshold_count' in data:
                 rule.threshold_count = data['threshold_count']
@@ -154,13 +198,57 @@ def alert_rule_detail(rule_id):
                 rule.is_active = data['is_active']
             
             db.session.commit()
+            notify_rules_changed()
             
             return jsonify({'message': 'Alert rule updated successfully'})
             
+        except FilterQueryError as e:
+            db.session.rollback()
+            return jsonify({'error': f'Invalid filter_query: {e}'}), 400
         except Exception as e:
             db.session.rollback()
             return jsonify({'error': str(e)}), 500
 
+# Search statements keyed by their predicates; there are only a few dozen
+# filter combinations, and reusing the TextClause lets SQLAlchemy's compiled
+# cache skip recompiling them
+_search_statements = {}
+
+def _search_statement(query_parts):
+    """
+    Get the cached search statement for a combination of predicates
+    """
+    key = tuple(query_parts)
+    statement = _search_statements.get(key)
+    if statement is None:
+        where_clause = " AND ".join(query_parts) if query_parts else "1=1"
+        statement = _search_statements[key] = text(f"""
+            SELECT id, ts, source, host, event_type, message, enrichment, event_metadata
+            FROM events_enriched 
+            WHERE {where_clause}
+            ORDER BY ts DESC
+            LIMIT :limit
+        """)
+    return statement
+
+def _search_row(row):
+    return {
+        'id': row.id,
+        'ts': row.ts.isoformat(),
+        'source': row.source,
+        'host': row.host,
+        'event_type': row.event_type,
+        'message': row.message,
+        'enrichment': row.enrichment,
+        'metadata': row.event_metadata
+    }
+
+def _dumps_line(obj):
+    """
+    Serialize obj as one NDJSON line
+    """
+    return dumps(obj) + b'\n'
+
 @api_bp.route('/search', methods=['POST'])
 @login_required
 def search():
@@ -170,8 +258,6 @@ def search():
     data = request.get_json()
     
     try:
-        from sqlalchemy import text
-        
         # Build search query
         query_parts = []
         params = {}
@@ -184,6 +270,7 @@ def search():
             query_parts.append("source = :source")
             params['source'] = data['source']
         
+        # A ts range also lets the planner prune events_enriched partitions
         if data.get('start_time'):
             query_parts.append("ts >= :start_time")
             params['start_time'] = data['start_time']
@@ -193,36 +280,51 @@ def search():
             params['end_time'] = data['end_time']
         
         if data.get('search_text'):
-            query_parts.append("message ILIKE :search_text")
-            params['search_text'] = f"%{data['search_text']}%"
+            if data.get('search_mode') == 'substring':
+                query_parts.append("message ILIKE :search_text")
+                params['search_text'] = f"%{data['search_text']}%"
+            else:
+                query_parts.append("message_tsv @@ plainto_tsquery('english', :search_text)")
+                params['search_text'] = data['search_text']
         
-        where_clause = " AND ".join(query_parts) if query_parts else "1=1"
+        # Single-key filters use the expression indexes on event_metadata
+        if data.get('meta_user'):
+            query_parts.append("event_metadata->>'user' = :meta_user")
+            params['meta_user'] = data['meta_user']
         
-        # Execute search
-        sql = f"""
-            SELECT id, ts, source, host, event_type, message, enrichment, event_metadata
-            FROM events_enriched 
-            WHERE {where_clause}
-            ORDER BY ts DESC
-            LIMIT :limit
-        """
+        if data.get('meta_src_ip'):
+            query_parts.append("event_metadata->>'src_ip' = :meta_src_ip")
+            params['meta_src_ip'] = data['meta_src_ip']
+        
+        # Structured filters use the jsonb_path_ops GIN indexes
+        if data.get('metadata'):
+            query_parts.append("event_metadata @> CAST(:metadata AS jsonb)")
+            params['metadata'] = json.dumps(data['metadata'])
+        
+        if data.get('enrichment'):
+            query_parts.append("enrichment @> CAST(:enrichment AS jsonb)")
+            params['enrichment'] = json.dumps(data['enrichment'])
         
+        # Execute search
         params['limit'] = data.get('limit', 100)
         
-        result = db.session.execute(text(sql), params).fetchall()
-        
-        events = []
-        for row in result:
-            events.append({
-                'id': row.id,
-                'ts': row.ts.isoformat(),
-                'source': row.source,
-                'host': row.host,
-                'event_type': row.event_type,
-                'message': row.message,
-                'enrichment': row.enrichment,
-                'metadata': row.metadata
-            })
+        statement = _search_statement(query_parts)
+        
+        # Large exports stream as NDJSON from a server-side cursor
+        if data.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson':
+            def generate():
+                result = db.session.execute(
+                    statement.execution_options(stream_results=True, yield_per=500),
+                    params
+                )
+                for row in result:
+                    yield _dumps_line(_search_row(row))
+            
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+        result = db.session.execute(statement, params).fetchall()
+        
+        events = [_search_row(row) for row in result]
         
         return jsonify({'events': events, 'total': len(events)})
         
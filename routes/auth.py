@@ -1,12 +1,92 @@
 from flask import Blueprint, request, render_template, redirect, url_for, flash, session, current_app
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import check_password_hash, generate_password_hash
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from datetime import datetime, timezone
 from app import db
 from models import User
 
 auth_bp = Blueprint('auth', __name__)
 
+# Recent password checks, keyed by stored hash and a digest of the attempt so
+# a password change invalidates them
+VERIFY_CACHE_TTL = 30
+VERIFY_CACHE_SIZE = 1024
+_verify_cache = OrderedDict()
+_verify_cache_lock = threading.Lock()
+
+# Failed logins allowed per username from one client address before further
+# attempts from it are refused, and per address across all usernames; keying
+# on the address too stops anyone locking a user out by guessing wrong
+MAX_FAILED_LOGINS = 5
+MAX_FAILED_LOGINS_PER_ADDRESS = 50
+FAILED_LOGIN_WINDOW = 15 * 60
+
+def _verify_password(user, password):
+    """
+    Check a password against the user's hash, reusing results from the last
+    VERIFY_CACHE_TTL seconds
+    """
+    key = (user.password_hash, hashlib.sha256(password.encode()).hexdigest())
+    now = time.monotonic()
+    
+    with _verify_cache_lock:
+        cached = _verify_cache.get(key)
+        if cached and now - cached[1] < VERIFY_CACHE_TTL:
+            return cached[0]
+    
+    valid = check_password_hash(user.password_hash, password)
+    
+    with _verify_cache_lock:
+        _verify_cache[key] = (valid, now)
+        _verify_cache.move_to_end(key)
+        while len(_verify_cache) > VERIFY_CACHE_SIZE:
+            _verify_cache.popitem(last=False)
+    
+    return valid
+
+def _failed_login_key(username, address):
+    return f"siem:login_failures:user:{address}:{username}"
+
+def _address_failed_login_key(address):
+    return f"siem:login_failures:address:{address}"
+
+def _login_blocked(username, address):
+    """
+    Check whether username or the client address has exhausted its
+    failed-login allowance
+    """
+    try:
+        failures, address_failures = current_app.session_manager.redis.mget(
+            _failed_login_key(username, address), _address_failed_login_key(address)
+        )
+        return (
+            (failures is not None and int(failures) >= MAX_FAILED_LOGINS)
+            or (address_failures is not None and int(address_failures) >= MAX_FAILED_LOGINS_PER_ADDRESS)
+        )
+    except Exception as e:
+        current_app.logger.warning(f"Could not read failed login count: {e}")
+        return False
+
+def _clear_failed_logins(username, address):
+    try:
+        current_app.session_manager.redis.delete(_failed_login_key(username, address))
+    except Exception as e:
+        current_app.logger.warning(f"Could not clear failed login count: {e}")
+
+def _record_failed_login(username, address):
+    try:
+        pipe = current_app.session_manager.redis.pipeline()
+        for key in (_failed_login_key(username, address), _address_failed_login_key(address)):
+            pipe.incr(key)
+            pipe.expire(key, FAILED_LOGIN_WINDOW)
+        pipe.execute()
+    except Exception as e:
+        current_app.logger.warning(f"Could not record failed login: {e}")
+
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
     """
@@ -20,9 +100,14 @@ def login():
         password = request.form['password']
         remember = request.form.get('remember', False)
 
+        if _login_blocked(username, request.remote_addr):
+            flash('Too many failed login attempts, please try again later', 'error')
+            return render_template('login.html')
+
         user = User.query.filter_by(username=username).first()
 
-        if user and check_password_hash(user.password_hash, password):
+        if user and _verify_password(user, password):
+            _clear_failed_logins(username, request.remote_addr)
             login_user(user, remember=remember)
             
             # Create new session
@@ -36,6 +121,7 @@ def login():
             next_page = request.args.get('next')
             return redirect(next_page or url_for('dashboard.index'))
         else:
+            _record_failed_login(username, request.remote_addr)
             flash('Invalid username or password', 'error')
     
     return render_template('login.html')
@@ -114,12 +200,9 @@ def revoke_session(session_id):
 @login_required
 def revoke_all_sessions():
     # Revoke all sessions except the current one
-    current_session_id = session.get('session_id')
-    sessions = current_app.session_manager.get_user_sessions(current_user.id)
-    
-    for session_data in sessions:
-        if session_data['session_id'] != current_session_id:
-            current_app.session_manager.delete_session(session_data['session_id'])
+    current_app.session_manager.revoke_all_user_sessions(
+        current_user.id, keep_session_id=session.get('session_id')
+    )
     
     flash('All other sessions have been revoked', 'success')
     return redirect(url_for('auth.active_sessions'))
@@ -1,12 +1,128 @@
-from flask import Blueprint, render_template, request, jsonify
+import json
+import math
+from functools import wraps
+from flask import Blueprint, Response, render_template, request, jsonify, current_app, stream_with_context
 from flask_login import login_required, current_user
-from sqlalchemy import text, func
+from sqlalchemy import text, func, tuple_
+from sqlalchemy.orm import contains_eager
 from datetime import datetime, timedelta, timezone
 from app import db
 from models import EventsEnriched, AlertEvent, AlertRule, SystemHealth
+from utils.json_utils import dumps, json_response
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
+# Result sizes the planner estimates above this are reported approximately
+# rather than counted exactly
+EXACT_COUNT_LIMIT = 10000
+
+# Statements for the polled dashboard endpoints, built once so SQLAlchemy
+# reuses their compiled form
+TOTAL_EVENTS_SQL = text("""
+    SELECT COALESCE(SUM(c), 0)
+    FROM mv_events_hourly
+    WHERE hour >= :start_time
+""")
+
+EVENTS_BY_TYPE_SQL = text("""
+    SELECT event_type, SUM(c) as count
+    FROM mv_events_hourly 
+    WHERE hour >= :start_time
+    GROUP BY event_type
+    ORDER BY count DESC
+    LIMIT 10
+""")
+
+EVENTS_BY_HOUR_SQL = text("""
+    SELECT hour, SUM(c) as count
+    FROM mv_events_hourly 
+    WHERE hour >= :start_time
+    GROUP BY hour
+    ORDER BY hour
+""")
+
+TOP_HOSTS_SQL = text("""
+    SELECT host, SUM(c) as count
+    FROM mv_events_hourly 
+    WHERE hour >= :start_time AND host IS NOT NULL
+    GROUP BY host
+    ORDER BY count DESC
+    LIMIT 10
+""")
+
+# Latest health metrics for each component: the recursive CTE skips through
+# idx_system_health_component_timestamp one component at a time and the
+# lateral subquery reads each component's newest row from the same index
+LATEST_HEALTH_SQL = text("""
+    WITH RECURSIVE components AS (
+        (SELECT component FROM system_health ORDER BY component LIMIT 1)
+        UNION ALL
+        SELECT (
+            SELECT component FROM system_health
+            WHERE component > c.component
+            ORDER BY component LIMIT 1
+        )
+        FROM components c
+        WHERE c.component IS NOT NULL
+    )
+    SELECT h.component, h.status, h.metrics, h.timestamp
+    FROM components c
+    CROSS JOIN LATERAL (
+        SELECT component, status, metrics, timestamp
+        FROM system_health
+        WHERE component = c.component
+        ORDER BY timestamp DESC
+        LIMIT 1
+    ) h
+    WHERE c.component IS NOT NULL
+""")
+
+def _estimated_count(stmt):
+    """
+    Row count for a select, estimated by the planner when it is large
+    
+    Pagination totals don't need to be exact, and counting millions of rows
+    costs far more than the page itself.
+    """
+    stmt = stmt.order_by(None)
+    compiled = stmt.compile(dialect=db.engine.dialect)
+    plan = db.session.connection().exec_driver_sql(
+        f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params
+    ).scalar()
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+    
+    if estimate > EXACT_COUNT_LIMIT:
+        return estimate
+    return db.session.execute(db.select(func.count()).select_from(stmt.subquery())).scalar()
+
+def redis_cached(key, ttl):
+    """
+    Cache a JSON view's successful response body in Redis for ttl seconds
+    
+    The cached data is the same for every user, so only use this on views
+    whose output does not depend on the caller or the query string.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            redis = current_app.session_manager.redis
+            try:
+                cached = redis.get(key)
+                if cached is not None:
+                    return Response(cached, mimetype='application/json')
+            except Exception as e:
+                current_app.logger.warning(f"Could not read {key} from Redis: {e}")
+            
+            response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                try:
+                    redis.setex(key, ttl, response.get_data())
+                except Exception as e:
+                    current_app.logger.warning(f"Could not cache {key} in Redis: {e}")
+            return response
+        return decorated_function
+    return decorator
+
 @dashboard_bp.route('/')
 @login_required
 def index():
@@ -33,6 +149,7 @@ def alerts():
 
 @dashboard_bp.route('/api/dashboard/stats')
 @login_required
+@redis_cached('siem:cache:dashboard_stats', 30)
 def dashboard_stats():
     """
     Get dashboard statistics
@@ -41,55 +158,36 @@ def dashboard_stats():
         # Get stats for last 24 hours
         start_time = datetime.now(timezone.utc) - timedelta(hours=24)
         
+        # Counts come from the hourly buckets in mv_events_hourly, refreshed
+        # by the refresh_dashboard_stats task
+        bucket_start = start_time.replace(minute=0, second=0, microsecond=0)
+        
         # Total events
-        total_events = EventsEnriched.query.filter(
-            EventsEnriched.ts >= start_time
-        ).count()
+        total_events = db.session.execute(TOTAL_EVENTS_SQL, {'start_time': bucket_start}).scalar()
         
         # Events by type
-        events_by_type = db.session.execute(text("""
-            SELECT event_type, COUNT(*) as count
-            FROM events_enriched 
-            WHERE ts >= :start_time
-            GROUP BY event_type
-            ORDER BY count DESC
-            LIMIT 10
-        """), {'start_time': start_time}).fetchall()
+        events_by_type = db.session.execute(EVENTS_BY_TYPE_SQL, {'start_time': bucket_start}).fetchall()
         
         # Events by hour for chart
-        events_by_hour = db.session.execute(text("""
-            SELECT 
-                DATE_TRUNC('hour', ts) as hour,
-                COUNT(*) as count
-            FROM events_enriched 
-            WHERE ts >= :start_time
-            GROUP BY DATE_TRUNC('hour', ts)
-            ORDER BY hour
-        """), {'start_time': start_time}).fetchall()
+        events_by_hour = db.session.execute(EVENTS_BY_HOUR_SQL, {'start_time': bucket_start}).fetchall()
         
         # Top source hosts
-        top_hosts = db.session.execute(text("""
-            SELECT host, COUNT(*) as count
-            FROM events_enriched 
-            WHERE ts >= :start_time AND host IS NOT NULL
-            GROUP BY host
-            ORDER BY count DESC
-            LIMIT 10
-        """), {'start_time': start_time}).fetchall()
+        top_hosts = db.session.execute(TOP_HOSTS_SQL, {'start_time': bucket_start}).fetchall()
         
         # Recent alerts
         recent_alerts = AlertEvent.query\
             .join(AlertRule)\
+            .options(contains_eager(AlertEvent.rule).load_only(AlertRule.name))\
             .filter(AlertEvent.triggered_at >= start_time)\
             .order_by(AlertEvent.triggered_at.desc())\
             .limit(5)\
             .all()
         
         return jsonify({
-            'total_events': total_events,
-            'events_by_type': [{'type': row.event_type, 'count': row.count} for row in events_by_type],
-            'events_by_hour': [{'hour': row.hour.isoformat(), 'count': row.count} for row in events_by_hour],
-            'top_hosts': [{'host': row.host, 'count': row.count} for row in top_hosts],
+            'total_events': int(total_events),
+            'events_by_type': [{'type': row.event_type, 'count': int(row.count)} for row in events_by_type],
+            'events_by_hour': [{'hour': row.hour.isoformat(), 'count': int(row.count)} for row in events_by_hour],
+            'top_hosts': [{'host': row.host, 'count': int(row.count)} for row in top_hosts],
             'recent_alerts': [{
                 'id': alert.id,
                 'rule_name': alert.rule.name,
@@ -101,11 +199,48 @@ def dashboard_stats():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Columns returned by the events API, labelled with their JSON keys
+EVENT_COLUMNS = (
+    EventsEnriched.id,
+    EventsEnriched.ts,
+    EventsEnriched.source,
+    EventsEnriched.host,
+    EventsEnriched.event_type,
+    EventsEnriched.message,
+    EventsEnriched.enrichment,
+    EventsEnriched.event_metadata.label('metadata'),
+)
+
+def _event_cursor(row):
+    return {'before_ts': row.ts.isoformat(), 'before_id': row.id}
+
+def _stream_event_page(stmt):
+    """
+    Stream a keyset page as {"events": [...], "next_cursor": ...} while
+    rows are read from a server-side cursor
+    """
+    result = db.session.execute(stmt.execution_options(stream_results=True, yield_per=200))
+    
+    yield b'{"events":['
+    last = None
+    for row in result:
+        if last is not None:
+            yield b','
+        yield dumps(row._asdict())
+        last = row
+    yield b'],"next_cursor":'
+    yield dumps(_event_cursor(last) if last is not None else None)
+    yield b'}'
+
 @dashboard_bp.route('/api/events')
 @login_required
 def api_events():
     """
     Get events with filtering and pagination
+    
+    Pass the next_cursor values from a previous response as before_ts and
+    before_id to page by keyset instead of offset; those pages are streamed
+    and carry no total.
     """
     try:
         # Get query parameters
@@ -117,59 +252,59 @@ def api_events():
         start_time = request.args.get('start_time')
         end_time = request.args.get('end_time')
         search = request.args.get('search')
+        before_ts = request.args.get('before_ts')
+        before_id = request.args.get('before_id', type=int)
         
-        # Build query
-        query = EventsEnriched.query
+        # Build query over plain columns; rows are serialized as they are
+        stmt = db.select(*EVENT_COLUMNS)
         
         if event_type:
-            query = query.filter(EventsEnriched.event_type == event_type)
+            stmt = stmt.where(EventsEnriched.event_type == event_type)
         
         if source:
-            query = query.filter(EventsEnriched.source == source)
+            stmt = stmt.where(EventsEnriched.source == source)
         
         if host:
-            query = query.filter(EventsEnriched.host == host)
+            stmt = stmt.where(EventsEnriched.host == host)
         
         if start_time:
             start_dt = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
-            query = query.filter(EventsEnriched.ts >= start_dt)
+            stmt = stmt.where(EventsEnriched.ts >= start_dt)
         
         if end_time:
             end_dt = datetime.fromisoformat(end_time.replace('Z', '+00:00'))
-            query = query.filter(EventsEnriched.ts <= end_dt)
+            stmt = stmt.where(EventsEnriched.ts <= end_dt)
         
         if search:
-            query = query.filter(EventsEnriched.message.contains(search))
+            stmt = stmt.where(EventsEnriched.message.contains(search))
         
-        # Order by timestamp descending
-        query = query.order_by(EventsEnriched.ts.desc())
+        # Order by timestamp descending, id breaking ties for keyset paging
+        stmt = stmt.order_by(EventsEnriched.ts.desc(), EventsEnriched.id.desc())
         
-        # Paginate
-        pagination = query.paginate(
-            page=page, 
-            per_page=per_page, 
-            error_out=False
-        )
+        # Keyset pagination: continue after the cursor from a previous page
+        if before_ts and before_id is not None:
+            before_dt = datetime.fromisoformat(before_ts.replace('Z', '+00:00'))
+            stmt = stmt.where(
+                EventsEnriched.ts <= before_dt,
+                tuple_(EventsEnriched.ts, EventsEnriched.id) < (before_dt, before_id)
+            )
+            return Response(
+                stream_with_context(_stream_event_page(stmt.limit(per_page))),
+                mimetype='application/json'
+            )
         
-        events = []
-        for event in pagination.items:
-            events.append({
-                'id': event.id,
-                'ts': event.ts.isoformat(),
-                'source': event.source,
-                'host': event.host,
-                'event_type': event.event_type,
-                'message': event.message,
-                'enrichment': event.enrichment,
-                'metadata': event.event_metadata
-            })
+        # Offset pagination; the total comes from the planner for large results
+        page = max(page, 1)
+        rows = db.session.execute(stmt.limit(per_page).offset((page - 1) * per_page)).all()
+        total = _estimated_count(stmt)
         
-        return jsonify({
-            'events': events,
-            'total': pagination.total,
-            'pages': pagination.pages,
-            'current_page': pagination.page,
-            'per_page': pagination.per_page
+        return json_response({
+            'events': [row._asdict() for row in rows],
+            'next_cursor': _event_cursor(rows[-1]) if rows else None,
+            'total': total,
+            'pages': math.ceil(total / per_page) if per_page else 0,
+            'current_page': page,
+            'per_page': per_page
         })
         
     except Exception as e:
@@ -182,31 +317,28 @@ def api_alerts():
     Get alerts with pagination
     """
     try:
-        page = int(request.args.get('page', 1))
+        page = max(int(request.args.get('page', 1)), 1)
         per_page = int(request.args.get('per_page', 20))
         
-        pagination = AlertEvent.query\
-            .join(AlertRule)\
-            .order_by(AlertEvent.triggered_at.desc())\
-            .paginate(page=page, per_page=per_page, error_out=False)
+        stmt = db.select(
+            AlertEvent.id,
+            AlertRule.name.label('rule_name'),
+            AlertRule.description.label('rule_description'),
+            AlertEvent.triggered_at,
+            AlertEvent.event_count,
+            AlertEvent.details,
+            AlertEvent.email_sent
+        ).join(AlertRule, AlertEvent.rule_id == AlertRule.id)\
+            .order_by(AlertEvent.triggered_at.desc())
         
-        alerts = []
-        for alert in pagination.items:
-            alerts.append({
-                'id': alert.id,
-                'rule_name': alert.rule.name,
-                'rule_description': alert.rule.description,
-                'triggered_at': alert.triggered_at.isoformat(),
-                'event_count': alert.event_count,
-                'details': alert.details,
-                'email_sent': alert.email_sent
-            })
+        rows = db.session.execute(stmt.limit(per_page).offset((page - 1) * per_page)).all()
+        total = _estimated_count(stmt)
         
-        return jsonify({
-            'alerts': alerts,
-            'total': pagination.total,
-            'pages': pagination.pages,
-            'current_page': pagination.page
+        return json_response({
+            'alerts': [row._asdict() for row in rows],
+            'total': total,
+            'pages': math.ceil(total / per_page) if per_page else 0,
+            'current_page': page
         })
         
     except Exception as e:
@@ -214,27 +346,36 @@ def api_alerts():
 
 @dashboard_bp.route('/api/system/health')
 @login_required
+@redis_cached('siem:cache:system_health', 10)
 def system_health():
     """
     Get system health status
     """
     try:
         # Get latest health metrics for each component
-        latest_health = db.session.execute(text("""
-            SELECT DISTINCT ON (component) 
-                component, status, metrics, timestamp
-            FROM system_health 
-            ORDER BY component, timestamp DESC
-        """)).fetchall()
-        
-        health_data = []
+        latest_health = db.session.execute(LATEST_HEALTH_SQL).fetchall()
+        
+        health_data = {}
         for row in latest_health:
-            health_data.append({
+            health_data[row.component] = {
                 'component': row.component,
                 'status': row.status,
                 'metrics': row.metrics,
                 'timestamp': row.timestamp.isoformat()
-            })
+            }
+        
+        # Postgres only records status changes; the latest sample lives in Redis
+        try:
+            latest_sample = current_app.session_manager.redis.xrevrange(
+                current_app.config['HEALTH_STREAM_KEY'], count=1
+            )
+            if latest_sample:
+                sample = json.loads(latest_sample[0][1][b'data'])
+                health_data[sample['component']] = sample
+        except Exception as e:
+            current_app.logger.warning(f"Could not read health data from Redis: {e}")
+        
+        health_data = list(health_data.values())
         
         return jsonify({'health': health_data})
         
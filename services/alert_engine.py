@@ -1,18 +1,328 @@
+import os
+import re
+import time
+import select
 import logging
 import smtplib
+import threading
+from collections import namedtuple
+from functools import lru_cache
 from datetime import datetime, timezone, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from sqlalchemy import text
+from flask import current_app
+from sqlalchemy import and_, false, func, text, true, update
+from sqlalchemy.orm import contains_eager
 from app import db
 from models import AlertRule, AlertEvent, EventsEnriched
-from utils.email_sender import EmailSender
+from utils.email_sender import get_email_sender
+from utils.json_utils import dumps, loads
 
 logger = logging.getLogger(__name__)
 
+# Redis sorted set per rule holding matching event ids scored by event time
+RULE_WINDOW_KEY = 'siem:rule:{}'
+
+# Redis list of alerts waiting for their notification email, and how many
+# are taken per flush; alerts sharing recipients are sent as one digest
+ALERT_EMAIL_QUEUE_KEY = 'siem:alert_emails'
+ALERT_EMAIL_BATCH_SIZE = 1000
+
+# Seconds a worker keeps its copy of the active threshold rules; changes
+# announced on RULES_CHANGED_CHANNEL invalidate it sooner
+RULE_CACHE_TTL = 60
+RULES_CHANGED_CHANNEL = 'alert_rules_changed'
+
+def notify_rules_changed():
+    """
+    Tell every process caching alert rules to reload them; call after commit
+    """
+    db.session.execute(text(f"NOTIFY {RULES_CHANGED_CHANNEL}"))
+    db.session.commit()
+
+def _listen_for_rule_changes(engine):
+    """
+    Invalidate the cached alert rules whenever a change is announced
+    """
+    while True:
+        dbapi_conn = None
+        try:
+            conn = engine.raw_connection()
+            conn.detach()
+            dbapi_conn = conn.driver_connection
+            dbapi_conn.autocommit = True
+            
+            cursor = dbapi_conn.cursor()
+            cursor.execute(f"LISTEN {RULES_CHANGED_CHANNEL}")
+            
+            # Changes may have been missed while disconnected
+            RuleWindowCounter.invalidate()
+            
+            while True:
+                if select.select([dbapi_conn], [], [], 60) != ([], [], []):
+                    dbapi_conn.poll()
+                    if dbapi_conn.notifies:
+                        dbapi_conn.notifies.clear()
+                        RuleWindowCounter.invalidate()
+                        
+        except Exception as e:
+            logger.warning(f"Alert rule change listener error: {str(e)}")
+            if dbapi_conn is not None:
+                try:
+                    dbapi_conn.close()
+                except Exception:
+                    pass
+            time.sleep(5)
+
+class FilterQueryError(ValueError):
+    """
+    Raised when an alert rule's filter query cannot be parsed
+    """
+
+# One condition of a filter query, e.g. event_type="ssh_login_failed"
+FilterCondition = namedtuple('FilterCondition', ['field', 'op', 'value'])
+
+# Event columns a filter can name directly; other fields are looked up in
+# the parsed event metadata
+FILTER_COLUMNS = ('event_type', 'source', 'host', 'message')
+
+_FILTER_TOKEN_RE = re.compile(
+    r'\s*(?:(?P<keyword>AND|LIKE)\b|(?P<op>!=|=)|(?P<field>[A-Za-z_][A-Za-z0-9_]*)|"(?P<value>[^"]*)")',
+    re.IGNORECASE
+)
+
+@lru_cache(maxsize=1024)
+def parse_filter_query(filter_query):
+    """
+    Parse a filter query into a tuple of FilterConditions that must all hold
+    
+    The grammar is `condition (AND condition)*` where a condition is
+    `field = "value"`, `field != "value"` or `field LIKE "pattern"`; an empty
+    query matches every event.
+    
+    Raises:
+        FilterQueryError: If the query does not follow the grammar
+    """
+    tokens = []
+    pos = 0
+    query = (filter_query or '').strip()
+    while pos < len(query):
+        match = _FILTER_TOKEN_RE.match(query, pos)
+        if not match:
+            raise FilterQueryError(f"Unexpected input at position {pos}: {query[pos:pos + 20]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'keyword':
+            value = value.upper()
+            kind = 'op' if value == 'LIKE' else value
+        tokens.append((kind, value))
+        pos = match.end()
+    
+    conditions = []
+    i = 0
+    while i < len(tokens):
+        if conditions:
+            if tokens[i][0] != 'AND':
+                raise FilterQueryError(f"Expected AND before {tokens[i][1]!r}")
+            i += 1
+        
+        condition = tokens[i:i + 3]
+        if [kind for kind, _ in condition] != ['field', 'op', 'value']:
+            raise FilterQueryError('Expected a condition of the form field="value"')
+        conditions.append(FilterCondition(condition[0][1], condition[1][1], condition[2][1]))
+        i += 3
+    
+    return tuple(conditions)
+
+def _filter_column(field):
+    if field in FILTER_COLUMNS:
+        return getattr(EventsEnriched, field)
+    return EventsEnriched.event_metadata[field].astext
+
+@lru_cache(maxsize=1024)
+def compile_filter_query(filter_query):
+    """
+    Compile a rule's filter query to a SQLAlchemy predicate on events_enriched
+    
+    Results are cached by query text, so an edited rule simply compiles to a
+    new entry. Values become bound parameters, and the resulting statements
+    share SQLAlchemy's compiled-SQL cache across evaluation cycles.
+    """
+    predicates = []
+    for condition in parse_filter_query(filter_query):
+        column = _filter_column(condition.field)
+        if condition.op == '=':
+            predicates.append(column == condition.value)
+        elif condition.op == '!=':
+            predicates.append(column != condition.value)
+        else:
+            predicates.append(column.like(condition.value))
+    
+    return and_(true(), *predicates)
+
+def _like_regex(pattern):
+    """
+    Translate a SQL LIKE pattern to an anchored regular expression
+    """
+    parts = ('.*' if char == '%' else '.' if char == '_' else re.escape(char) for char in pattern)
+    return re.compile(''.join(parts) + r'\Z', re.DOTALL)
+
+@lru_cache(maxsize=1024)
+def filter_matcher(filter_query):
+    """
+    Build a function testing an enriched event against a filter query in
+    Python, with the same semantics as compile_filter_query
+    
+    The function takes the event's FILTER_COLUMNS values as a dict and its
+    event_metadata.
+    """
+    checks = []
+    for condition in parse_filter_query(filter_query):
+        if condition.op == 'LIKE':
+            checks.append((condition.field, _like_regex(condition.value).match))
+        elif condition.op == '=':
+            checks.append((condition.field, condition.value.__eq__))
+        else:
+            checks.append((condition.field, condition.value.__ne__))
+    
+    def matches(columns, metadata):
+        for field, check in checks:
+            if field in FILTER_COLUMNS:
+                value = columns.get(field)
+            else:
+                value = (metadata or {}).get(field)
+            # NULLs never satisfy a condition in SQL
+            if value is None or not check(str(value)):
+                return False
+        return True
+    
+    return matches
+
+def _rule_filter(rule_id, filter_query, compile_filter):
+    """
+    Compile a stored rule's filter, treating a malformed legacy filter as
+    matching nothing rather than failing the whole evaluation
+    """
+    try:
+        return compile_filter(filter_query)
+    except FilterQueryError as e:
+        logger.warning(f"Alert rule {rule_id} has an invalid filter query: {e}")
+        return None
+
+def _epoch(ts):
+    """
+    Convert an event timestamp to epoch seconds, treating naive values as UTC
+    """
+    if not isinstance(ts, datetime):
+        return time.time()
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+class RuleWindowCounter:
+    """
+    Sliding-window event counts per threshold rule, kept in Redis and updated
+    as events are enriched so rule evaluation doesn't rescan events_enriched
+    """
+    _rules = None
+    _rules_loaded_at = 0.0
+    _rules_lock = threading.Lock()
+    _listener_pid = None
+    
+    def __init__(self, redis_client=None):
+        self.redis = redis_client or current_app.session_manager.redis
+    
+    @classmethod
+    def invalidate(cls):
+        """
+        Drop the cached rules so the next lookup reloads them
+        """
+        cls._rules = None
+    
+    @classmethod
+    def _start_listener(cls):
+        """
+        Start this process's rule change listener; threads don't survive fork,
+        so it is tracked per pid
+        """
+        if cls._listener_pid == os.getpid():
+            return
+        with cls._rules_lock:
+            if cls._listener_pid != os.getpid():
+                threading.Thread(
+                    target=_listen_for_rule_changes,
+                    args=(db.engine,),
+                    name='alert-rule-listener',
+                    daemon=True
+                ).start()
+                cls._listener_pid = os.getpid()
+    
+    @classmethod
+    def _active_rules(cls):
+        """
+        Get (rule id, event matcher, window seconds) for active threshold rules
+        """
+        cls._start_listener()
+        
+        if cls._rules is None or time.monotonic() - cls._rules_loaded_at > RULE_CACHE_TTL:
+            with cls._rules_lock:
+                if cls._rules is None or time.monotonic() - cls._rules_loaded_at > RULE_CACHE_TTL:
+                    rows = db.session.query(
+                        AlertRule.id, AlertRule.filter_query, AlertRule.time_window_minutes
+                    ).filter_by(is_active=True, rule_type='threshold').all()
+                    
+                    rules = []
+                    for rule_id, filter_query, time_window_minutes in rows:
+                        matcher = _rule_filter(rule_id, filter_query, filter_matcher)
+                        if matcher is not None:
+                            rules.append((rule_id, matcher, time_window_minutes * 60))
+                    cls._rules = rules
+                    cls._rules_loaded_at = time.monotonic()
+        
+        return cls._rules
+    
+    def record_events(self, events):
+        """
+        Add enriched events to the windows of the rules they match
+        
+        Args:
+            events: (id, ts, FILTER_COLUMNS values, event_metadata) tuples,
+                plain values so no record is reloaded from the database
+        """
+        rules = self._active_rules()
+        if not rules:
+            return
+        
+        pipe = self.redis.pipeline(transaction=False)
+        for event_id, ts, columns, metadata in events:
+            score = _epoch(ts)
+            for rule_id, matches, window_seconds in rules:
+                if matches(columns, metadata):
+                    key = RULE_WINDOW_KEY.format(rule_id)
+                    pipe.zadd(key, {event_id: score})
+                    pipe.expire(key, window_seconds + RULE_CACHE_TTL)
+        pipe.execute()
+    
+    def count(self, rules):
+        """
+        Trim each rule's window to its time span and return its size
+        
+        Returns:
+            Dictionary mapping rule id to event count
+        """
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for rule in rules:
+            key = RULE_WINDOW_KEY.format(rule.id)
+            pipe.zremrangebyscore(key, '-inf', f'({now - rule.time_window_minutes * 60}')
+            pipe.zcard(key)
+        
+        results = pipe.execute()
+        return {rule.id: results[2 * i + 1] for i, rule in enumerate(rules)}
+
 class AlertEngine:
     def __init__(self):
-        self.email_sender = EmailSender()
+        self.email_sender = get_email_sender()
     
     def evaluate_rules(self):
         """
@@ -20,7 +330,15 @@ class AlertEngine:
         """
         rules = AlertRule.query.filter_by(is_active=True).all()
         
+        # Threshold rules are counted together, one query per time window
+        try:
+            self._evaluate_threshold_rules([rule for rule in rules if rule.rule_type == 'threshold'])
+        except Exception as e:
+            logger.error(f"Error evaluating threshold rules: {str(e)}")
+        
         for rule in rules:
+            if rule.rule_type == 'threshold':
+                continue
             try:
                 self._evaluate_rule(rule)
             except Exception as e:
@@ -31,43 +349,78 @@ class AlertEngine:
         Evaluate a single alert rule
         """
         if rule.rule_type == 'threshold':
-            self._evaluate_threshold_rule(rule)
+            self._evaluate_threshold_rules([rule])
         elif rule.rule_type == 'correlation':
             self._evaluate_correlation_rule(rule)
     
-    def _evaluate_threshold_rule(self, rule):
+    def _evaluate_threshold_rules(self, rules):
         """
-        Evaluate a threshold-based alert rule
+        Evaluate threshold-based alert rules, counting all of them in one pass
+        """
+        if not rules:
+            return
+        
+        now = datetime.now(timezone.utc)
+        start_times = {rule.id: now - timedelta(minutes=rule.time_window_minutes) for rule in rules}
+        event_counts = self._window_event_counts(rules, start_times)
+        
+        triggered = [rule for rule in rules if event_counts[rule.id] >= rule.threshold_count]
+        if not triggered:
+            return
+        
+        # Check if we already alerted recently to avoid spam
+        last_alerted = dict(
+            db.session.query(AlertEvent.rule_id, func.max(AlertEvent.triggered_at))
+            .filter(AlertEvent.rule_id.in_([rule.id for rule in triggered]))
+            .filter(AlertEvent.triggered_at > min(start_times[rule.id] for rule in triggered))
+            .group_by(AlertEvent.rule_id)
+            .all()
+        )
+        
+        for rule in triggered:
+            last = last_alerted.get(rule.id)
+            if last is None or _epoch(last) <= start_times[rule.id].timestamp():
+                self._trigger_alert(rule, event_counts[rule.id])
+    
+    def _window_event_counts(self, rules, start_times):
+        """
+        Get each rule's event count from the Redis windows, falling back to
+        scanning events_enriched when Redis is unavailable
+        
+        Returns:
+            Dictionary mapping rule id to event count
         """
         try:
-            # Build SQL query based on rule filter
-            time_window = timedelta(minutes=rule.time_window_minutes)
-            start_time = datetime.now(timezone.utc) - time_window
-            
-            # Parse filter query and build WHERE clause
-            where_clause = self._build_where_clause(rule.filter_query)
-            
-            query = text(f"""
-                SELECT COUNT(*) as event_count
-                FROM events_enriched 
-                WHERE ts >= :start_time 
-                AND ({where_clause})
-            """)
-            
-            result = db.session.execute(query, {'start_time': start_time}).fetchone()
-            event_count = result.event_count
-            
-            if event_count >= rule.threshold_count:
-                # Check if we already alerted recently to avoid spam
-                recent_alert = AlertEvent.query.filter_by(rule_id=rule.id)\
-                    .filter(AlertEvent.triggered_at > start_time)\
-                    .first()
-                
-                if not recent_alert:
-                    self._trigger_alert(rule, event_count)
-                    
+            return RuleWindowCounter().count(rules)
         except Exception as e:
-            logger.error(f"Error evaluating threshold rule {rule.id}: {str(e)}")
+            logger.warning(f"Falling back to database rule counts: {str(e)}")
+            return self._count_window_events(rules, start_times)
+    
+    def _count_window_events(self, rules, start_times):
+        """
+        Count matching events for every rule in a single pass over the widest
+        window, each rule's count restricted to its own window
+        
+        Args:
+            rules: Threshold rules
+            start_times: Dictionary mapping rule id to its window start
+        
+        Returns:
+            Dictionary mapping rule id to event count
+        """
+        columns = []
+        for i, rule in enumerate(rules):
+            predicate = _rule_filter(rule.id, rule.filter_query, compile_filter_query)
+            if predicate is None:
+                predicate = false()
+            columns.append(
+                func.count().filter(and_(predicate, EventsEnriched.ts >= start_times[rule.id])).label(f'r{i}')
+            )
+        
+        query = db.select(*columns).where(EventsEnriched.ts >= min(start_times.values()))
+        
+        result = db.session.execute(query).fetchone()
+        return {rule.id: result[i] for i, rule in enumerate(rules)}
     
     def _evaluate_correlation_rule(self, rule):
         """
@@ -76,23 +429,6 @@ class AlertEngine:
         """
         logger.info(f"Correlation rule evaluation not yet implemented for rule {rule.id}")
     
-    def _build_where_clause(self, filter_query):
-        """
-        Build SQL WHERE clause from filter query
-        Simple implementation - in production, use a proper query parser
-        """
-        # Basic filter parsing - extend as needed
-        if 'event_type=' in filter_query:
-            # Extract event_type value
-            import re
-            match = re.search(r'event_type="([^"]+)"', filter_query)
-            if match:
-                event_type = match.group(1)
-                return f"event_type = '{event_type}'"
-        
-        # Default fallback
-        return "1=1"
-    
     def _trigger_alert(self, rule, event_count):
         """
         Trigger an alert for a rule
@@ -114,11 +450,9 @@ class AlertEngine:
             db.session.add(alert_event)
             db.session.commit()
             
-            # Send email notification
+            # Queue the email notification for the next digest
             if rule.email_recipients:
-                self._send_alert_email(rule, alert_event)
-                alert_event.email_sent = True
-                db.session.commit()
+                self._queue_alert_email(rule, alert_event)
             
             logger.info(f"Alert triggered for rule {rule.name}: {event_count} events")
             
@@ -126,6 +460,79 @@ class AlertEngine:
             logger.error(f"Error triggering alert for rule {rule.id}: {str(e)}")
             db.session.rollback()
     
+    def _queue_alert_email(self, rule, alert_event):
+        """
+        Queue an alert for flush_alert_emails, sending it straight away if
+        Redis is unavailable
+        """
+        try:
+            current_app.session_manager.redis.rpush(ALERT_EMAIL_QUEUE_KEY, dumps({
+                'alert_id': alert_event.id,
+                'recipients': rule.email_recipients,
+                'rule_name': rule.name,
+                'rule_description': rule.description or '',
+                'threshold': rule.threshold_count,
+                'time_window': rule.time_window_minutes,
+                'event_count': alert_event.event_count,
+                'triggered_at': alert_event.triggered_at
+            }))
+        except Exception as e:
+            logger.warning(f"Could not queue alert email for rule {rule.id}, sending now: {str(e)}")
+            self._send_alert_email(rule, alert_event)
+            alert_event.email_sent = True
+            db.session.commit()
+    
+    def flush_alert_emails(self):
+        """
+        Send queued alert emails, one digest per distinct recipient list
+        
+        Returns:
+            Number of alerts whose email was sent
+        """
+        redis = current_app.session_manager.redis
+        sent = 0
+        
+        while True:
+            # Take a batch atomically so concurrent flushes never send twice
+            pipe = redis.pipeline()
+            pipe.lrange(ALERT_EMAIL_QUEUE_KEY, 0, ALERT_EMAIL_BATCH_SIZE - 1)
+            pipe.ltrim(ALERT_EMAIL_QUEUE_KEY, ALERT_EMAIL_BATCH_SIZE, -1)
+            entries = pipe.execute()[0]
+            if not entries:
+                return sent
+            
+            digests = {}
+            for entry in entries:
+                alert = loads(entry)
+                digests.setdefault(tuple(sorted(alert['recipients'])), []).append((entry, alert))
+            
+            sent_ids = []
+            failed = []
+            for recipients, queued in digests.items():
+                alerts = [alert for _, alert in queued]
+                if self.email_sender.send_alert_emails(list(recipients), alerts):
+                    sent_ids.extend(alert['alert_id'] for alert in alerts)
+                else:
+                    logger.error(f"Could not send alert email for {len(alerts)} alerts to {list(recipients)}")
+                    failed.extend(entry for entry, _ in queued)
+            
+            # Digests that could not be sent go back on the queue for the
+            # next flush rather than being lost with the batch
+            if failed:
+                redis.rpush(ALERT_EMAIL_QUEUE_KEY, *failed)
+            
+            if sent_ids:
+                db.session.execute(
+                    update(AlertEvent).where(AlertEvent.id.in_(sent_ids)).values(email_sent=True)
+                )
+                db.session.commit()
+                sent += len(sent_ids)
+            
+            # Stop once the queue is drained, or on a failure so the entries
+            # just requeued are not retried straight away
+            if failed or len(entries) < ALERT_EMAIL_BATCH_SIZE:
+                return sent
+    
     def _send_alert_email(self, rule, alert_event):
         """
         Send email notification for alert
@@ -161,6 +568,9 @@ class AlertEngine:
         """
         Create a new alert rule
         """
+        # Reject malformed filters now rather than when the rule fires
+        parse_filter_query(filter_query)
+        
         try:
             rule = AlertRule(
                 name=name,
@@ -175,6 +585,7 @@ class AlertEngine:
             
             db.session.add(rule)
             db.session.commit()
+            notify_rules_changed()
             
             logger.info(f"Created alert rule: {name}")
             return rule
@@ -190,6 +601,7 @@ class AlertEngine:
         """
         return AlertEvent.query\
             .join(AlertRule)\
+            .options(contains_eager(AlertEvent.rule))\
             .order_by(AlertEvent.triggered_at.desc())\
             .limit(limit)\
             .all()
@@ -1,77 +1,265 @@
+import io
+import os
 import json
+import time
+import queue
 import logging
-from datetime import datetime, timezone
+import threading
+from concurrent.futures import Future
 from flask import request, jsonify, current_app
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import delete, insert, select, text
 from app import db
-from models import EventsRaw
+from models import EventsRaw, RawPublishOutbox
+from services.rabbitmq_client import RabbitMQClient, raw_routing_key
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 logger = logging.getLogger(__name__)
 
+# Batches at least this large are loaded with COPY instead of INSERT
+COPY_THRESHOLD = 100
+
+# Events waiting to be written, the most that may be queued or in flight
+# before agents are told to back off, and how the writer threads batch them
+INGEST_QUEUE_MAX = int(os.environ.get('INGEST_QUEUE_MAX', '10000'))
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', '2'))
+INGEST_BATCH_SIZE = 1000
+INGEST_FLUSH_INTERVAL = 0.1
+
+# Attempts at storing a batch, the delay before the first retry (doubling
+# after each), and how long a request waits for its events to be stored
+INGEST_STORE_ATTEMPTS = 3
+INGEST_RETRY_BACKOFF = 0.2
+INGEST_STORE_TIMEOUT = float(os.environ.get('INGEST_STORE_TIMEOUT', '30'))
+
+# (rows, future) per request; the future resolves once the rows are committed
+_ingest_q = queue.Queue()
+_queued_rows = 0
+
+# Stored (outbox_id, event_ids, rows) batches waiting to be published to
+# RabbitMQ for parsing and enrichment, and how often publishing a batch is
+# retried before it is left to the republish sweep
+_publish_q = queue.Queue()
+PUBLISH_ATTEMPTS = 3
+
+# Outbox entries older than this are republished by the sweep, and how many
+# it handles per run
+REPUBLISH_MIN_AGE = 300
+REPUBLISH_BATCH_SIZE = 100
+_ingest_lock = threading.Lock()
+_ingest_workers_pid = None
+
+def _dumps(obj):
+    """
+    Serialize a payload to a JSON string, using orjson when available
+    """
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+def _copy_field(value):
+    """
+    Escape a value for PostgreSQL's text COPY format
+    """
+    if value is None:
+        return '\\N'
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
 class IngestionService:
     def __init__(self):
-        pass  # Simplified for demo - removed RabbitMQ dependency
+        pass
     
     def ingest_event(self, data):
         """
-        Ingest a raw event from an agent
+        Queue a raw event from an agent for the background writers
+        """
+        return self.enqueue_events([data])
+    
+    def enqueue_events(self, events_data):
+        """
+        Validate events and have the background writers store them
+        
+        The writers batch rows from concurrent requests into one commit; the
+        request waits for its rows to be committed. Returns 202 once they are
+        stored, or 503 when the queue is full or storing failed so the agent
+        retries later.
         """
+        global _queued_rows
+        
+        rows, error = self._build_rows(events_data)
+        if error:
+            return error
+        
+        _start_ingest_workers(current_app._get_current_object())
+        
+        stored = Future()
+        with _ingest_lock:
+            if _queued_rows + len(rows) > INGEST_QUEUE_MAX:
+                return {'error': 'Ingestion queue full, retry later'}, 503
+            _queued_rows += len(rows)
+            _ingest_q.put_nowait((rows, stored))
+        
         try:
+            stored.result(timeout=INGEST_STORE_TIMEOUT)
+        except Exception as e:
+            logger.warning("Could not store %d events: %s", len(rows), e)
+            return {'error': 'Events could not be stored, retry later'}, 503
+        
+        return {'message': 'Events accepted', 'count': len(rows)}, 202
+    
+    def _build_rows(self, events_data):
+        """
+        Validate agent events and turn them into events_raw rows
+        
+        Returns:
+            (rows, None) or (None, (error_body, status_code))
+        """
+        rows = []
+        
+        for data in events_data:
             # Validate required fields
             payload = data.get('payload', {})
             raw_content = payload.get('raw') if payload else data.get('raw')
             
             if not data.get('source') or not raw_content:
-                return {'error': 'Missing required fields: source, payload.raw'}, 400
+                return None, ({'error': 'Missing required fields: source, payload.raw'}, 400)
             
-            # Create raw event record
-            raw_event = EventsRaw(
-                received_at=datetime.now(timezone.utc),
-                source=data['source'],
-                host=data.get('host', 'unknown'),
-                payload=data.get('payload', {
+            # received_at is stamped by the database default
+            rows.append({
+                'source': data['source'],
+                'host': data.get('host', 'unknown'),
+                'payload': data.get('payload', {
                     'timestamp': data.get('timestamp'),
                     'raw': raw_content,
                     'agent_info': data.get('agent_info', {})
                 })
+            })
+        
+        if not rows:
+            return None, ({'error': 'Empty request body'}, 400)
+        
+        return rows, None
+    
+    def _store_rows(self, rows):
+        """
+        Write validated rows to events_raw in one transaction, recording the
+        batch in raw_publish_outbox until it has been published
+        
+        The commit keeps full durability: the request is acknowledged once
+        it returns, and agents do not resend acknowledged batches.
+        
+        Returns:
+            (list of new event ids, outbox entry id)
+        """
+        # Create raw event records
+        if len(rows) >= COPY_THRESHOLD:
+            event_ids = self._copy_raw_events(rows)
+        else:
+            event_ids = db.session.execute(
+                insert(EventsRaw).returning(EventsRaw.id, sort_by_parameter_order=True),
+                rows
+            ).scalars().all()
+        outbox_id = db.session.execute(
+            insert(RawPublishOutbox).values(raw_ids=list(event_ids)).returning(RawPublishOutbox.id)
+        ).scalar_one()
+        db.session.commit()
+        
+        return event_ids, outbox_id
+    
+    def _copy_raw_events(self, rows):
+        """
+        Bulk load raw events with COPY inside the session's transaction
+        
+        Ids are reserved from the table's sequence up front so the events can
+        still be handed to parsing and enrichment.
+        """
+        event_ids = db.session.execute(text("""
+            SELECT nextval(pg_get_serial_sequence('events_raw', 'id'))
+            FROM generate_series(1, :count)
+        """), {'count': len(rows)}).scalars().all()
+        
+        buf = io.StringIO()
+        for event_id, row in zip(event_ids, rows):
+            buf.write('\t'.join((
+                str(event_id),
+                _copy_field(row['source']),
+                _copy_field(row['host']),
+                _copy_field(_dumps(row['payload']))
+            )))
+            buf.write('\n')
+        buf.seek(0)
+        
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                "COPY events_raw (id, source, host, payload) FROM STDIN",
+                buf
             )
-            
-            db.session.add(raw_event)
-            db.session.commit()
-            
-            # Process event synchronously for demo (in production, use message queue)
-            try:
-                from services.parser import EventParser
-                from services.enrichment import EnrichmentService
-                
-                # Parse the event
-                parser = EventParser()
-                parsed_event = parser.parse_message({
-                    'raw_id': raw_event.id,
-                    'source': raw_event.source,
-                    'host': raw_event.host,
-                    'payload': raw_event.payload
-                })
-                normalized_event = parser.normalize_fields(parsed_event)
-                normalized_event['source'] = raw_event.source
-                normalized_event['host'] = raw_event.host
-                
-                # Enrich the event
-                enrichment_service = EnrichmentService()
-                enrichment_service.enrich_event(raw_event.id, normalized_event)
-                
-                logger.info(f"Processed and enriched event {raw_event.id}")
-                
-            except Exception as e:
-                logger.warning(f"Error processing event {raw_event.id}: {str(e)}")
-            
-            logger.info(f"Ingested event {raw_event.id} from {raw_event.source}")
-            
-            return {'message': 'Event ingested successfully', 'event_id': raw_event.id}, 201
-            
-        except Exception as e:
-            logger.error(f"Error ingesting event: {str(e)}")
-            db.session.rollback()
-            return {'error': 'Failed to ingest event'}, 500
+        finally:
+            cursor.close()
+        
+        return event_ids
+    
+    def _publish_events(self, rabbitmq, event_ids, rows):
+        """
+        Hand stored raw events to the RabbitMQ consumers for parsing and
+        enrichment
+        """
+        rabbitmq.publish_messages('logs.raw', [
+            (raw_routing_key(row['source']), {
+                'raw_id': event_id,
+                'source': row['source'],
+                'host': row['host'],
+                'payload': row['payload']
+            })
+            for event_id, row in zip(event_ids, rows)
+        ])
+    
+    def _mark_published(self, outbox_id):
+        """
+        Drop a batch's outbox entry once its events are published
+        """
+        db.session.execute(delete(RawPublishOutbox).where(RawPublishOutbox.id == outbox_id))
+        db.session.commit()
+    
+    def republish_pending(self, rabbitmq):
+        """
+        Publish stored batches whose publishing failed or was cut short by a
+        restart, as recorded in raw_publish_outbox
+        
+        Returns:
+            Number of events republished
+        """
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=REPUBLISH_MIN_AGE)
+        entries = db.session.execute(
+            select(RawPublishOutbox)
+            .where(RawPublishOutbox.received_at < cutoff)
+            .order_by(RawPublishOutbox.id)
+            .limit(REPUBLISH_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        ).scalars().all()
+        
+        republished = 0
+        for entry in entries:
+            # The batch's rows share its received_at, which prunes the lookup
+            # to one partition
+            rows = db.session.execute(
+                select(EventsRaw.id, EventsRaw.source, EventsRaw.host, EventsRaw.payload)
+                .where(EventsRaw.received_at == entry.received_at, EventsRaw.id.in_(entry.raw_ids))
+            ).all()
+            if rows:
+                self._publish_events(rabbitmq, [row.id for row in rows], [row._asdict() for row in rows])
+                republished += len(rows)
+            db.session.delete(entry)
+        
+        db.session.commit()
+        return republished
     
     def get_ingestion_stats(self):
         """
@@ -81,13 +269,15 @@ class IngestionService:
             # Events in last 24 hours
             from sqlalchemy import func, text
             
+            # Per-minute counters from mv_ingestion_stats, refreshed by the
+            # refresh_ingestion_stats task
             result = db.session.execute(text("""
                 SELECT 
                     source,
-                    COUNT(*) as count,
-                    MAX(received_at) as last_received
-                FROM events_raw 
-                WHERE received_at > NOW() - INTERVAL '24 hours'
+                    SUM(count) as count,
+                    MAX(last_received) as last_received
+                FROM mv_ingestion_stats 
+                WHERE m > NOW() - INTERVAL '24 hours'
                 GROUP BY source
                 ORDER BY count DESC
             """)).fetchall()
@@ -96,7 +286,7 @@ class IngestionService:
             for row in result:
                 stats.append({
                     'source': row.source,
-                    'count': row.count,
+                    'count': int(row.count),
                     'last_received': row.last_received.isoformat() if row.last_received else None
                 })
             
@@ -106,6 +296,137 @@ class IngestionService:
             logger.error(f"Error getting ingestion stats: {str(e)}")
             return {'error': 'Failed to get stats'}, 500
 
+def _store_with_retry(service, rows, attempts=INGEST_STORE_ATTEMPTS):
+    """
+    Store rows, retrying with backoff; raises the last error if every
+    attempt fails
+    """
+    for attempt in range(attempts):
+        try:
+            return service._store_rows(rows)
+        except Exception as e:
+            db.session.rollback()
+            if attempt + 1 == attempts:
+                raise
+            logger.warning("Error storing %d queued events (attempt %d): %s", len(rows), attempt + 1, e)
+            time.sleep(INGEST_RETRY_BACKOFF * 2 ** attempt)
+
+def _store_batch(service, batch):
+    """
+    Store a batch of queued requests and resolve their futures
+    
+    If the batch as a whole keeps failing, each request is stored on its own
+    so one bad request only fails itself.
+    """
+    rows = [row for request_rows, _ in batch for row in request_rows]
+    try:
+        event_ids, outbox_id = _store_with_retry(service, rows)
+    except Exception as e:
+        logger.error(f"Error storing {len(rows)} queued events: {e}")
+        if len(batch) == 1:
+            batch[0][1].set_exception(e)
+            return
+        
+        for request_rows, stored in batch:
+            try:
+                event_ids, outbox_id = _store_with_retry(service, request_rows, attempts=1)
+            except Exception as e:
+                stored.set_exception(e)
+                continue
+            stored.set_result(len(event_ids))
+            _publish_q.put((outbox_id, event_ids, request_rows))
+        return
+    
+    logger.info("Ingested %d queued events", len(rows))
+    for _, stored in batch:
+        stored.set_result(len(event_ids))
+    _publish_q.put((outbox_id, event_ids, rows))
+
+def _drain_ingest_queue(app):
+    """
+    Writer thread: batch queued requests by size or age and store each batch
+    """
+    global _queued_rows
+    service = IngestionService()
+    
+    while True:
+        batch = [_ingest_q.get()]
+        count = len(batch[0][0])
+        deadline = time.monotonic() + INGEST_FLUSH_INTERVAL
+        
+        while count < INGEST_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_ingest_q.get(timeout=remaining))
+            except queue.Empty:
+                break
+            count += len(batch[-1][0])
+        
+        try:
+            with app.app_context():
+                _store_batch(service, batch)
+        except Exception as e:
+            logger.error(f"Error storing {count} queued events: {e}")
+            for _, stored in batch:
+                if not stored.done():
+                    stored.set_exception(e)
+        finally:
+            with _ingest_lock:
+                _queued_rows -= count
+
+def _publish_stored_events(app):
+    """
+    Publisher thread: send batches the writers have stored to RabbitMQ
+    """
+    service = IngestionService()
+    rabbitmq = None
+    
+    while True:
+        outbox_id, event_ids, rows = _publish_q.get()
+        for attempt in range(PUBLISH_ATTEMPTS):
+            try:
+                with app.app_context():
+                    if rabbitmq is None:
+                        rabbitmq = RabbitMQClient()
+                    service._publish_events(rabbitmq, event_ids, rows)
+                break
+            except Exception as e:
+                logger.warning("Error publishing %d stored events (attempt %d): %s", len(event_ids), attempt + 1, e)
+                rabbitmq = None
+                time.sleep(1)
+        else:
+            logger.error("Could not publish %d stored events after %d attempts; leaving them to the republish sweep",
+                         len(event_ids), PUBLISH_ATTEMPTS)
+            continue
+        
+        with app.app_context():
+            try:
+                service._mark_published(outbox_id)
+            except Exception as e:
+                # The sweep will publish the batch again; duplicates beat loss
+                logger.warning("Could not clear outbox entry %s: %s", outbox_id, e)
+                db.session.rollback()
+
+def _start_ingest_workers(app):
+    """
+    Start the writer and publisher threads once per process (gunicorn
+    forks after import)
+    """
+    global _ingest_workers_pid
+    
+    if _ingest_workers_pid == os.getpid():
+        return
+    
+    with _ingest_lock:
+        if _ingest_workers_pid == os.getpid():
+            return
+        for _ in range(INGEST_WORKERS):
+            threading.Thread(target=_drain_ingest_queue, args=(app,), daemon=True).start()
+        threading.Thread(target=_publish_stored_events, args=(app,), daemon=True).start()
+        _ingest_workers_pid = os.getpid()
+
 def authenticate_agent(token):
     """
     Authenticate agent API token
@@ -1,40 +1,310 @@
-import json
 import re
+import time
 import yaml
 import logging
+from functools import lru_cache
 from datetime import datetime, timezone
 from pathlib import Path
+from utils.json_utils import loads
 
 logger = logging.getLogger(__name__)
 
+# RE2 matches in linear time with a DFA; the grok patterns use no
+# backreferences or lookaround, so it can run them unchanged
+try:
+    import re2
+    RE2_AVAILABLE = True
+except ImportError:
+    RE2_AVAILABLE = False
+
+# Arrow runs a regex over a whole batch of messages in one C++ call
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+# Smallest batch parse_messages hands to Arrow; below this building the
+# arrays costs more than it saves
+ARROW_MIN_BATCH = 32
+
+# How long the current time may be reused for events without a usable
+# timestamp, and the cached (time.time(), datetime) pair
+NOW_RESOLUTION = 0.25
+_now_cache = [0.0, None]
+
+def _now_utc():
+    """
+    Current UTC time, refreshed at most every NOW_RESOLUTION seconds
+    """
+    t = time.time()
+    if t - _now_cache[0] > NOW_RESOLUTION:
+        _now_cache[:] = [t, datetime.fromtimestamp(t, timezone.utc)]
+    return _now_cache[1]
+
+# Formats tried, in order, for timestamps that aren't ISO 8601 UTC
+TIMESTAMP_FORMATS = [
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%d %H:%M:%S',
+    '%b %d %H:%M:%S',  # syslog format
+    '%d/%b/%Y:%H:%M:%S %z',  # Apache format
+]
+
+MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+def _parse_syslog_timestamp(timestamp_str, year):
+    """
+    Parse a syslog "Jan  5 10:00:00" timestamp by slicing, or return None
+    if it isn't one
+    """
+    parts = timestamp_str.split()
+    if len(parts) != 3 or len(parts[2]) != 8:
+        return None
+    
+    month = MONTHS.get(parts[0])
+    clock = parts[2]
+    if month is None or not parts[1].isdigit() or clock[2] != ':' or clock[5] != ':':
+        return None
+    
+    try:
+        return datetime(year, month, int(parts[1]), int(clock[:2]), int(clock[3:5]), int(clock[6:]),
+                        tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=4096)
+def _parse_timestamp_str(timestamp_str, year):
+    """
+    Parse a timestamp string, or return None if no format matches
+    
+    Events in the same second share a timestamp string, so results are
+    cached rather than re-running the strptime ladder for each one.
+    """
+    # Fast path for the common ISO 8601 UTC form, e.g. 2024-01-31T12:00:00Z
+    if len(timestamp_str) == 20 and timestamp_str.endswith('Z'):
+        try:
+            return datetime.fromisoformat(timestamp_str[:-1]).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    
+    parsed = _parse_syslog_timestamp(timestamp_str, year)
+    if parsed is not None:
+        return parsed
+    
+    # Only unusual inputs get as far as strptime
+    for fmt in TIMESTAMP_FORMATS:
+        value = timestamp_str
+        try:
+            if fmt == '%b %d %H:%M:%S':
+                # Add current year for syslog format
+                value = f"{year} {timestamp_str}"
+                fmt = '%Y %b %d %H:%M:%S'
+            
+            parsed = datetime.strptime(value, fmt)
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+            return parsed
+        except ValueError:
+            continue
+    
+    logger.warning("Could not parse timestamp: %s", timestamp_str)
+    return None
+
+@lru_cache(maxsize=64)
+def _compile_pattern(pattern):
+    """
+    Compile a combined grok pattern, shared by every EventParser so extra
+    instances don't recompile it
+    
+    Uses RE2 when it is installed, falling back to re for patterns it rejects.
+    """
+    if RE2_AVAILABLE:
+        try:
+            return re2.compile(pattern)
+        except Exception as e:
+            logger.warning("RE2 could not compile pattern, using re: %s", e)
+    return re.compile(pattern)
+
+# Common field names and the names events are stored with
+FIELD_MAPPINGS = {
+    'user': 'username',
+    'source_ip': 'src_ip',
+    'dest_ip': 'dst_ip',
+    'source_port': 'src_port',
+    'dest_port': 'dst_port'
+}
+_FIELD_MAP_ITEMS = tuple(FIELD_MAPPINGS.items())
+_MISSING = object()
+
+def _normalize_field_names(fields):
+    """
+    Rename common field names in place
+    """
+    for old_name, new_name in _FIELD_MAP_ITEMS:
+        value = fields.pop(old_name, _MISSING)
+        if value is not _MISSING:
+            fields[new_name] = value
+
+# Named groups inside a grok pattern
+_GROUP_NAME_RE = re.compile(r'\(\?P<(\w+)>')
+
 class EventParser:
     def __init__(self):
         self.patterns = self._load_grok_patterns()
+        # Field names of each pattern in group order, normalized; fields are
+        # read positionally, so patterns may only capture with named groups
+        self.pattern_fields = {}
+        for pattern_name, pattern_config in self.patterns.items():
+            fields = _GROUP_NAME_RE.findall(pattern_config['pattern'])
+            if re.compile(pattern_config['pattern']).groups != len(fields):
+                raise ValueError(f"Grok pattern {pattern_name} has unnamed capture groups")
+            self.pattern_fields[pattern_name] = tuple(FIELD_MAPPINGS.get(field, field) for field in fields)
+        # Combined patterns keyed by the names of the patterns they contain
+        self._combined_patterns = {}
     
     def _load_grok_patterns(self):
         """
         Load Grok-like parsing patterns from configuration
+        
+        Patterns are anchored at the start of the message so a non-matching
+        line fails at offset 0 instead of being retried at every position.
+        Syslog lines may carry a leading <PRI> field.
+        
+        A pattern is only tried on messages containing every literal in its
+        prefilter; substring checks are far cheaper than running the regex.
         """
         patterns = {
             'ssh_failed': {
-                'pattern': r'(?P<timestamp>\w{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2})\s+(?P<host>\S+)\s+sshd\[\d+\]:\s+Failed password for (?P<user>\S+) from (?P<src_ip>\d+\.\d+\.\d+\.\d+)',
+                'pattern': r'^(?:<\d+>)?(?P<timestamp>\w{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2})\s+(?P<host>\S+)\s+sshd\[\d+\]:\s+Failed password for (?P<user>\S+) from (?P<src_ip>\d+\.\d+\.\d+\.\d+)',
+                'prefilter': ('sshd[', 'Failed password'),
                 'event_type': 'ssh_login_failed'
             },
             'ssh_success': {
-                'pattern': r'(?P<timestamp>\w{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2})\s+(?P<host>\S+)\s+sshd\[\d+\]:\s+Accepted password for (?P<user>\S+) from (?P<src_ip>\d+\.\d+\.\d+\.\d+)',
+                'pattern': r'^(?:<\d+>)?(?P<timestamp>\w{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2})\s+(?P<host>\S+)\s+sshd\[\d+\]:\s+Accepted password for (?P<user>\S+) from (?P<src_ip>\d+\.\d+\.\d+\.\d+)',
+                'prefilter': ('sshd[', 'Accepted password'),
                 'event_type': 'ssh_login_success'
             },
             'apache_access': {
-                'pattern': r'(?P<src_ip>\d+\.\d+\.\d+\.\d+)\s+-\s+-\s+\[(?P<timestamp>[^\]]+)\]\s+"(?P<method>\S+)\s+(?P<url>\S+)\s+HTTP/[^"]+"\s+(?P<status>\d+)\s+(?P<size>\d+)',
+                'pattern': r'^(?P<src_ip>\d+\.\d+\.\d+\.\d+)\s+-\s+-\s+\[(?P<timestamp>[^\]]+)\]\s+"(?P<method>\S+)\s+(?P<url>\S+)\s+HTTP/[^"]+"\s+(?P<status>\d+)\s+(?P<size>\d+)',
+                'prefilter': ('HTTP/',),
                 'event_type': 'web_access'
             },
             'syslog_generic': {
-                'pattern': r'(?P<timestamp>\w{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2})\s+(?P<host>\S+)\s+(?P<process>\S+):\s+(?P<message>.*)',
+                'pattern': r'^(?:<\d+>)?(?P<timestamp>\w{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2})\s+(?P<host>\S+)\s+(?P<process>\S+):\s+(?P<message>.*)',
+                'prefilter': (),
                 'event_type': 'syslog'
             }
         }
         return patterns
     
+    def _combine_patterns(self, pattern_names):
+        """
+        Compile patterns into one alternation so a message is scanned once
+        
+        Each pattern becomes a branch named after it, and its fields are
+        renamed <pattern>__<field> to keep group names unique. Returns the
+        compiled pattern and, per branch, its name, the index of its outer
+        group in match.groups() and its field names; the branch's fields
+        follow its outer group.
+        """
+        branches = []
+        for pattern_name in pattern_names:
+            branch = _GROUP_NAME_RE.sub(rf'(?P<{pattern_name}__\1>', self.patterns[pattern_name]['pattern'])
+            branches.append(f'(?P<{pattern_name}>{branch})')
+        
+        combined = _compile_pattern('|'.join(branches))
+        return combined, [
+            (pattern_name, combined.groupindex[pattern_name] - 1, self.pattern_fields[pattern_name])
+            for pattern_name in pattern_names
+        ]
+    
+    def _candidate_pattern(self, raw_text):
+        """
+        Get the combined pattern of every grok pattern whose prefilter
+        literals all appear in raw_text, and its branches as returned by
+        _combine_patterns; (None, []) if there are none
+        """
+        pattern_names = tuple(
+            pattern_name for pattern_name, pattern_config in self.patterns.items()
+            if all(token in raw_text for token in pattern_config['prefilter'])
+        )
+        if not pattern_names:
+            return None, []
+        
+        combined = self._combined_patterns.get(pattern_names)
+        if combined is None:
+            combined = self._combined_patterns[pattern_names] = self._combine_patterns(pattern_names)
+        return combined
+    
+    def parse_messages(self, raw_messages):
+        """
+        Parse a batch of raw messages, as parse_message does for one
+        
+        With pyarrow installed, each grok pattern is run over all remaining
+        unmatched lines in a single vectorized call; JSON, non-text and
+        unmatched messages go through parse_message.
+        
+        Returns:
+            List of parsed events, in input order
+        """
+        if not PYARROW_AVAILABLE or len(raw_messages) < ARROW_MIN_BATCH:
+            return [self.parse_message(raw_message) for raw_message in raw_messages]
+        
+        results = [None] * len(raw_messages)
+        pending = []
+        texts = []
+        for i, raw_message in enumerate(raw_messages):
+            payload = raw_message.get('payload') if isinstance(raw_message, dict) else None
+            raw_text = payload.get('raw', '') if isinstance(payload, dict) else None
+            if isinstance(raw_text, str) and raw_text.lstrip()[:1] not in ('{', '['):
+                pending.append(i)
+                texts.append(raw_text)
+        
+        # Patterns are tried in order, each over the lines none of the
+        # earlier ones matched, giving the same result as the alternation.
+        # The texts are converted to Arrow once; each pattern runs over the
+        # rows of it still unmatched, picked out with take
+        arr = pa.array(texts, type=pa.string())
+        rows = list(range(len(texts)))
+        for pattern_name, pattern_config in self.patterns.items():
+            if not rows:
+                break
+            
+            remaining = arr if len(rows) == len(texts) else arr.take(pa.array(rows, type=pa.int64()))
+            mask = None
+            for token in pattern_config['prefilter']:
+                token_mask = pc.match_substring(remaining, token)
+                mask = token_mask if mask is None else pc.and_(mask, token_mask)
+            
+            extracted = pc.extract_regex(remaining, pattern=pattern_config['pattern'])
+            if mask is not None:
+                extracted = pc.if_else(mask, extracted, pa.scalar(None, type=extracted.type))
+            
+            event_type = pattern_config['event_type']
+            still_rows = []
+            for row, groups in zip(rows, extracted.to_pylist()):
+                if groups is None:
+                    still_rows.append(row)
+                    continue
+                
+                fields = {FIELD_MAPPINGS.get(field, field): value for field, value in groups.items()}
+                results[pending[row]] = {
+                    'event_type': event_type,
+                    'timestamp': self._parse_timestamp(fields.get('timestamp')),
+                    'fields': fields,
+                    'message': texts[row]
+                }
+            rows = still_rows
+        
+        for i, raw_message in enumerate(raw_messages):
+            if results[i] is None:
+                results[i] = self.parse_message(raw_message)
+        return results
+    
     def parse_message(self, raw_message):
         """
         Parse a raw message and extract structured data
@@ -43,107 +313,96 @@ class EventParser:
             payload = raw_message['payload']
             raw_text = payload.get('raw', '')
             
-            # Try to parse as JSON first
-            if self._is_json(raw_text):
-                parsed_data = json.loads(raw_text)
+            # Try to parse as JSON first; only text that opens like JSON is
+            # worth handing to the decoder, and it is decoded just once
+            parsed_data = None
+            stripped = raw_text.lstrip()
+            if stripped and stripped[0] in '{[':
+                try:
+                    parsed_data = loads(raw_text)
+                except ValueError:
+                    pass
+            
+            if isinstance(parsed_data, dict):
+                _normalize_field_names(parsed_data)
                 return {
                     'event_type': parsed_data.get('event_type', 'json_event'),
                     'timestamp': self._parse_timestamp(parsed_data.get('timestamp')),
                     'fields': parsed_data,
-                    'message': str(parsed_data)
+                    'message': raw_text
                 }
             
-            # Try grok patterns
-            for pattern_name, pattern_config in self.patterns.items():
-                match = re.search(pattern_config['pattern'], raw_text)
-                if match:
-                    fields = match.groupdict()
-                    return {
-                        'event_type': pattern_config['event_type'],
-                        'timestamp': self._parse_timestamp(fields.get('timestamp')),
-                        'fields': fields,
-                        'message': raw_text
-                    }
+            # Try grok patterns; the matched branch is the one whose outer
+            # group took part in the match
+            combined, branches = self._candidate_pattern(raw_text)
+            match = combined.match(raw_text) if combined else None
+            if match:
+                groups = match.groups()
+                for pattern_name, index, field_names in branches:
+                    if groups[index] is not None:
+                        break
+                fields = dict(zip(field_names, groups[index + 1:index + 1 + len(field_names)]))
+                return {
+                    'event_type': self.patterns[pattern_name]['event_type'],
+                    'timestamp': self._parse_timestamp(fields.get('timestamp')),
+                    'fields': fields,
+                    'message': raw_text
+                }
             
             # Fallback to generic parsing
             return {
                 'event_type': 'unknown',
-                'timestamp': datetime.now(timezone.utc),
+                'timestamp': _now_utc(),
                 'fields': {'raw': raw_text},
                 'message': raw_text
             }
             
         except Exception as e:
-            logger.error(f"Error parsing message: {str(e)}")
+            logger.error("Error parsing message: %s", e)
             return {
                 'event_type': 'parse_error',
-                'timestamp': datetime.now(timezone.utc),
+                'timestamp': _now_utc(),
                 'fields': {'error': str(e), 'raw': raw_message.get('payload', {}).get('raw', '')},
                 'message': f"Parse error: {str(e)}"
             }
     
-    def _is_json(self, text):
-        """
-        Check if text is valid JSON
-        """
-        try:
-            json.loads(text)
-            return True
-        except (ValueError, TypeError):
-            return False
-    
     def _parse_timestamp(self, timestamp_str):
         """
         Parse various timestamp formats
         """
         if not timestamp_str:
-            return datetime.now(timezone.utc)
-        
-        # Try different timestamp formats
-        formats = [
-            '%Y-%m-%dT%H:%M:%SZ',
-            '%Y-%m-%d %H:%M:%S',
-            '%b %d %H:%M:%S',  # syslog format
-            '%d/%b/%Y:%H:%M:%S %z',  # Apache format
-        ]
-        
-        for fmt in formats:
-            try:
-                if fmt == '%b %d %H:%M:%S':
-                    # Add current year for syslog format
-                    timestamp_str = f"{datetime.now().year} {timestamp_str}"
-                    fmt = '%Y %b %d %H:%M:%S'
-                
-                parsed = datetime.strptime(timestamp_str, fmt)
-                if parsed.tzinfo is None:
-                    parsed = parsed.replace(tzinfo=timezone.utc)
-                return parsed
-            except ValueError:
-                continue
+            return _now_utc()
         
-        # If all else fails, return current time
-        logger.warning(f"Could not parse timestamp: {timestamp_str}")
-        return datetime.now(timezone.utc)
+        # The year is part of the key so year-less syslog timestamps cached
+        # in December aren't reused in January
+        parsed = _parse_timestamp_str(timestamp_str, _now_utc().year)
+        if parsed is None:
+            # If all else fails, return current time
+            return _now_utc()
+        return parsed
     
     def normalize_fields(self, parsed_event):
         """
-        Normalize field names and values
-        """
-        normalized = parsed_event.copy()
-        fields = normalized.get('fields', {})
-        
-        # Normalize common field names
-        field_mappings = {
-            'user': 'username',
-            'source_ip': 'src_ip',
-            'dest_ip': 'dst_ip',
-            'source_port': 'src_port',
-            'dest_port': 'dst_port'
-        }
-        
-        for old_name, new_name in field_mappings.items():
-            if old_name in fields:
-                fields[new_name] = fields.pop(old_name)
+        Normalize field names in place
         
-        normalized['fields'] = fields
-        return normalized
+        parse_message already returns normalized fields, so this is only
+        needed for events built elsewhere.
+        """
+        _normalize_field_names(parsed_event.get('fields', {}))
+        return parsed_event
+
+# Global instance; the parser holds only compiled patterns and is safe to
+# share between threads
+_parser_instance = None
+
+def get_event_parser() -> EventParser:
+    """
+    Get a singleton instance of EventParser
+    
+    Returns:
+        EventParser instance
+    """
+    global _parser_instance
+    if _parser_instance is None:
+        _parser_instance = EventParser()
+    return _parser_instance
@@ -1,14 +1,35 @@
 import pika
-import json
 import logging
 from flask import current_app
+from utils.json_utils import dumps
 
 logger = logging.getLogger(__name__)
 
+# Log sources with their own raw queue; anything else goes to q.raw.unknown
+RAW_SOURCE_QUEUES = ['syslog', 'apache', 'ssh', 'firewall']
+
+# Every queue bound to logs.raw, each of which needs a consumer
+RAW_QUEUES = [f'q.raw.{source}' for source in RAW_SOURCE_QUEUES] + ['q.raw.unknown']
+
+# Raw deliveries that could not be decoded, kept for inspection instead of
+# being redelivered forever
+DEAD_LETTER_QUEUE = 'q.raw.dead'
+
+# Unacknowledged deliveries a consumer holds by default; one at a time
+# would cost a broker round trip per message
+CONSUMER_PREFETCH = 256
+
+def raw_routing_key(source):
+    """
+    Routing key on the logs.raw exchange for events from a source
+    """
+    return f"raw.{source if source in RAW_SOURCE_QUEUES else 'unknown'}"
+
 class RabbitMQClient:
     def __init__(self):
         self.connection = None
         self.channel = None
+        self.publish_channel = None
         self._connect()
     
     def _connect(self):
@@ -20,6 +41,7 @@ class RabbitMQClient:
             connection_params = pika.URLParameters(rabbitmq_url)
             self.connection = pika.BlockingConnection(connection_params)
             self.channel = self.connection.channel()
+            self.publish_channel = None
             
             # Declare exchanges and queues
             self._setup_exchanges_and_queues()
@@ -42,9 +64,7 @@ class RabbitMQClient:
         )
         
         # Declare queues for different log sources
-        queues = ['syslog', 'apache', 'ssh', 'firewall']
-        
-        for queue_name in queues:
+        for queue_name in RAW_SOURCE_QUEUES:
             queue_full_name = f'q.raw.{queue_name}'
             self.channel.queue_declare(queue=queue_full_name, durable=True)
             
@@ -55,47 +75,96 @@ class RabbitMQClient:
                 routing_key=f'raw.{queue_name}'
             )
         
-        # Generic queue for unknown sources
+        # Generic queue for unknown sources (an exact key, since raw.* would
+        # also copy every known source's events here)
         self.channel.queue_declare(queue='q.raw.unknown', durable=True)
         self.channel.queue_bind(
             exchange='logs.raw',
             queue='q.raw.unknown',
-            routing_key='raw.*'
+            routing_key='raw.unknown'
         )
+        
+        self.channel.queue_declare(queue=DEAD_LETTER_QUEUE, durable=True)
+    
+    def _get_publish_channel(self):
+        """
+        Get the channel used for publishing, opening it on first use
+        
+        Publishes go over their own transactional channel so a whole batch is
+        confirmed by the broker with one commit; consumer acks on the main
+        channel stay outside the transaction.
+        """
+        if not self.connection or self.connection.is_closed:
+            self._connect()
+        
+        if self.publish_channel is None or self.publish_channel.is_closed:
+            self.publish_channel = self.connection.channel()
+            self.publish_channel.tx_select()
+        return self.publish_channel
     
     def publish_message(self, exchange, routing_key, message):
         """
         Publish a message to RabbitMQ
         """
+        self.publish_messages(exchange, [(routing_key, message)])
+    
+    def publish_messages(self, exchange, messages):
+        """
+        Publish a batch of (routing_key, message) pairs over one channel
+        
+        Returns once the broker has accepted every message in the batch;
+        raises if it did not, in which case none of them were routed.
+        """
         try:
-            if not self.connection or self.connection.is_closed:
-                self._connect()
+            channel = self._get_publish_channel()
             
-            self.channel.basic_publish(
-                exchange=exchange,
-                routing_key=routing_key,
-                body=json.dumps(message),
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # Make message persistent
+            properties = pika.BasicProperties(delivery_mode=2)  # Make messages persistent
+            for routing_key, message in messages:
+                channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=dumps(message),
+                    properties=properties
                 )
-            )
+            channel.tx_commit()
             
         except Exception as e:
-            logger.error(f"Error publishing message: {str(e)}")
+            logger.error(f"Error publishing {len(messages)} messages: {str(e)}")
+            self.publish_channel = None
             raise
     
-    def consume_messages(self, queue_name, callback):
+    def dead_letter(self, body):
+        """
+        Park an undeliverable message body on the dead letter queue
+        
+        Goes over the consuming channel, so call it from a consumer callback
+        before acknowledging the delivery.
+        """
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=DEAD_LETTER_QUEUE,
+            body=body,
+            properties=pika.BasicProperties(delivery_mode=2)
+        )
+    
+    def consume_messages(self, queue_name, callback, prefetch_count=CONSUMER_PREFETCH):
         """
         Consume messages from a queue
+        
+        prefetch_count bounds the unacknowledged deliveries held by the
+        consumer, so the broker can keep sending while earlier messages are
+        processed. Deliveries are never auto-acknowledged: the callback must
+        ack them, ideally in batches with basic_ack(multiple=True).
         """
         try:
             if not self.connection or self.connection.is_closed:
                 self._connect()
             
-            self.channel.basic_qos(prefetch_count=1)
+            self.channel.basic_qos(prefetch_count=prefetch_count)
             self.channel.basic_consume(
                 queue=queue_name,
-                on_message_callback=callback
+                on_message_callback=callback,
+                auto_ack=False
             )
             
             logger.info(f"Starting to consume from queue: {queue_name}")
@@ -5,32 +5,57 @@ Periodically removes expired sessions from Redis
 
 from celery import shared_task
 import logging
+import time
 from app import app
-from utils.session_manager import SessionManager
 
 logger = logging.getLogger(__name__)
 
+# Keys fetched per SCAN call and per pipelined batch of Redis commands
+SCAN_BATCH_SIZE = 1000
+
+def _scan_batches(redis, pattern):
+    """
+    Yield lists of up to SCAN_BATCH_SIZE keys matching pattern, using SCAN
+    so Redis is never blocked walking the whole keyspace
+    """
+    batch = []
+    for key in redis.scan_iter(match=pattern, count=SCAN_BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= SCAN_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _count_keys(redis, pattern):
+    return sum(1 for _ in redis.scan_iter(match=pattern, count=SCAN_BATCH_SIZE))
+
 @shared_task
 def cleanup_expired_sessions():
     """Celery task to clean up expired sessions"""
     try:
         with app.app_context():
-            session_manager = SessionManager(app)
+            session_manager = app.session_manager
             redis = session_manager.redis
-            
-            # Get all session keys
-            session_keys = redis.keys('session:*')
             sessions_cleaned = 0
-            
-            for key in session_keys:
-                session_id = key.decode().split(':')[1]
-                session_data = session_manager.get_session(session_id)
-                
-                if session_data is None:
-                    sessions_cleaned += 1
-            
+
+            # Session keys expire on their own in Redis, no later than a
+            # session lifetime after their last access; what is left behind
+            # are their ids in each user's user_sessions index, scored by that
+            # access time
+            expired_before = time.time() - session_manager.session_lifetime
+            for user_keys in _scan_batches(redis, 'user_sessions:*'):
+                pipe = redis.pipeline(transaction=False)
+                for user_key in user_keys:
+                    pipe.zremrangebyscore(user_key, '-inf', expired_before)
+                # Indexes still stored as plain sets are converted on next use
+                sessions_cleaned += sum(
+                    removed for removed in pipe.execute(raise_on_error=False)
+                    if isinstance(removed, int)
+                )
+
             logger.info(f"Session cleanup completed. Removed {sessions_cleaned} expired sessions.")
-            
+
     except Exception as e:
         logger.error(f"Error during session cleanup: {e}")
         raise
@@ -40,17 +65,16 @@ def log_active_sessions():
     """Celery task to log active session statistics"""
     try:
         with app.app_context():
-            session_manager = SessionManager(app)
-            redis = session_manager.redis
-            
+            redis = app.session_manager.redis
+
             # Count active sessions
-            session_count = len(redis.keys('session:*'))
-            
+            session_count = _count_keys(redis, 'session:*')
+
             # Count unique users with active sessions
-            user_count = len(redis.keys('user_sessions:*'))
-            
+            user_count = _count_keys(redis, 'user_sessions:*')
+
             logger.info(f"Active sessions: {session_count}, Unique users: {user_count}")
-            
+
     except Exception as e:
         logger.error(f"Error logging session statistics: {e}")
         raise
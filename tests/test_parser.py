@@ -0,0 +1,54 @@
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+from services import parser
+from services.parser import ARROW_MIN_BATCH, PYARROW_AVAILABLE, EventParser
+
+MESSAGES = [
+    'Jan 12 10:15:32 web01 sshd[4242]: Failed password for root from 10.0.0.5 port 22 ssh2',
+    '<34>Feb  3 08:01:02 bastion sshd[17]: Accepted password for alice from 192.168.1.20 port 51000 ssh2',
+    '203.0.113.9 - - [10/Oct/2024:13:55:36 +0000] "GET /index.html HTTP/1.1" 200 2326',
+    'Mar  7 23:59:59 db01 cron[881]: (root) CMD (run-parts /etc/cron.hourly)',
+    'Jan 12 10:15:32 web01 sshd[4242]: Failed password for invalid user from somewhere',
+    'Apr  1 00:00:00 host kernel: HTTP/ appears but this is still just syslog',
+    '{"event_type": "login", "username": "bob", "timestamp": "2024-10-10T13:55:36+00:00"}',
+    '[1, 2, 3]',
+    '   {"not": "closed"',
+    'free text that matches nothing',
+    '',
+]
+
+def _raw(text):
+    return {'payload': {'raw': text}}
+
+@unittest.skipUnless(PYARROW_AVAILABLE, 'pyarrow is not installed')
+class ParseMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = EventParser()
+        # Events without a usable timestamp get the current time
+        now = datetime(2024, 10, 10, 12, 0, tzinfo=timezone.utc)
+        patcher = mock.patch.object(parser, '_now_utc', return_value=now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_batch_matches_single_message_parsing(self):
+        raw_messages = [_raw(text) for text in MESSAGES]
+        raw_messages *= ARROW_MIN_BATCH // len(raw_messages) + 1
+        raw_messages += [{'payload': {'raw': None}}, {'no_payload': True}]
+
+        self.assertEqual(
+            self.parser.parse_messages(raw_messages),
+            [self.parser.parse_message(raw_message) for raw_message in raw_messages]
+        )
+
+    def test_small_batch_matches_single_message_parsing(self):
+        raw_messages = [_raw(text) for text in MESSAGES]
+
+        self.assertEqual(
+            self.parser.parse_messages(raw_messages),
+            [self.parser.parse_message(raw_message) for raw_message in raw_messages]
+        )
+
+if __name__ == '__main__':
+    unittest.main()
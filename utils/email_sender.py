@@ -3,18 +3,59 @@ Email Sender Utility
 Handles email notifications for SIEM alerts
 """
 
+import io
 import os
+import time
+import base64
 import smtplib
 import logging
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
-from email import encoders
 from typing import List, Optional, Dict, Any
 from datetime import datetime
+from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 logger = logging.getLogger(__name__)
 
+# Attachments larger than this are left out of the email
+MAX_ATTACHMENT_BYTES = int(os.environ.get('SMTP_MAX_ATTACHMENT_MB', '10')) * 1024 * 1024
+
+# Bytes read per step when base64-encoding an attachment; a multiple of the
+# 57 bytes that encode to one 76-character line
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+# Email bodies are compiled once at import; HTML templates escape alert
+# fields, which come from user-defined rules
+EMAIL_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates', 'email')
+
+_template_env = Environment(
+    loader=FileSystemLoader(EMAIL_TEMPLATE_DIR),
+    autoescape=select_autoescape(['html']),
+    trim_blocks=True,
+    lstrip_blocks=True
+)
+_ALERT_TEXT = _template_env.get_template('alert.txt')
+_ALERT_HTML = _template_env.get_template('alert.html')
+_SYSTEM_HEALTH_TEXT = _template_env.get_template('system_health.txt')
+
+def _alert_context(alert_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Fill in defaults for the alert fields used by the alert templates
+    """
+    return {
+        'rule_name': alert_data.get('rule_name', 'Unknown Rule'),
+        'rule_description': alert_data.get('rule_description', ''),
+        'event_count': alert_data.get('event_count', 0),
+        'threshold': alert_data.get('threshold', 0),
+        'time_window': alert_data.get('time_window', 0),
+        'triggered_at': alert_data.get('triggered_at', datetime.utcnow())
+    }
+
+# Seconds a cached SMTP connection may sit idle before it is checked with NOOP
+SMTP_IDLE_CHECK_SECONDS = 60
+
 class EmailSender:
     """
     Email sender for SIEM alert notifications
@@ -41,6 +82,12 @@ class EmailSender:
         self.use_tls = use_tls
         self.from_email = from_email or os.environ.get('ALERT_FROM_EMAIL', 'alerts@siem.local')
         
+        # One authenticated connection is reused across emails; the lock
+        # keeps threads from interleaving SMTP commands on it
+        self._server = None
+        self._server_last_used = 0.0
+        self._server_lock = threading.Lock()
+        
         logger.info(f"Email sender initialized with server: {self.smtp_server}:{self.smtp_port}")
     
     def send_email(self, recipients: List[str], subject: str, body: str,
@@ -102,77 +149,13 @@ class EmailSender:
             True if email was sent successfully, False otherwise
         """
         try:
-            # Extract alert information
-            rule_name = alert_data.get('rule_name', 'Unknown Rule')
-            event_count = alert_data.get('event_count', 0)
-            threshold = alert_data.get('threshold', 0)
-            time_window = alert_data.get('time_window', 0)
-            triggered_at = alert_data.get('triggered_at', datetime.utcnow())
-            rule_description = alert_data.get('rule_description', '')
+            alert = _alert_context(alert_data)
             
             # Create subject
-            subject = f"SIEM Alert: {rule_name}"
+            subject = f"SIEM Alert: {alert['rule_name']}"
             
-            # Create plain text body
-            body = f"""
-SECURITY ALERT
-
-Alert Rule: {rule_name}
-Description: {rule_description}
-
-Event Details:
-- Threshold: {threshold} events in {time_window} minutes
-- Actual Count: {event_count} events
-- Triggered At: {triggered_at}
-
-Please investigate this security event immediately.
-
----
-This is an automated message from the SIEM platform.
-            """.strip()
-            
-            # Create HTML body
-            html_body = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <style>
-                    body {{ font-family: Arial, sans-serif; margin: 20px; }}
-                    .alert-box {{ 
-                        background-color: #f8d7da; 
-                        border: 1px solid #f5c6cb; 
-                        color: #721c24; 
-                        padding: 15px; 
-                        border-radius: 5px; 
-                        margin-bottom: 20px;
-                    }}
-                    .details {{ background-color: #f8f9fa; padding: 15px; border-radius: 5px; }}
-                    .metric {{ margin: 5px 0; }}
-                    .footer {{ margin-top: 20px; font-size: 12px; color: #666; }}
-                </style>
-            </head>
-            <body>
-                <div class="alert-box">
-                    <h2>🚨 SECURITY ALERT</h2>
-                    <h3>{rule_name}</h3>
-                </div>
-                
-                <div class="details">
-                    <h4>Alert Details</h4>
-                    <div class="metric"><strong>Description:</strong> {rule_description}</div>
-                    <div class="metric"><strong>Threshold:</strong> {threshold} events in {time_window} minutes</div>
-                    <div class="metric"><strong>Actual Count:</strong> {event_count} events</div>
-                    <div class="metric"><strong>Triggered At:</strong> {triggered_at}</div>
-                </div>
-                
-                <p><strong>Action Required:</strong> Please investigate this security event immediately.</p>
-                
-                <div class="footer">
-                    This is an automated message from the SIEM platform.
-                </div>
-            </body>
-            </html>
-            """
+            body = _ALERT_TEXT.render(alerts=[alert])
+            html_body = _ALERT_HTML.render(alerts=[alert])
             
             return self.send_email(recipients, subject, body, html_body)
             
@@ -180,6 +163,35 @@ This is an automated message from the SIEM platform.
             logger.error(f"Error sending alert email: {e}")
             return False
     
+    def send_alert_emails(self, recipients: List[str], alerts: List[Dict[str, Any]]) -> bool:
+        """
+        Send several alerts to the same recipients as one digest email
+        
+        Args:
+            recipients: List of recipient email addresses
+            alerts: List of alert information dictionaries, as taken by
+                send_alert_email
+            
+        Returns:
+            True if email was sent successfully, False otherwise
+        """
+        if len(alerts) == 1:
+            return self.send_alert_email(recipients, alerts[0])
+        
+        try:
+            alerts = [_alert_context(alert_data) for alert_data in alerts]
+            
+            subject = f"SIEM Alert: {len(alerts)} alerts triggered"
+            
+            body = _ALERT_TEXT.render(alerts=alerts)
+            html_body = _ALERT_HTML.render(alerts=alerts)
+            
+            return self.send_email(recipients, subject, body, html_body)
+            
+        except Exception as e:
+            logger.error(f"Error sending alert digest email: {e}")
+            return False
+    
     def send_system_health_email(self, recipients: List[str], health_data: Dict[str, Any]) -> bool:
         """
         Send a system health notification email
@@ -194,8 +206,6 @@ This is an automated message from the SIEM platform.
         try:
             status = health_data.get('status', 'unknown')
             component = health_data.get('component', 'system')
-            metrics = health_data.get('metrics', {})
-            timestamp = health_data.get('timestamp', datetime.utcnow())
             
             # Create subject based on status
             if status == 'critical':
@@ -205,24 +215,12 @@ This is an automated message from the SIEM platform.
             else:
                 subject = f"✅ INFO: SIEM {component} Health Update"
             
-            # Create body
-            body = f"""
-SIEM SYSTEM HEALTH NOTIFICATION
-
-Component: {component}
-Status: {status.upper()}
-Timestamp: {timestamp}
-
-Metrics:
-"""
-            
-            for key, value in metrics.items():
-                body += f"- {key}: {value}\n"
-            
-            body += """
----
-This is an automated message from the SIEM platform.
-"""
+            body = _SYSTEM_HEALTH_TEXT.render(
+                component=component,
+                status=status,
+                metrics=health_data.get('metrics', {}),
+                timestamp=health_data.get('timestamp', datetime.utcnow())
+            )
             
             return self.send_email(recipients, subject, body)
             
@@ -239,15 +237,27 @@ This is an automated message from the SIEM platform.
             file_path: Path to file to attach
         """
         try:
+            size = os.path.getsize(file_path)
+            if size > MAX_ATTACHMENT_BYTES:
+                logger.warning(f"Attachment {file_path} is {size} bytes, over the "
+                               f"{MAX_ATTACHMENT_BYTES} byte limit; not attaching it")
+                return
+            
+            # Encode in chunks rather than holding the raw file and its
+            # base64 copy in memory at once
+            encoded = io.BytesIO()
             with open(file_path, 'rb') as attachment:
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(attachment.read())
+                for chunk in iter(lambda: attachment.read(ATTACHMENT_CHUNK_SIZE), b''):
+                    encoded.write(base64.encodebytes(chunk))
             
-            encoders.encode_base64(part)
+            part = MIMEBase('application', 'octet-stream')
+            part.set_payload(encoded.getvalue().decode('ascii'))
+            part['Content-Transfer-Encoding'] = 'base64'
             
             part.add_header(
                 'Content-Disposition',
-                f'attachment; filename= {os.path.basename(file_path)}'
+                'attachment',
+                filename=os.path.basename(file_path)
             )
             
             msg.attach(part)
@@ -255,6 +265,59 @@ This is an automated message from the SIEM platform.
         except Exception as e:
             logger.error(f"Error attaching file {file_path}: {e}")
     
+    def _connect(self) -> smtplib.SMTP:
+        """
+        Open and authenticate a new SMTP connection
+        
+        Returns:
+            Connected SMTP client
+        """
+        if self.smtp_port == 465:
+            # Use SSL
+            server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port)
+        else:
+            # Use regular connection, possibly with STARTTLS
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+            if self.use_tls:
+                server.starttls()
+        
+        # Login if credentials provided
+        if self.username and self.password:
+            server.login(self.username, self.password)
+        
+        return server
+    
+    def _get_server(self) -> smtplib.SMTP:
+        """
+        Get the cached SMTP connection, opening it on first use or when an
+        idle connection no longer answers NOOP. Call with _server_lock held.
+        
+        Returns:
+            Connected SMTP client
+        """
+        if self._server is not None and time.monotonic() - self._server_last_used > SMTP_IDLE_CHECK_SECONDS:
+            try:
+                if self._server.noop()[0] != 250:
+                    self._close_server()
+            except OSError:
+                self._server = None
+        
+        if self._server is None:
+            self._server = self._connect()
+        return self._server
+    
+    def _close_server(self):
+        """
+        Quit the cached SMTP connection, if any. Call with _server_lock held.
+        """
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except OSError:
+            pass
+        self._server = None
+    
     def _send_message(self, msg: MIMEMultipart, recipients: List[str]) -> bool:
         """
         Send the email message
@@ -267,24 +330,19 @@ This is an automated message from the SIEM platform.
             True if sent successfully, False otherwise
         """
         try:
-            # Create SMTP connection
-            if self.smtp_port == 465:
-                # Use SSL
-                server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port)
-            else:
-                # Use regular connection, possibly with STARTTLS
-                server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-                if self.use_tls:
-                    server.starttls()
-            
-            # Login if credentials provided
-            if self.username and self.password:
-                server.login(self.username, self.password)
-            
-            # Send email
-            text = msg.as_string()
-            server.sendmail(self.from_email, recipients, text)
-            server.quit()
+            with self._server_lock:
+                # Send email, reconnecting once if the server dropped the
+                # cached connection; the body goes out once however many
+                # recipients there are
+                for attempt in range(2):
+                    try:
+                        self._get_server().send_message(msg, self.from_email, recipients)
+                        break
+                    except smtplib.SMTPServerDisconnected:
+                        self._server = None
+                        if attempt:
+                            raise
+                self._server_last_used = time.monotonic()
             
             logger.info(f"Email sent successfully to {recipients}")
             return True
@@ -294,6 +352,8 @@ This is an automated message from the SIEM platform.
             return False
         except Exception as e:
             logger.error(f"Error sending email: {e}")
+            with self._server_lock:
+                self._server = None
             return False
     
     def test_connection(self) -> bool:
@@ -304,16 +364,7 @@ This is an automated message from the SIEM platform.
             True if connection is successful, False otherwise
         """
         try:
-            if self.smtp_port == 465:
-                server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port)
-            else:
-                server = smtplib.SMTP(self.smtp_server, self.smtp_port)
-                if self.use_tls:
-                    server.starttls()
-            
-            if self.username and self.password:
-                server.login(self.username, self.password)
-            
+            server = self._connect()
             server.quit()
             logger.info("Email connection test successful")
             return True
@@ -321,6 +372,13 @@ This is an automated message from the SIEM platform.
         except Exception as e:
             logger.error(f"Email connection test failed: {e}")
             return False
+    
+    def close(self):
+        """
+        Close the cached SMTP connection
+        """
+        with self._server_lock:
+            self._close_server()
 
 
 # Singleton instance for global use
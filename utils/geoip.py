@@ -4,8 +4,14 @@ Provides IP geolocation services using MaxMind GeoLite2 database
 """
 
 import os
+import mmap
+import socket
+import struct
 import logging
+import threading
 import ipaddress
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional, Any
 
 logger = logging.getLogger(__name__)
@@ -17,15 +23,125 @@ except ImportError:
     MAXMIND_AVAILABLE = False
     logger.warning("maxminddb library not available. GeoIP lookups will be disabled.")
 
+# Lookup results kept per reader, keyed on the IP string; client IPs repeat
+# heavily, so most lookups skip the database walk
+GEOIP_CACHE_SIZE = int(os.environ.get('GEOIP_CACHE_SIZE', '100000'))
+
+# lookup_batch spreads batches with at least this many distinct IPs over
+# up to GEOIP_BATCH_WORKERS threads; smaller ones are mostly cache hits,
+# cheaper to run inline than to hand to a pool
+GEOIP_BATCH_PARALLEL_MIN = 256
+GEOIP_BATCH_WORKERS = 8
+
+# Read the whole database into the page cache in the background after
+# opening it, so early lookups don't stall on page faults
+GEOIP_PREFAULT = os.environ.get('GEOIP_PREFAULT', '1') == '1'
+
+def _prefault_file(path: str):
+    """
+    Pull a file into the page cache by touching one byte per page
+    """
+    try:
+        with open(path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_WILLNEED)
+                for offset in range(0, len(mm), mmap.PAGESIZE):
+                    mm[offset]
+        
+        logger.info(f"GeoIP database {path} prefaulted into the page cache")
+    except Exception as e:
+        logger.warning(f"Could not prefault GeoIP database {path}: {e}")
+
+# IPv4 networks reported as Private/Local: the ranges ipaddress treats as
+# private, loopback or link-local, plus carrier-grade NAT space
+_PRIVATE_V4 = [
+    ipaddress.ip_network(network) for network in [
+        '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8',
+        '169.254.0.0/16', '172.16.0.0/12', '192.0.0.0/29', '192.0.0.170/31',
+        '192.0.2.0/24', '192.168.0.0/16', '198.18.0.0/15', '198.51.100.0/24',
+        '203.0.113.0/24', '240.0.0.0/4', '255.255.255.255/32',
+    ]
+]
+
+PRIVATE_V4_NETWORKS = [
+    (int(network.network_address), int(network.netmask)) for network in _PRIVATE_V4
+]
+
+# State of every IPv4 /16 prefix: public, wholly private, or partly covered
+# by a smaller private network and so needing the full mask check
+_PREFIX_PUBLIC, _PREFIX_PRIVATE, _PREFIX_MIXED = 0, 1, 2
+
+def _build_prefix_table():
+    table = bytearray(1 << 16)
+    for network in _PRIVATE_V4:
+        first = int(network.network_address) >> 16
+        if network.prefixlen <= 16:
+            table[first:(int(network.broadcast_address) >> 16) + 1] = \
+                bytes([_PREFIX_PRIVATE]) * (1 << (16 - network.prefixlen))
+        elif table[first] != _PREFIX_PRIVATE:
+            table[first] = _PREFIX_MIXED
+    return table
+
+PRIVATE_V4_PREFIXES = _build_prefix_table()
+
+_IPV4_STRUCT = struct.Struct('!I')
+
+PRIVATE_GEO_DATA = {
+    'country': 'Private/Local',
+    'country_code': 'XX',
+    'city': 'Private/Local',
+    'latitude': None,
+    'longitude': None,
+    'accuracy_radius': None,
+    'is_private': True
+}
+
+def _is_private_ip(ip_address: str) -> bool:
+    """
+    Check whether an IP address is private, loopback or link-local
+    
+    Dotted-quad IPv4 is classified by its /16 prefix in PRIVATE_V4_PREFIXES,
+    falling back to the masks in PRIVATE_V4_NETWORKS only for prefixes that
+    are partly private; only IPv6 and anything inet_pton rejects go through
+    ipaddress.
+    
+    Raises:
+        ValueError: if ip_address is not a valid IP address
+    """
+    try:
+        ip_int = _IPV4_STRUCT.unpack(socket.inet_pton(socket.AF_INET, ip_address))[0]
+    except OSError:
+        ip_obj = ipaddress.ip_address(ip_address)
+        return ip_obj.is_private or ip_obj.is_loopback or ip_obj.is_link_local
+    
+    prefix = PRIVATE_V4_PREFIXES[ip_int >> 16]
+    if prefix != _PREFIX_MIXED:
+        return prefix == _PREFIX_PRIVATE
+    
+    for network, mask in PRIVATE_V4_NETWORKS:
+        if ip_int & mask == network:
+            return True
+    return False
+
 class GeoIPLookup:
     """
     GeoIP lookup service using MaxMind GeoLite2 database
     """
     
+    __slots__ = ('db_path', 'reader', 'lookup', '_batch_pool', '_batch_pool_lock')
+    
     def __init__(self, db_path: Optional[str] = None):
         self.db_path = db_path or os.environ.get('GEOIP_DB_PATH', '/opt/geoip/GeoLite2-City.mmdb')
         self.reader = None
         self._initialize_reader()
+        # Misses (None) are cached too
+        self.lookup = lru_cache(maxsize=GEOIP_CACHE_SIZE)(self._lookup_uncached)
+        self._batch_pool = None
+        self._batch_pool_lock = threading.Lock()
     
     def _initialize_reader(self):
         """Initialize the MaxMind database reader"""
@@ -35,8 +151,18 @@ class GeoIPLookup:
         
         try:
             if os.path.exists(self.db_path):
-                self.reader = maxminddb.open_database(self.db_path)
+                try:
+                    self.reader = maxminddb.open_database(self.db_path, mode=maxminddb.MODE_MMAP_EXT)
+                except ValueError as e:
+                    logger.error(f"maxminddb C extension unavailable ({e}); "
+                                 f"falling back to the much slower pure Python reader")
+                    self.reader = maxminddb.open_database(self.db_path)
                 logger.info(f"GeoIP database loaded from {self.db_path}")
+                
+                if GEOIP_PREFAULT:
+                    threading.Thread(
+                        target=_prefault_file, args=(self.db_path,), name='geoip-prefault', daemon=True
+                    ).start()
             else:
                 logger.warning(f"GeoIP database not found at {self.db_path}")
                 logger.info("To enable GeoIP lookups:")
@@ -46,9 +172,10 @@ class GeoIPLookup:
         except Exception as e:
             logger.error(f"Error loading GeoIP database: {e}")
     
-    def lookup(self, ip_address: str) -> Optional[Dict[str, Any]]:
+    def _lookup_uncached(self, ip_address: str) -> Optional[Dict[str, Any]]:
         """
-        Perform GeoIP lookup for an IP address
+        Perform GeoIP lookup for an IP address; use lookup, which caches
+        the results
         
         Args:
             ip_address: The IP address to lookup
@@ -60,20 +187,9 @@ class GeoIPLookup:
             return None
         
         try:
-            # Validate IP address
-            ip_obj = ipaddress.ip_address(ip_address)
-            
-            # Skip private/local addresses
-            if ip_obj.is_private or ip_obj.is_loopback or ip_obj.is_link_local:
-                return {
-                    'country': 'Private/Local',
-                    'country_code': 'XX',
-                    'city': 'Private/Local',
-                    'latitude': None,
-                    'longitude': None,
-                    'accuracy_radius': None,
-                    'is_private': True
-                }
+            # Validate IP address and skip private/local addresses
+            if _is_private_ip(ip_address):
+                return PRIVATE_GEO_DATA
             
             # Perform lookup
             result = self.reader.get(ip_address)
@@ -81,14 +197,17 @@ class GeoIPLookup:
                 return None
             
             # Extract relevant information
+            country = result.get('country') or {}
+            city = result.get('city') or {}
+            location = result.get('location') or {}
             geo_data = {
-                'country': self._safe_get(result, 'country', 'names', 'en', default='Unknown'),
-                'country_code': self._safe_get(result, 'country', 'iso_code', default='XX'),
-                'city': self._safe_get(result, 'city', 'names', 'en', default='Unknown'),
-                'latitude': self._safe_get(result, 'location', 'latitude'),
-                'longitude': self._safe_get(result, 'location', 'longitude'),
-                'accuracy_radius': self._safe_get(result, 'location', 'accuracy_radius'),
-                'timezone': self._safe_get(result, 'location', 'time_zone'),
+                'country': (country.get('names') or {}).get('en', 'Unknown'),
+                'country_code': country.get('iso_code', 'XX'),
+                'city': (city.get('names') or {}).get('en', 'Unknown'),
+                'latitude': location.get('latitude'),
+                'longitude': location.get('longitude'),
+                'accuracy_radius': location.get('accuracy_radius'),
+                'timezone': location.get('time_zone'),
                 'is_private': False
             }
             
@@ -116,40 +235,36 @@ class GeoIPLookup:
             logger.error(f"Error performing GeoIP lookup for {ip_address}: {e}")
             return None
     
-    def _safe_get(self, data: Dict, *keys, default=None):
-        """
-        Safely traverse nested dictionary keys
-        
-        Args:
-            data: Dictionary to traverse
-            *keys: Keys to traverse in order
-            default: Default value if key path doesn't exist
-            
-        Returns:
-            Value at the key path or default
-        """
-        current = data
-        for key in keys:
-            if isinstance(current, dict) and key in current:
-                current = current[key]
-            else:
-                return default
-        return current
-    
     def lookup_batch(self, ip_addresses: list) -> Dict[str, Optional[Dict[str, Any]]]:
         """
         Perform batch GeoIP lookups
         
+        Duplicate addresses are looked up once, and large batches are looked
+        up concurrently through the shared lookup cache.
+        
         Args:
             ip_addresses: List of IP addresses to lookup
             
         Returns:
             Dictionary mapping IP addresses to their geolocation data
         """
-        results = {}
-        for ip in ip_addresses:
-            results[ip] = self.lookup(ip)
-        return results
+        unique = list(dict.fromkeys(ip_addresses))
+        if len(unique) < GEOIP_BATCH_PARALLEL_MIN or not self.reader:
+            return {ip: self.lookup(ip) for ip in unique}
+        
+        return dict(zip(unique, self._get_batch_pool().map(self.lookup, unique)))
+    
+    def _get_batch_pool(self) -> ThreadPoolExecutor:
+        """
+        Get the thread pool used by lookup_batch, creating it on first use
+        """
+        if self._batch_pool is None:
+            with self._batch_pool_lock:
+                if self._batch_pool is None:
+                    self._batch_pool = ThreadPoolExecutor(
+                        max_workers=GEOIP_BATCH_WORKERS, thread_name_prefix='geoip-batch'
+                    )
+        return self._batch_pool
     
     def is_available(self) -> bool:
         """
@@ -189,6 +304,7 @@ class GeoIPLookup:
     
     def close(self):
         """Close the GeoIP database reader"""
+        self.lookup.cache_clear()
         if self.reader:
             self.reader.close()
             self.reader = None
@@ -197,6 +313,7 @@ class GeoIPLookup:
 
 # Singleton instance for global use
 _geoip_instance = None
+_geoip_lock = threading.Lock()
 
 def get_geoip_instance() -> GeoIPLookup:
     """
@@ -207,7 +324,9 @@ def get_geoip_instance() -> GeoIPLookup:
     """
     global _geoip_instance
     if _geoip_instance is None:
-        _geoip_instance = GeoIPLookup()
+        with _geoip_lock:
+            if _geoip_instance is None:
+                _geoip_instance = GeoIPLookup()
     return _geoip_instance
 
 def lookup_ip(ip_address: str) -> Optional[Dict[str, Any]]:
@@ -0,0 +1,41 @@
+"""
+JSON Serialization Utility
+Serializes and parses JSON with orjson when it is installed
+"""
+
+import json
+from datetime import datetime
+from flask import Response
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dumps(obj) -> bytes:
+    """
+    Serialize obj to JSON bytes; datetimes become ISO 8601 strings
+    """
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj, default=_json_default).encode()
+
+def loads(data):
+    """
+    Parse JSON from str or bytes
+    """
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_response(obj, status=200) -> Response:
+    """
+    Serialize obj to a JSON response
+    """
+    return Response(dumps(obj), status=status, mimetype='application/json')
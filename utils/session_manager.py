@@ -3,20 +3,53 @@ Session management for SIEM platform
 Provides Redis-based session handling with security features
 """
 
-from datetime import datetime, timedelta
-import json
+import time
+from datetime import datetime, timedelta, timezone
 from uuid import uuid4
 from flask import session
-from redis import Redis
-from flask_login import user_loaded_from_header
+from redis import BlockingConnectionPool, Redis
+from redis.exceptions import ResponseError
+
+# Seconds between writes recording an access to a session; reads within
+# this of the last one leave the session untouched
+SESSION_TOUCH_INTERVAL = 60
+
+# Session fields stored as integer epoch seconds
+TIMESTAMP_FIELDS = ('created_at', 'last_accessed', 'expires_at')
+
+def _epoch(value):
+    """
+    Epoch seconds from a stored session timestamp; sessions created before
+    timestamps were stored as integers hold naive UTC ISO strings
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return int(datetime.fromisoformat(value.decode()).replace(tzinfo=timezone.utc).timestamp())
+
+def _decode_session(session_data):
+    """Turn a session hash read from Redis into a dict"""
+    session = {key.decode(): value.decode() for key, value in session_data.items()}
+    session['user_id'] = int(session['user_id'])
+    # Timestamps are shown to users, so hand them back as UTC datetimes
+    for field in TIMESTAMP_FIELDS:
+        if field in session:
+            session[field] = datetime.fromtimestamp(_epoch(session_data[field.encode()]), timezone.utc)
+    return session
 
 class SessionManager:
     def __init__(self, app=None, redis_url=None):
         self.app = app
         self.redis_url = redis_url or app.config.get('REDIS_URL', 'redis://localhost:6379/1')
-        self.redis = Redis.from_url(self.redis_url)
-        self.session_lifetime = int(app.config.get('SESSION_LIFETIME', 86400))  # 24 hours default
-        self.max_sessions = int(app.config.get('MAX_USER_SESSIONS', 5))
+        # One pool for the whole process, shared with everything else that
+        # uses this client; callers wait for a free connection at the limit
+        # instead of opening more
+        self.redis = Redis(connection_pool=BlockingConnectionPool.from_url(
+            self.redis_url,
+            max_connections=int(app.config.get('REDIS_MAX_CONNECTIONS', 64)),
+            socket_keepalive=True,
+            health_check_interval=30
+        ))
 
         if app is not None:
             self.init_app(app)
@@ -24,6 +57,11 @@ class SessionManager:
     def init_app(self, app):
         """Initialize the session manager with the Flask app"""
         self.app = app
+
+        # Read once here rather than from app.config on every request
+        self.session_lifetime = int(app.config.get('SESSION_LIFETIME', 86400))  # 24 hours default
+        self.max_sessions = int(app.config.get('MAX_USER_SESSIONS', 5))
+        self.strict_security = bool(app.config.get('STRICT_SESSION_SECURITY', False))
         
         # Set session configuration
         app.config.update(
@@ -34,142 +72,269 @@ class SessionManager:
             SESSION_COOKIE_SAMESITE='Lax'
         )
 
-        # Register session cleanup with Flask-Login
-        @user_loaded_from_header.connect
-        def on_user_loaded(sender, user=None, **kwargs):
-            if user:
-                self.cleanup_expired_sessions(user.id)
+        # Expired sessions are pruned from the user indexes by the periodic
+        # cleanup_expired_sessions task, not on the request path
 
     def create_session(self, user_id, user_agent, ip_address):
         """Create a new session for a user"""
         session_id = str(uuid4())
+        now = int(time.time())
         session_data = {
             'user_id': user_id,
             'session_id': session_id,
-            'user_agent': user_agent,
-            'ip_address': ip_address,
-            'created_at': datetime.utcnow().isoformat(),
-            'last_accessed': datetime.utcnow().isoformat(),
-            'expires_at': (datetime.utcnow() + timedelta(seconds=self.session_lifetime)).isoformat()
+            'user_agent': user_agent or '',
+            'ip_address': ip_address or '',
+            'created_at': now,
+            'last_accessed': now,
+            'expires_at': now + self.session_lifetime
         }
 
-        # Store session in Redis
-        self.redis.setex(
-            f'session:{session_id}',
-            self.session_lifetime,
-            json.dumps(session_data)
-        )
+        # Store session in Redis as a hash, so touching it only rewrites
+        # the last_accessed field. The key expires at expires_at, so a
+        # session that still exists has not expired
+        session_key = f'session:{session_id}'
+        pipe = self.redis.pipeline()
+        pipe.hset(session_key, mapping=session_data)
+        pipe.expireat(session_key, session_data['expires_at'])
 
-        # Add session to user's session list
+        # Add session to user's session index, scored by last access
         user_sessions_key = f'user_sessions:{user_id}'
-        self.redis.sadd(user_sessions_key, session_id)
+        pipe.zadd(user_sessions_key, {session_id: now})
+        pipe.zcard(user_sessions_key)
+        try:
+            session_count = pipe.execute()[-1]
+        except ResponseError:
+            # The index is still a plain set from before it was sorted
+            self._convert_user_sessions(user_sessions_key)
+            pipe = self.redis.pipeline()
+            pipe.zadd(user_sessions_key, {session_id: now})
+            pipe.zcard(user_sessions_key)
+            session_count = pipe.execute()[-1]
 
-        # Enforce max sessions per user
-        self._enforce_max_sessions(user_id)
+        # Enforce max sessions per user, only once the index is over it
+        if session_count > self.max_sessions:
+            self._enforce_max_sessions(user_id)
 
         return session_id
 
     def get_session(self, session_id):
         """Retrieve and validate a session"""
         session_key = f'session:{session_id}'
-        session_data = self.redis.get(session_key)
+        try:
+            session_data = self.redis.hgetall(session_key)
+        except ResponseError:
+            # A session stored as a JSON string before sessions became hashes
+            self.redis.delete(session_key)
+            return None
 
         if not session_data:
             return None
 
-        session_data = json.loads(session_data)
-        
+        if b'user_id' not in session_data or b'expires_at' not in session_data:
+            # A stray hash left by a touch that raced the session's expiry
+            self.redis.delete(session_key)
+            return None
+
+        session_data = _decode_session(session_data)
+
         # Update last accessed time
-        session_data['last_accessed'] = datetime.utcnow().isoformat()
-        self.redis.setex(
-            session_key,
-            self.session_lifetime,
-            json.dumps(session_data)
+        last_accessed = int(session_data['last_accessed'].timestamp())
+        touched = self._touch_session(
+            session_id, session_data['user_id'], last_accessed, int(session_data['expires_at'].timestamp())
         )
+        if touched != last_accessed:
+            session_data['last_accessed'] = datetime.fromtimestamp(touched, timezone.utc)
 
         return session_data
 
-    def delete_session(self, session_id):
+    def _touch_session(self, session_id, user_id, last_accessed, expires_at):
+        """
+        Record an access to a session, unless the last one was within
+        SESSION_TOUCH_INTERVAL
+
+        Returns the session's last access time as epoch seconds.
+        """
+        now = int(time.time())
+        if now - last_accessed < SESSION_TOUCH_INTERVAL:
+            return last_accessed
+
+        # If the session expired since it was read, HSET recreates it as a
+        # bare hash; setting the expiry again in the same transaction removes
+        # that straight away instead of leaving it without a TTL
+        session_key = f'session:{session_id}'
+        pipe = self.redis.pipeline()
+        pipe.hset(session_key, 'last_accessed', now)
+        pipe.expireat(session_key, expires_at)
+        pipe.zadd(f'user_sessions:{user_id}', {session_id: now}, xx=True)
+        pipe.execute(raise_on_error=False)
+        return now
+
+    def _convert_user_sessions(self, user_sessions_key):
+        """
+        Turn a user's session index stored as a plain set, from before it was
+        a sorted set; members count as accessed just before any session
+        created now
+        """
+        session_ids = self.redis.smembers(user_sessions_key)
+        accessed = int(time.time()) - 1
+        pipe = self.redis.pipeline()
+        pipe.delete(user_sessions_key)
+        if session_ids:
+            pipe.zadd(user_sessions_key, {session_id: accessed for session_id in session_ids})
+        pipe.execute()
+
+    def _user_session_ids(self, user_id, start=0, end=-1):
+        """Session ids for a user, oldest access first"""
+        user_sessions_key = f'user_sessions:{user_id}'
+        try:
+            session_ids = self.redis.zrange(user_sessions_key, start, end)
+        except ResponseError:
+            self._convert_user_sessions(user_sessions_key)
+            session_ids = self.redis.zrange(user_sessions_key, start, end)
+        return [session_id.decode() for session_id in session_ids]
+
+    def delete_session(self, session_id, user_id=None):
         """Delete a specific session"""
         session_key = f'session:{session_id}'
-        session_data = self.redis.get(session_key)
 
-        if session_data:
-            session_data = json.loads(session_data)
-            user_id = session_data.get('user_id')
-            if user_id:
-                self.redis.srem(f'user_sessions:{user_id}', session_id)
-            
-            self.redis.delete(session_key)
+        if user_id is None:
+            try:
+                user_id = self.redis.hget(session_key, 'user_id')
+            except ResponseError:
+                user_id = None
+            if not user_id:
+                self.redis.delete(session_key)
+                return
+            user_id = int(user_id)
 
-    def get_user_sessions(self, user_id):
-        """Get all active sessions for a user"""
-        sessions = []
-        session_ids = self.redis.smembers(f'user_sessions:{user_id}')
+        pipe = self.redis.pipeline()
+        if user_id:
+            pipe.zrem(f'user_sessions:{user_id}', session_id)
+        pipe.delete(session_key)
+        pipe.execute(raise_on_error=False)
+
+    def _read_sessions(self, session_ids, *fields):
+        """
+        Read several sessions in one round-trip
 
+        Returns a list aligned with session_ids holding each session's dict,
+        or just the requested fields as a list when fields are given, or
+        None for sessions that no longer exist.
+        """
+        pipe = self.redis.pipeline(transaction=False)
         for session_id in session_ids:
-            session_data = self.redis.get(f'session:{session_id.decode()}')
-            if session_data:
-                sessions.append(json.loads(session_data))
+            if fields:
+                pipe.hmget(f'session:{session_id}', fields)
+            else:
+                pipe.hgetall(f'session:{session_id}')
 
+        sessions = []
+        for session_data in pipe.execute(raise_on_error=False):
+            # Errors are old JSON sessions, treated as gone
+            if isinstance(session_data, Exception) or not session_data:
+                sessions.append(None)
+            elif fields:
+                sessions.append(
+                    None if session_data[0] is None
+                    else [value.decode() if value is not None else None for value in session_data]
+                )
+            else:
+                sessions.append(_decode_session(session_data))
         return sessions
 
+    def get_user_sessions(self, user_id):
+        """Get all active sessions for a user"""
+        session_ids = self._user_session_ids(user_id)
+        if not session_ids:
+            return []
+
+        # Fetch every session in one round-trip
+        sessions = self._read_sessions(session_ids)
+        return [session for session in sessions if session]
+
     def cleanup_expired_sessions(self, user_id):
-        """Clean up expired sessions for a user"""
-        session_ids = self.redis.smembers(f'user_sessions:{user_id}')
-        now = datetime.utcnow()
+        """
+        Drop sessions Redis has already expired from a user's session index
 
-        for session_id in session_ids:
-            session_key = f'session:{session_id.decode()}'
-            session_data = self.redis.get(session_key)
+        Session keys expire on their own at expires_at, which is no later than
+        a session lifetime after their last access, each member's score; so
+        only the index can go stale.
+        """
+        try:
+            self.redis.zremrangebyscore(
+                f'user_sessions:{user_id}', '-inf', time.time() - self.session_lifetime
+            )
+        except ResponseError:
+            self._convert_user_sessions(f'user_sessions:{user_id}')
 
-            if session_data:
-                session_data = json.loads(session_data)
-                expires_at = datetime.fromisoformat(session_data['expires_at'])
-                
-                if expires_at < now:
-                    self.delete_session(session_id.decode())
+    def _delete_user_sessions(self, user_id, session_ids):
+        """Delete several of a user's sessions in one round-trip"""
+        if not session_ids:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(*[f'session:{session_id}' for session_id in session_ids])
+        pipe.zrem(f'user_sessions:{user_id}', *session_ids)
+        pipe.execute()
 
     def _enforce_max_sessions(self, user_id):
         """Enforce maximum number of sessions per user"""
-        sessions = self.get_user_sessions(user_id)
-        
-        if len(sessions) > self.max_sessions:
-            # Sort sessions by last accessed time and remove oldest
-            sorted_sessions = sorted(
-                sessions,
-                key=lambda x: datetime.fromisoformat(x['last_accessed'])
-            )
-            
-            for session in sorted_sessions[:-self.max_sessions]:
-                self.delete_session(session['session_id'])
+        # Sessions can expire before their score ages out of the index, so
+        # check which still exist rather than counting members
+        session_ids = self._user_session_ids(user_id)
+        pipe = self.redis.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.exists(f'session:{session_id}')
+        exists = pipe.execute()
+
+        live = [session_id for session_id, alive in zip(session_ids, exists) if alive]
+        dead = [session_id for session_id, alive in zip(session_ids, exists) if not alive]
 
-    def revoke_all_user_sessions(self, user_id):
-        """Revoke all sessions for a specific user"""
-        sessions = self.get_user_sessions(user_id)
-        for session in sessions:
-            self.delete_session(session['session_id'])
+        # The index is ordered by last access, so everything but the newest
+        # max_sessions live sessions goes
+        self._delete_user_sessions(user_id, dead + live[:-self.max_sessions])
+
+    def revoke_all_user_sessions(self, user_id, keep_session_id=None):
+        """
+        Revoke all sessions for a specific user, optionally sparing one
+
+        Runs as a single pipeline regardless of how many sessions the user has.
+        """
+        session_ids = [
+            session_id for session_id in self._user_session_ids(user_id)
+            if session_id != keep_session_id
+        ]
+        self._delete_user_sessions(user_id, session_ids)
 
     def validate_session(self, session_id, user_agent, ip_address):
         """Validate session integrity and security"""
-        session_data = self.get_session(session_id)
-        if not session_data:
+        # Only the fields checked here are read back
+        session_key = f'session:{session_id}'
+        try:
+            user_id, stored_user_agent, stored_ip_address, last_accessed, expires_at = self.redis.hmget(
+                session_key, ['user_id', 'user_agent', 'ip_address', 'last_accessed', 'expires_at']
+            )
+        except ResponseError:
+            # A session stored as a JSON string before sessions became hashes
+            self.redis.delete(session_key)
             return False
 
-        # Check if session is expired
-        expires_at = datetime.fromisoformat(session_data['expires_at'])
-        if expires_at < datetime.utcnow():
-            self.delete_session(session_id)
+        # Expired sessions are gone from Redis
+        if user_id is None:
+            if last_accessed is not None:
+                # A stray hash left by a touch that raced the session's expiry
+                self.redis.delete(session_key)
             return False
 
         # Validate user agent and IP (optional strict checking)
-        if self.app.config.get('STRICT_SESSION_SECURITY', False):
-            if session_data['user_agent'] != user_agent:
+        if self.strict_security:
+            if stored_user_agent.decode() != (user_agent or ''):
                 self.delete_session(session_id)
                 return False
             
-            if session_data['ip_address'] != ip_address:
+            if stored_ip_address.decode() != (ip_address or ''):
                 self.delete_session(session_id)
                 return False
 
+        self._touch_session(session_id, int(user_id), _epoch(last_accessed), _epoch(expires_at))
         return True